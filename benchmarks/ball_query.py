@@ -0,0 +1,60 @@
+'''
+Time of the PyTorch density-aware ball query (openpoints/models/PCM/ball_query.py), split into the
+radius adjustment and the query, for the encoder stages of HandModel.
+    python benchmarks/ball_query.py --device cuda --batch 32
+'''
+import os
+import sys
+import time
+import types
+import argparse
+import importlib
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (points, centroids, radius, nsample) of the encoder stages
+STAGES = [(1024, 1024, 0.1, 12), (1024, 512, 0.1, 12), (512, 256, 0.3, 12), (256, 128, 0.3, 12)]
+
+
+def load_ball_query():
+    # the PCM modules alone, openpoints.models imports the CUDA extensions
+    package = types.ModuleType('pcm')
+    package.__path__ = [os.path.join(ROOT, 'openpoints', 'models', 'PCM')]
+    sys.modules['pcm'] = package
+    return importlib.import_module('pcm.ball_query')
+
+
+def timed(fn, device, repeat):
+    fn()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    t = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, (time.perf_counter() - t) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch', type=int, default=32, help='clouds per batch')
+    parser.add_argument('--lambda_param', type=float, default=0.3)
+    parser.add_argument('--k_dense', type=int, default=24)
+    parser.add_argument('--query_block', type=int, default=None, help='centroids per tile, default by device')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs')
+    opt = parser.parse_args()
+
+    bq = load_ball_query()
+    device = torch.device(opt.device)
+    torch.manual_seed(0)
+    print('%8s %10s %8s %8s %12s %12s' % ('points', 'centroids', 'radius', 'nsample', 'radius (ms)', 'query (ms)'))
+    for n, s, radius, nsample in STAGES:
+        xyz = torch.rand(opt.batch, n, 3, device=device) * 2 - 1
+        new_xyz = xyz[:, :s].contiguous()
+        adjusted, t_radius = timed(lambda: bq.density_radius(xyz, new_xyz, radius, opt.lambda_param, opt.k_dense),
+                                   device, opt.repeat)
+        _, t_query = timed(lambda: bq.ball_query(adjusted, nsample, xyz, new_xyz, opt.query_block), device, opt.repeat)
+        print('%8d %10d %8.2f %8d %12.2f %12.2f' % (n, s, radius, nsample, t_radius * 1000, t_query * 1000))
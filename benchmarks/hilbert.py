@@ -0,0 +1,53 @@
+'''
+Time of the Hilbert encoders of openpoints/models/PCM/hilbert.py: the bit loop (encode) against the
+look up tables (xyz2key), over cloud sizes and grid depths, with the fraction of equal codes.
+    python benchmarks/hilbert.py --device cuda --points 1024 16384 131072 --depth 8 16
+'''
+import os
+import time
+import argparse
+import importlib.util
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_hilbert():
+    # the module alone, openpoints.models imports the CUDA extensions
+    spec = importlib.util.spec_from_file_location('hilbert', os.path.join(ROOT, 'openpoints', 'models', 'PCM', 'hilbert.py'))
+    hilbert = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(hilbert)
+    return hilbert
+
+
+def timed(fn, device, repeat):
+    fn()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    t = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, (time.perf_counter() - t) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--points', type=int, nargs='+', default=[1024, 16384, 131072], help='grid coordinates')
+    parser.add_argument('--depth', type=int, nargs='+', default=[8, 16], help='bits per axis')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs')
+    opt = parser.parse_args()
+
+    hilbert = load_hilbert()
+    device = torch.device(opt.device)
+    torch.manual_seed(0)
+    print('%10s %8s %12s %12s %10s %8s' % ('points', 'depth', 'loop (ms)', 'lut (ms)', 'speedup', 'equal'))
+    for n in opt.points:
+        for depth in opt.depth:
+            grid_coord = torch.randint(0, 2 ** depth, (n, 3), device=device)
+            reference, t_loop = timed(lambda: hilbert.encode(grid_coord, num_dims=3, num_bits=depth), device, opt.repeat)
+            code, t_lut = timed(lambda: hilbert.xyz2key(*grid_coord.unbind(-1), depth=depth), device, opt.repeat)
+            print('%10d %8d %12.2f %12.2f %10.1f %8.4f' % (n, depth, t_loop * 1000, t_lut * 1000, t_loop / t_lut,
+                                                          (code == reference).float().mean().item()))
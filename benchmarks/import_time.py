@@ -0,0 +1,99 @@
+'''
+Startup latency of the training / evaluation entry points and of DataLoader worker spawn.
+
+Every measurement runs in a fresh interpreter, so the numbers include the full import cost.
+    python benchmarks/import_time.py --repeat 5 --workers 8
+'''
+import os
+import sys
+import ast
+import time
+import argparse
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODULES = ['torch', 'dataloader.loader', 'dataloader.ho3d_loader', 'openpoints.dataset.data_util']
+SCRIPTS = ['train_mdda.py', 'eval.py']
+
+
+def script_imports(script):
+    """
+    Module level import statements of a script, including the ones under if blocks
+    (the dataset loaders), but not the network picked at runtime with importlib
+    """
+    with open(os.path.join(ROOT, script)) as f:
+        source = f.read()
+    tree = ast.parse(source)
+    lines = []
+    nodes = list(tree.body)
+    while nodes:
+        node = nodes.pop(0)
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(ast.get_source_segment(source, node))
+        elif isinstance(node, (ast.If, ast.Try)):
+            nodes = list(node.body) + list(node.orelse) + nodes
+    # keep the order, drop duplicates
+    return list(dict.fromkeys(lines))
+
+
+def time_snippet(snippet, repeat):
+    code = 'import time\nt = time.perf_counter()\n%s\nprint(time.perf_counter() - t)' % snippet
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+        total = time.perf_counter() - t
+        if out.returncode != 0:
+            return None, out.stderr.strip().splitlines()[-1]
+        times.append((float(out.stdout.strip().splitlines()[-1]), total))
+    times = np.array(times)
+    return np.median(times, 0), None
+
+
+class _WorkerProbe(object):
+    # pickled into every worker, unpickling it imports dataloader.loader like a real dataset does
+    def __init__(self, n):
+        from dataloader import loader
+        self.reader = loader.nyu_reader
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        return index
+
+
+def time_worker_spawn(workers, repeat, context):
+    import torch.utils.data
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        data = torch.utils.data.DataLoader(_WorkerProbe(workers), batch_size=1, num_workers=workers,
+                                           multiprocessing_context=context)
+        for _ in data:
+            pass
+        times.append(time.perf_counter() - t)
+    return np.median(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per measurement')
+    parser.add_argument('--workers', type=int, default=8, help='DataLoader workers to spawn')
+    parser.add_argument('--context', type=str, default='spawn', help='multiprocessing context: spawn | forkserver | fork')
+    opt = parser.parse_args()
+
+    print('%-40s %12s %12s' % ('import', 'import (s)', 'process (s)'))
+    for module in MODULES:
+        t, err = time_snippet('import %s' % module, opt.repeat)
+        print('%-40s %s' % (module, 'failed: %s' % err if t is None else '%12.3f %12.3f' % tuple(t)))
+    for script in SCRIPTS:
+        t, err = time_snippet('\n'.join(script_imports(script)), opt.repeat)
+        print('%-40s %s' % (script, 'failed: %s' % err if t is None else '%12.3f %12.3f' % tuple(t)))
+
+    t = time_worker_spawn(opt.workers, opt.repeat, opt.context)
+    print('%-40s %12.3f' % ('%d %s workers, first epoch' % (opt.workers, opt.context), t))
@@ -0,0 +1,70 @@
+'''
+Time and peak memory of the kNN backends (openpoints/models/PCM/knn.py) against the dense
+square_distance + topk search, over cloud sizes.
+    python benchmarks/knn.py --device cuda --points 1024 16384 131072 --queries 512 --k 16
+'''
+import os
+import sys
+import time
+import argparse
+import importlib.util
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_knn():
+    # the module alone, openpoints.models imports the CUDA extensions
+    spec = importlib.util.spec_from_file_location('knn', os.path.join(ROOT, 'openpoints', 'models', 'PCM', 'knn.py'))
+    knn = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(knn)
+    return knn
+
+
+def dense(k, xyz, new_xyz, knn):
+    return torch.topk(knn.square_distance(new_xyz, xyz), k, dim=-1, largest=False, sorted=True)[1]
+
+
+def measure(fn, device, repeat):
+    fn()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    t = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = (time.perf_counter() - t) / repeat
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return out, elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch', type=int, default=2, help='clouds per batch')
+    parser.add_argument('--points', type=int, nargs='+', default=[1024, 16384, 131072], help='reference points')
+    parser.add_argument('--queries', type=int, default=512, help='query points, 0 queries every point')
+    parser.add_argument('--k', type=int, default=16, help='neighbours')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs')
+    parser.add_argument('--dense_max', type=int, default=32768, help='largest cloud searched densely')
+    opt = parser.parse_args()
+
+    knn = load_knn()
+    device = torch.device(opt.device)
+    torch.manual_seed(0)
+    print('%10s %10s %10s %12s %12s %8s' % ('points', 'queries', 'backend', 'time (ms)', 'peak (MB)', 'exact'))
+    for n in opt.points:
+        xyz = torch.rand(opt.batch, n, 3, device=device)
+        s = opt.queries if 0 < opt.queries < n else n
+        new_xyz = xyz[:, torch.randperm(n, device=device)[:s]]
+        reference = None
+        if n <= opt.dense_max:
+            reference, t, peak = measure(lambda: dense(opt.k, xyz, new_xyz, knn), device, opt.repeat)
+            print('%10d %10d %10s %12.2f %12.1f %8s' % (n, s, 'dense', t * 1000, peak, '-'))
+        for backend in ['tiled', 'grid']:
+            idx, t, peak = measure(lambda: knn.knn_query(opt.k, xyz, new_xyz, backend=backend), device, opt.repeat)
+            exact = '-' if reference is None else \
+                '%.4f' % (torch.sort(idx, -1)[0] == torch.sort(reference, -1)[0]).float().mean().item()
+            print('%10d %10d %10s %12.2f %12.1f %8s' % (n, s, backend, t * 1000, peak, exact))
@@ -0,0 +1,52 @@
+'''
+Time of the PyTorch selective scans (mamba_ssm/ops/cpu_interface.py) against selective_scan_ref, on the
+sequence lengths and widths of the encoder stages of HandModel, with the largest error to the ref.
+    python benchmarks/selective_scan.py --batch 1 --threads 4
+'''
+import time
+import argparse
+import torch
+from mamba_ssm.ops.selective_scan_interface import selective_scan_ref
+from mamba_ssm.ops.cpu_interface import selective_scan_cpu
+
+# (sequence length, d_inner) of the encoder stages: 1024 points then halved, d_inner = 2 * channels
+STAGES = [(1024, 256), (512, 256), (256, 512), (128, 512)]
+
+
+def timed(fn, repeat):
+    fn()  # warm up
+    t = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - t) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=1, help='clouds per batch')
+    parser.add_argument('--d_state', type=int, default=16)
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs')
+    parser.add_argument('--skip_ref', action='store_true', help='do not time selective_scan_ref')
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    torch.manual_seed(0)
+    print('%8s %8s %10s %14s %14s %10s' % ('length', 'd_inner', 'scan', 'time (ms)', 'speedup', 'max err'))
+    for L, D in STAGES:
+        u, delta, z = [torch.randn(opt.batch, D, L) for _ in range(3)]
+        B, C = [torch.randn(opt.batch, opt.d_state, L) for _ in range(2)]
+        # S4D real initialization, as Mamba
+        A = -torch.arange(1, opt.d_state + 1, dtype=torch.float32).repeat(D, 1)
+        D_skip, delta_bias = torch.ones(D), torch.randn(D)
+        args = (u, delta, A, B, C, D_skip, z, delta_bias, True)
+        reference, t_ref = timed(lambda: selective_scan_ref(*args), 1 if opt.skip_ref else opt.repeat)
+        if not opt.skip_ref:
+            print('%8d %8d %10s %14.2f %14s %10s' % (L, D, 'ref', t_ref * 1000, '1.00', '-'))
+        for name, parallel in [('chunked', False), ('log-depth', True)]:
+            out, t = timed(lambda: selective_scan_cpu(*args, chunk_size=opt.chunk_size, parallel=parallel), opt.repeat)
+            speedup = '-' if opt.skip_ref else '%.2f' % (t_ref / t)
+            print('%8d %8d %10s %14.2f %14s %10.2e' % (L, D, name, t * 1000, speedup,
+                                                       (out - reference).abs().max().item()))
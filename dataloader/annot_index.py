@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar compiled annotation index.
+
+The loaders parse the COCO json (DexYCB, HO3D) or ``joint_data.mat`` (NYU) at
+startup and keep the result as a list of dicts of small numpy arrays, whose
+reference counts are touched by every DataLoader worker (copy-on-write RSS
+growth).  ``compile_annot_index`` writes the parsed annotations once as one
+``.npy`` file per column and ``AnnotIndex`` maps them back with
+``mmap_mode='r'``, so a worker only holds a few large shared arrays.
+
+Layout of an index directory:
+
+    meta.json                     num_records, array columns, string columns
+    <column>.npy                  [N, ...] one array per field, nested dicts as 'cam_param.focal'
+    <column>.blob.npy             uint8, utf-8 bytes of a string column back to back
+    <column>.offset.npy           [N + 1] int64, start of each string in the blob
+"""
+import os
+import json
+import argparse
+import os.path as osp
+import numpy as np
+
+META_NAME = 'meta.json'
+
+
+def _flatten(record, prefix=''):
+    items = []
+    for k, v in record.items():
+        if isinstance(v, dict):
+            items += _flatten(v, prefix + k + '.')
+        else:
+            items.append((prefix + k, v))
+    return items
+
+
+def compile_annot_index(records, out_dir, columns=None):
+    """
+    Write annotations to a columnar index
+    :param records: list of dicts with the same fields (the datalist of a loader), may be empty if columns is given
+    :param out_dir: output directory
+    :param columns: dict of extra array columns, each [N, ...]
+    """
+    if not osp.exists(out_dir):
+        os.makedirs(out_dir)
+    arrays = {}
+    strings = {}
+    for record in records:
+        for k, v in _flatten(record):
+            if isinstance(v, str):
+                strings.setdefault(k, []).append(v)
+            else:
+                arrays.setdefault(k, []).append(np.asarray(v))
+    arrays = {k: np.stack(v) for k, v in arrays.items()}
+    if columns is not None:
+        arrays.update({k: np.asarray(v) for k, v in columns.items()})
+    lengths = set([len(v) for v in arrays.values()] + [len(v) for v in strings.values()])
+    assert len(lengths) == 1, 'all columns must have the same length'
+
+    for k, v in arrays.items():
+        np.save(osp.join(out_dir, k + '.npy'), v)
+    for k, v in strings.items():
+        encoded = [s.encode('utf-8') for s in v]
+        offset = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offset[1:] = np.cumsum([len(s) for s in encoded])
+        np.save(osp.join(out_dir, k + '.blob.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(osp.join(out_dir, k + '.offset.npy'), offset)
+    with open(osp.join(out_dir, META_NAME), 'w') as f:
+        json.dump({'num_records': lengths.pop(), 'arrays': sorted(arrays.keys()),
+                   'strings': sorted(strings.keys())}, f)
+
+
+class AnnotIndex(object):
+    """
+    Read-only view of an index written by compile_annot_index.
+    Indexing returns a fresh record dict in the datalist format, so callers can
+    modify it without a deepcopy.
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(osp.join(root, META_NAME)) as f:
+            self.meta = json.load(f)
+        self._open()
+
+    def _open(self):
+        root = self.root
+        self.arrays = {k: np.load(osp.join(root, k + '.npy'), mmap_mode='r') for k in self.meta['arrays']}
+        self.strings = {k: (np.load(osp.join(root, k + '.blob.npy'), mmap_mode='r'),
+                            np.load(osp.join(root, k + '.offset.npy'), mmap_mode='r'))
+                        for k in self.meta['strings']}
+
+    def __len__(self):
+        return self.meta['num_records']
+
+    def __getstate__(self):
+        # pickling a memmap copies its data, reopen the maps instead
+        return {'root': self.root, 'meta': self.meta}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def column(self, name):
+        return self.arrays[name]
+
+    def string(self, name, idx):
+        blob, offset = self.strings[name]
+        return blob[offset[idx]:offset[idx + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, idx):
+        record = {}
+        items = [(k, np.array(v[idx])) for k, v in self.arrays.items()]
+        items += [(k, self.string(k, idx)) for k in self.strings]
+        for k, v in items:
+            if isinstance(v, np.ndarray) and v.ndim == 0:
+                v = v.item()
+            keys = k.split('.')
+            node = record
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = v
+        return record
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='dexycb', help='dataset name: nyu, dexycb, ho3d')
+    parser.add_argument('--dataset_path', type=str, default='../dataset', help='dataset path')
+    parser.add_argument('--protocal', type=str, default='s0', help='evaluation setting')
+    parser.add_argument('--phase', type=str, default='train', help='train | test (ho3d: train_all | test)')
+    parser.add_argument('--out', type=str, required=True, help='output directory of the index')
+    opt = parser.parse_args()
+
+    if opt.dataset == 'nyu':
+        import scipy.io as sio
+        labels = sio.loadmat('{}/{}/joint_data.mat'.format(opt.dataset_path, opt.phase))
+        compile_annot_index([], opt.out, columns={'joint_uvd': labels['joint_uvd'][0],
+                                                  'joint_xyz': labels['joint_xyz'][0]})
+    elif opt.dataset == 'dexycb':
+        from dataloader import loader
+        data = loader.DexYCBDataset(opt.protocal, opt.phase, opt.dataset_path)
+        compile_annot_index(data.datalist, opt.out)
+    elif opt.dataset == 'ho3d':
+        from dataloader import ho3d_loader
+        data = ho3d_loader.HO3D(opt.phase, opt.dataset_path, dataset_version='v2', center_type='joint_mean')
+        compile_annot_index(data.datalist, opt.out)
+    else:
+        raise NotImplementedError()
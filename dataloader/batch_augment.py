@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Batched depth augmentation.
+
+Tensor version of ``loader.augmentCrop`` (rot / com / sc / none) that works on a
+collated batch of un-augmented crops, so the warps run as a single
+``grid_sample`` call on the training device instead of one ``cv2.warpAffine`` /
+``cv2.warpPerspective`` per sample inside the workers.
+
+The datasets return the raw crop with ``device_augment=True``:
+    crop [B, 1, H, W], gt3Dcrop [B, J, 3], com (u, v, d) [B, 3], cube [B, 3], M [B, 3, 3], cam_para [B, 4]
+"""
+import torch
+import torch.nn.functional as F
+from dataloader.batch_pcl import img_to_points
+from dataloader.geometry import pixel_grid, inverse_3x3, joint_img_to_3d, joint_3d_to_img
+
+
+def com_to_transform(com, cube, dsize, paras):
+    """
+    Batched loader.comToTransform
+    :param com: [B, 3] center of mass in image coordinates
+    :param cube: [B, 3] cube size in mm
+    :param dsize: (x, y) size of the crop
+    :return: [B, 3, 3] affine transform
+    """
+    fx, fy = paras[:, 0], paras[:, 1]
+    u, v, d = com.unbind(-1)
+    xstart = torch.floor((u * d / fx - cube[:, 0] / 2.) / d * fx + 0.5)
+    xend = torch.floor((u * d / fx + cube[:, 0] / 2.) / d * fx + 0.5)
+    ystart = torch.floor((v * d / fy - cube[:, 1] / 2.) / d * fy + 0.5)
+    yend = torch.floor((v * d / fy + cube[:, 1] / 2.) / d * fy + 0.5)
+
+    wb = xend - xstart
+    hb = yend - ystart
+    wide = wb > hb
+    scale = torch.where(wide, dsize[0] / wb, dsize[1] / hb)
+    sz_x = torch.where(wide, torch.full_like(wb, dsize[0]), wb * dsize[1] / hb)
+    sz_y = torch.where(wide, hb * dsize[0] / wb, torch.full_like(hb, dsize[1]))
+
+    trans = torch.zeros(com.size(0), 3, 3, dtype=com.dtype, device=com.device)
+    trans[:, 0, 0] = scale
+    trans[:, 1, 1] = scale
+    trans[:, 0, 2] = torch.floor(dsize[0] / 2. - sz_x / 2.) - scale * xstart
+    trans[:, 1, 2] = torch.floor(dsize[1] / 2. - sz_y / 2.) - scale * ystart
+    trans[:, 2, 2] = 1
+    return trans
+
+
+def rotation_matrix_2d(center, rot):
+    """
+    Batched cv2.getRotationMatrix2D(center, -rot, 1) as 3x3 matrices
+    :param center: (x, y) center of rotation
+    :param rot: [B] angle in deg
+    """
+    alpha = torch.cos(torch.deg2rad(-rot))
+    beta = torch.sin(torch.deg2rad(-rot))
+    cx, cy = center
+    trans = torch.zeros(rot.size(0), 3, 3, dtype=rot.dtype, device=rot.device)
+    trans[:, 0, 0] = alpha
+    trans[:, 0, 1] = beta
+    trans[:, 0, 2] = (1 - alpha) * cx - beta * cy
+    trans[:, 1, 0] = -beta
+    trans[:, 1, 1] = alpha
+    trans[:, 1, 2] = beta * cx + (1 - alpha) * cy
+    trans[:, 2, 2] = 1
+    return trans
+
+
+def warp_nearest(img, trans):
+    """
+    Batched cv2.warpPerspective(img, trans, flags=cv2.INTER_NEAREST) with a zero border
+    :param img: [B, 1, H, W]
+    :param trans: [B, 3, 3] forward transform (source -> destination pixel)
+    """
+    B, _, H, W = img.size()
+    ys, xs = pixel_grid(H, W, img.device, trans.dtype)
+    dst = torch.stack((xs, ys, torch.ones_like(xs)), dim=-1).view(1, H * W, 3)
+    src = torch.matmul(dst, inverse_3x3(trans).transpose(1, 2))
+    src = src[:, :, 0:2] / src[:, :, 2:]
+    # pixel centers, align_corners=False
+    grid = torch.stack(((2 * src[:, :, 0] + 1) / W - 1, (2 * src[:, :, 1] + 1) / H - 1), dim=-1)
+    grid = grid.view(B, H, W, 2).to(img.dtype)
+    return F.grid_sample(img, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+
+class BatchAugment(object):
+    """
+    Batched loader.augmentCrop followed by the normalization and point sampling of __getitem__.
+    Parameters are drawn per sample with the same distributions as loader.rand_augment.
+    """
+    def __init__(self, img_size=128, aug_modes=('rot', 'com', 'sc', 'none'), aug_para=(10, 0.2, 180), flip=1,
+                 sample_num=1024, pix_dropout=0.):
+        self.img_size = img_size
+        self.aug_modes = list(aug_modes)
+        self.sigma_com, self.sigma_sc, self.rot_range = aug_para
+        self.flip = flip
+        self.sample_num = sample_num
+        # probability 0.7, as in nyu_loader
+        self.pix_dropout = pix_dropout
+
+    def rand_augment(self, batch_size, device=None):
+        mode = torch.randint(0, len(self.aug_modes), (batch_size,), device=device)
+        off = (torch.rand(batch_size, 3, device=device, dtype=torch.float64) * 2 - 1) * self.sigma_com
+        rot = (torch.rand(batch_size, device=device, dtype=torch.float64) * 2 - 1) * self.rot_range
+        sc = torch.abs(1. + (torch.rand(batch_size, device=device, dtype=torch.float64) * 2 - 1) * self.sigma_sc)
+        return mode, off, rot, sc
+
+    def _mode_mask(self, mode, name):
+        if name not in self.aug_modes:
+            return torch.zeros_like(mode, dtype=torch.bool)
+        return mode == self.aug_modes.index(name)
+
+    def augment(self, crop, gt3Dcrop, com, cube, M, paras, mode, off, rot, sc):
+        """
+        Batched loader.augmentCrop
+        :return: normalized image, 3D annotations(unnormal), cube, com(image coordinates), M
+        """
+        dtype = torch.float64
+        crop = crop.float()
+        gt3Dcrop, com, cube, M, paras = [t.to(dtype) for t in (gt3Dcrop, com, cube, M, paras)]
+        off, rot, sc = off.to(dtype), rot.to(dtype), sc.to(dtype)
+        B, _, H, W = crop.size()
+
+        premax = crop.view(B, -1).max(-1)[0]
+        active = premax > 0
+        is_com = self._mode_mask(mode, 'com') & active
+        is_rot = self._mode_mask(mode, 'rot') & active & (rot != 0)
+        is_sc = self._mode_mask(mode, 'sc') & active & (sc != 1)
+
+        eye = torch.eye(3, dtype=dtype, device=crop.device).expand(B, 3, 3)
+        com3D = joint_img_to_3d(com, paras, self.flip)
+
+        # com: recrop around the moved center
+        new_com = joint_3d_to_img(com3D + off, paras, self.flip)
+        is_com = is_com & (com[:, 2] != 0) & (new_com[:, 2] != 0)
+        M_com = com_to_transform(new_com, cube, (H, W), paras)
+
+        # sc: recrop with the scaled cube
+        new_cube = cube * sc.view(B, 1)
+        M_sc = com_to_transform(com, new_cube, (H, W), paras)
+
+        # rot: rotate about the crop center
+        R = rotation_matrix_2d((W // 2, H // 2), torch.remainder(rot, 360))
+
+        M_inv = inverse_3x3(M)
+        warp = torch.where(is_com.view(B, 1, 1), torch.matmul(M_com, M_inv), eye)
+        warp = torch.where(is_sc.view(B, 1, 1), torch.matmul(M_sc, M_inv), warp)
+        warp = torch.where(is_rot.view(B, 1, 1), R, warp)
+        img = warp_nearest(crop, warp)
+
+        # recropHand depth threshold, with the new com for 'com' and the old cube for 'sc'
+        recrop = (is_com | is_sc).view(B, 1, 1, 1)
+        z_com = torch.where(is_com, new_com[:, 2], com[:, 2]).to(img.dtype).view(B, 1, 1, 1)
+        zstart = z_com - cube[:, 2].to(img.dtype).view(B, 1, 1, 1) / 2.
+        zend = z_com + cube[:, 2].to(img.dtype).view(B, 1, 1, 1) / 2.
+        img = torch.where(recrop & (img < zstart) & (img != 0), zstart.expand_as(img), img)
+        img = torch.where(recrop & (img > zend) & (img != 0), torch.zeros_like(img), img)
+
+        # joints
+        new_joints3D = gt3Dcrop.clone()
+        shift = (com3D - joint_img_to_3d(new_com, paras, self.flip)).unsqueeze(1)
+        new_joints3D = torch.where(is_com.view(B, 1, 1), gt3Dcrop + shift, new_joints3D)
+        joint_2D = joint_3d_to_img(gt3Dcrop + com3D.unsqueeze(1), paras, self.flip)
+        alpha = torch.deg2rad(torch.remainder(rot, 360)).view(B, 1)
+        du = joint_2D[:, :, 0] - com[:, 0:1]
+        dv = joint_2D[:, :, 1] - com[:, 1:2]
+        joint_rot = torch.stack((du * torch.cos(alpha) - dv * torch.sin(alpha) + com[:, 0:1],
+                                 du * torch.sin(alpha) + dv * torch.cos(alpha) + com[:, 1:2],
+                                 joint_2D[:, :, 2]), dim=-1)
+        joint_rot = joint_img_to_3d(joint_rot, paras, self.flip) - com3D.unsqueeze(1)
+        new_joints3D = torch.where(is_rot.view(B, 1, 1), joint_rot, new_joints3D)
+
+        com = torch.where(is_com.view(B, 1), new_com, com)
+        cube = torch.where(is_sc.view(B, 1), new_cube, cube)
+        M = torch.where(is_com.view(B, 1, 1), M_com, M)
+        M = torch.where(is_sc.view(B, 1, 1), M_sc, M)
+
+        img = self.normalize_img(premax, img, com, cube)
+        return img, new_joints3D, cube, com, M
+
+    def normalize_img(self, premax, img, com, cube):
+        """
+        Batched loader.normalize_img
+        """
+        B = img.size(0)
+        premax = premax.view(B, 1, 1, 1)
+        d = com[:, 2].to(img.dtype).view(B, 1, 1, 1)
+        half = (cube[:, 2] / 2.).to(img.dtype).view(B, 1, 1, 1)
+        img = torch.where((img == premax) | (img == 0), d + half, img)
+        img = torch.min(torch.max(img, d - half), d + half)
+        return (img - d) / half
+
+    def __call__(self, crop, gt3Dcrop, com, cube, M, paras):
+        """
+        :return: img [B, 1, H, W], points [B, sample_num, 3], joint [B, J, 3], center [B, 3], M, cube
+        """
+        mode, off, rot, sc = self.rand_augment(crop.size(0), crop.device)
+        img, joint, cube, com, M = self.augment(crop, gt3Dcrop, com, cube, M, paras, mode, off, rot, sc)
+        paras = paras.to(com.dtype)
+        if self.pix_dropout > 0:
+            img = pix_dropout(img, background_value=1, P=self.pix_dropout, V=1, prob=0.7)
+        joint = joint / (cube[:, 2:3].unsqueeze(1) / 2.0)
+        center = joint_img_to_3d(com, paras, self.flip)
+        points, _ = img_to_points(img, center, cube, M, paras, self.flip, self.sample_num)
+        return img, points.float(), joint.float(), center.float(), M.float(), cube.float()
+
+
+def pix_dropout(img, background_value, P, V=1, prob=1.):
+    """
+    Batched loader.PixDropout with a Bernoulli mask
+    :param img: [B, 1, H, W]
+    :param P: fraction of foreground pixels set to V, float or [B]
+    :param prob: probability that a sample is augmented at all
+    """
+    B = img.size(0)
+    P = torch.as_tensor(P, dtype=img.dtype, device=img.device).expand(B).view(B, 1, 1, 1)
+    apply = (torch.rand(B, 1, 1, 1, device=img.device) < prob)
+    foreground = (img - background_value).abs() > 1e-6
+    drop = foreground & apply & (torch.rand_like(img) < P)
+    return torch.where(drop, torch.full_like(img, V), img)
+
+
+def pixhole_dropout(img, background_value, max_hole_size, num_holes, V=1):
+    """
+    Batched loader.PixholeDropout, circular holes at random centers
+    :param img: [B, 1, H, W]
+    """
+    B, _, H, W = img.size()
+    device = img.device
+    foreground = ((img - background_value).abs() > 1e-6).view(B, -1).sum(-1)
+    # no more holes than foreground pixels, none for an empty image
+    holes = torch.clamp(foreground, max=num_holes).view(B, 1)
+    valid = torch.arange(num_holes, device=device).view(1, num_holes) < holes
+
+    center_x = torch.randint(0, W, (B, num_holes, 1, 1), device=device).to(img.dtype)
+    center_y = torch.randint(0, H, (B, num_holes, 1, 1), device=device).to(img.dtype)
+    hole_size = torch.randint(1, max_hole_size + 1, (B, num_holes, 1, 1), device=device)
+    hole_size = torch.clamp(hole_size, max=min(H, W)).to(img.dtype)
+
+    ys, xs = pixel_grid(H, W, device, img.dtype)
+    distance = torch.sqrt((ys - center_y) ** 2 + (xs - center_x) ** 2)
+    hole = ((distance <= hole_size) & valid.view(B, num_holes, 1, 1)).any(1, keepdim=True)
+    return torch.where(hole, torch.full_like(img, V), img)
+
+
+def mask_img(img, img_joint_uvd, mask_offset, mask_para, min_mask_num=3, max_mask_num=10):
+    """
+    Batched loader.mask_img with a number of masks and joints drawn per sample
+    :param img: [B, 1, S, S] normalized depth
+    :param img_joint_uvd: [B, J, 3] normalized joint uvd
+    """
+    device = img.device
+    b, j, _ = img_joint_uvd.size()
+    S = img.size(-1)
+    K = max_mask_num - 1
+    mask_num = torch.randint(min_mask_num, max_mask_num, (b, 1), device=device)
+    # distinct joints per sample
+    joint_id = torch.argsort(torch.rand(b, j, device=device), dim=-1)[:, :K]
+    mask_uvd = torch.gather(img_joint_uvd, 1, joint_id.unsqueeze(-1).expand(b, K, 3))
+    mask_uvd = mask_uvd + (torch.rand(mask_uvd.size(), device=device) - 0.5) * mask_offset * 2
+    mask_range = torch.rand([b, K], device=device) * mask_para
+    mask_range = torch.where(torch.arange(K, device=device).view(1, K) < mask_num, mask_range,
+                             torch.zeros_like(mask_range))
+
+    ys, xs = pixel_grid(S, S, device, img.dtype)
+    mesh = torch.stack((2 * (xs + 0.5) / S - 1.0, 2 * (ys + 0.5) / S - 1.0), dim=-1).view(1, -1, 2)
+    mesh = torch.cat((mesh.expand(b, -1, 2), img.view(b, -1, 1)), dim=-1).view(b, 1, -1, 3)
+    dis = torch.sqrt(torch.sum((mesh - mask_uvd.view(b, K, 1, 3)) ** 2, dim=-1))
+    mask = dis.lt(mask_range.view([b, K, 1])).any(1)
+    return torch.where(mask.view(b, 1, img.size(-2), img.size(-1)), torch.ones_like(img), img)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Batched back-projection and point sampling.
+
+Tensor version of ``loader.getpcl`` / ``loader.depthToPCL`` followed by the
+point sampling of ``__getitem__``, for a collated batch of normalized crops on
+any device.  Every pixel is back-projected at once and the points are drawn by
+one masked random-rank pass instead of ``np.where`` + ``np.random.choice`` per
+sample.
+"""
+import torch
+from dataloader.geometry import pixel_grid, inverse_3x3
+
+
+def backproject(img, center, cube, M, paras, flip=1):
+    """
+    Batched loader.getpcl, without dropping the background
+    :param img: [B, 1, H, W] normalized depth crop, background is 1
+    :param center: [B, 3] crop center in 3D coordinates
+    :param cube: [B, 3] cube size in mm
+    :param M: [B, 3, 3] crop transform
+    :param paras: [B, 4] (fx, fy, fu, fv)
+    :return: pcl [B, H*W, 3] normalized by the cube, valid [B, H*W]
+    """
+    B, _, H, W = img.size()
+    dtype = center.dtype
+    img = img.view(B, H * W)
+    valid = ~torch.isclose(img, torch.ones_like(img))
+    depth = img.to(dtype) * (cube[:, 2:3] / 2.0) + center[:, 2:3]
+
+    ys, xs = pixel_grid(H, W, img.device, dtype)
+    pts = torch.stack((xs + 0.5, ys + 0.5, torch.ones_like(xs)), dim=-1).view(1, H * W, 3)
+    pts = torch.matmul(pts, inverse_3x3(M.to(dtype)).transpose(1, 2))
+    pts = pts[:, :, 0:2] / pts[:, :, 2:]
+
+    fx, fy, fu, fv = [p.view(B, 1) for p in paras.to(dtype).unbind(-1)]
+    pcl = torch.stack(((pts[:, :, 0] - fu) / fx * depth,
+                       flip * (pts[:, :, 1] - fv) / fy * depth,
+                       depth), dim=-1)
+    pcl = (pcl - center.unsqueeze(1)) / (cube.unsqueeze(1) / 2.0)
+    return pcl, valid
+
+
+def sample_points(pcl, valid, sample_num=1024):
+    """
+    Draw sample_num valid points per sample with one masked random-rank pass.
+    With n >= sample_num valid points this is a draw without replacement, otherwise
+    every point is taken floor(sample_num / n) times and sample_num % n distinct
+    points once more, as in __getitem__.
+    :param pcl: [B, N, 3]
+    :param valid: [B, N]
+    :return: points [B, sample_num, 3] (zeros when there is no valid point), count [B]
+    """
+    B, N, _ = pcl.size()
+    count = valid.sum(-1)
+    # valid points get a random rank in [0, 1), the background sorts last
+    rank = torch.rand(B, N, device=pcl.device)
+    rank = rank.masked_fill(~valid, 2.)
+    k = min(sample_num, N)
+    order = torch.topk(rank, k, dim=-1, largest=False, sorted=True)[1]
+
+    # cycle over the first n ranked points, then shuffle the slots
+    slot = torch.arange(sample_num, device=pcl.device).view(1, sample_num)
+    slot = torch.remainder(slot, count.clamp(min=1).view(B, 1))
+    slot = torch.gather(slot, 1, torch.argsort(torch.rand(B, sample_num, device=pcl.device), dim=-1))
+    index = torch.gather(order, 1, slot)
+    points = torch.gather(pcl, 1, index.unsqueeze(-1).expand(B, sample_num, 3))
+    points = points * (count > 0).view(B, 1, 1).to(points.dtype)
+    return points, count
+
+
+def img_to_points(img, center, cube, M, paras, flip=1, sample_num=1024):
+    """
+    B x H x W normalized crops to B x sample_num x 3 clouds
+    :return: points [B, sample_num, 3], count [B] number of valid pixels
+    """
+    pcl, valid = backproject(img, center, cube, M, paras, flip)
+    return sample_points(pcl, valid, sample_num)
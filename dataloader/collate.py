@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Structured samples and a packed collate.
+
+The loaders return 8 (DexYCB, HO3D) or 9 (NYU) small tensors per sample and the
+default collate allocates one batch tensor per field, each shipped from the
+worker in its own shared-memory segment.  ``PackedCollate`` writes all fields of
+a batch into one preallocated (shared-memory) buffer and returns a
+``PackedBatch`` whose fields are views into it, so a batch is a single
+allocation, a single IPC handle, a single pinned copy and a single host-to-device
+transfer.  Depth and points can be shipped as float16 and are upcast on device.
+"""
+import torch
+from torch.utils.data import get_worker_info
+
+# field names of the samples returned by the loaders
+NYU_FIELDS = ('img', 'pcl', 'joint', 'joint_img', 'center', 'M', 'cube', 'cam_para', 'volume_length')
+DEXYCB_FIELDS = ('img', 'pcl', 'joint', 'joint_img', 'center', 'M', 'cube', 'cam_para')
+HO3D_FIELDS = DEXYCB_FIELDS
+# device_augment=True, see dataloader/batch_augment.py
+RAW_FIELDS = ('crop', 'gt3Dcrop', 'com', 'cube', 'M', 'cam_para')
+HALF_FIELDS = ('img', 'pcl')
+# appended by dataloader/point_precompute.py
+PRECOMPUTE_FIELDS = ('fps_order', 'group_idx', 'group_radius')
+
+_ALIGN = 8
+
+
+class PackedBatch(object):
+    """
+    A collated batch stored in one flat byte buffer.
+    Behaves like the tuple returned by the default collate: fields can be
+    indexed, iterated and unpacked, float16 fields are returned as float32.
+    """
+    def __init__(self, buffer, layout):
+        self.buffer = buffer
+        # (name, dtype, shape, offset, nbytes, upcast)
+        self.layout = layout
+        self._fields = None
+
+    def fields(self):
+        if self._fields is None:
+            fields = []
+            for _, dtype, shape, offset, nbytes, upcast in self.layout:
+                field = self.buffer[offset:offset + nbytes].view(dtype).view(shape)
+                fields.append(field.float() if upcast else field)
+            self._fields = tuple(fields)
+        return self._fields
+
+    def __len__(self):
+        return len(self.layout)
+
+    def __getitem__(self, i):
+        return self.fields()[i]
+
+    def __iter__(self):
+        return iter(self.fields())
+
+    def get(self, name):
+        return self.fields()[[l[0] for l in self.layout].index(name)]
+
+    def pin_memory(self):
+        return PackedBatch(self.buffer.pin_memory(), self.layout)
+
+    def to(self, device, non_blocking=False):
+        return PackedBatch(self.buffer.to(device, non_blocking=non_blocking), self.layout)
+
+    def record_stream(self, stream):
+        self.buffer.record_stream(stream)
+
+
+class PackedCollate(object):
+    """
+    collate_fn writing a list of samples into one PackedBatch
+    :param fields: field names of a sample, in order
+    :param half: names of floating point fields shipped as float16
+    """
+    def __init__(self, fields, half=()):
+        self.fields = tuple(fields)
+        self.half = set(half)
+
+    def layout(self, sample, batch_size):
+        assert len(sample) == len(self.fields), 'sample has %d fields, expected %d' % (len(sample), len(self.fields))
+        layout = []
+        offset = 0
+        for name, value in zip(self.fields, sample):
+            value = torch.as_tensor(value)
+            upcast = name in self.half and value.is_floating_point()
+            dtype = torch.float16 if upcast else value.dtype
+            shape = (batch_size,) + tuple(value.shape)
+            nbytes = torch.Size(shape).numel() * torch.empty((), dtype=dtype).element_size()
+            layout.append((name, dtype, shape, offset, nbytes, upcast))
+            offset += (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+        return layout, offset
+
+    def __call__(self, batch):
+        layout, total = self.layout(batch[0], len(batch))
+        buffer = torch.empty(total, dtype=torch.uint8)
+        if get_worker_info() is not None:
+            # one shared-memory segment for the whole batch instead of one per field
+            buffer = buffer.share_memory_()
+        for (_, dtype, shape, offset, nbytes, _), values in zip(layout, zip(*batch)):
+            field = buffer[offset:offset + nbytes].view(dtype).view(shape)
+            for i, value in enumerate(values):
+                field[i].copy_(torch.as_tensor(value))
+        return PackedBatch(buffer, layout)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Preprocessed crop shard store.
+
+The crop produced by ``Crop_Image_deep_pp`` (together with its transform ``M``,
+the crop centre ``com`` and the cube) is deterministic for a given sample, so it
+only needs to be computed once.  ``prepare_crop_store`` writes it to disk and
+``CropStore`` maps it back, leaving only augmentation on the training hot path.
+
+Layout of a store directory:
+
+    meta.json              img_size, num_samples, shard_size, num_shards
+    index.npy              [N, 2] int64, (shard id, row inside the shard)
+    M.npy                  [N, 3, 3] float64, crop transform
+    com.npy                [N, 3] float64, crop centre (u, v, d)
+    cube.npy               [N, 3] float64, cube size in mm
+    cam_para.npy           [N, 4] float64, (fx, fy, fu, fv)
+    crops_00000.npy ...    [S, H, W] float16, one file per shard
+
+Crops are stored as depth offsets to ``com[2]`` so that float16 keeps sub-mm
+precision over the whole cube; background pixels are stored as NaN.
+"""
+import os
+import json
+import argparse
+import os.path as osp
+import numpy as np
+from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader
+
+META_NAME = 'meta.json'
+SHARD_NAME = 'crops_{:05d}.npy'
+
+
+def encode_crop(depth_crop, com):
+    """
+    Encode a crop as float16 offsets to the crop centre
+    :param depth_crop: cropped depth image, background is 0
+    :param com: crop centre (u, v, d)
+    :return: float16 image, background is NaN
+    """
+    crop = np.full(depth_crop.shape, np.nan, dtype=np.float32)
+    mask = depth_crop != 0
+    crop[mask] = depth_crop[mask] - com[2]
+    return crop.astype(np.float16)
+
+
+def decode_crop(crop, com):
+    """
+    Inverse of encode_crop
+    :return: float32 depth crop, background is 0
+    """
+    crop = crop.astype(np.float32)
+    mask = np.isnan(crop)
+    crop += np.float32(com[2])
+    crop[mask] = 0
+    return crop
+
+
+def _no_convert(sample):
+    return sample
+
+
+class _CropSamples(Dataset):
+    # thin wrapper so the crops can be computed by DataLoader workers
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        depth_crop, M, com, cube, cam_para = self.dataset.crop_sample(index)
+        return index, encode_crop(depth_crop, com), M, com, cube, cam_para
+
+
+def prepare_crop_store(dataset, out_dir, shard_size=4096, workers=8):
+    """
+    Run the deterministic crop of every sample once and write it to a shard store
+    :param dataset: dataset implementing crop_sample(index)
+    :param out_dir: output directory
+    :param shard_size: number of crops per shard
+    :param workers: number of worker processes used to crop
+    """
+    if not osp.exists(out_dir):
+        os.makedirs(out_dir)
+    num_samples = len(dataset)
+    num_shards = (num_samples + shard_size - 1) // shard_size
+    img_size = dataset.img_size
+
+    index = np.zeros([num_samples, 2], dtype=np.int64)
+    all_M = np.zeros([num_samples, 3, 3], dtype=np.float64)
+    all_com = np.zeros([num_samples, 3], dtype=np.float64)
+    all_cube = np.zeros([num_samples, 3], dtype=np.float64)
+    all_cam_para = np.zeros([num_samples, 4], dtype=np.float64)
+
+    shards = []
+    for shard_id in range(num_shards):
+        rows = min(shard_size, num_samples - shard_id * shard_size)
+        shards.append(np.lib.format.open_memmap(osp.join(out_dir, SHARD_NAME.format(shard_id)), mode='w+',
+                                                dtype=np.float16, shape=(rows, img_size, img_size)))
+
+    samples = DataLoader(_CropSamples(dataset), batch_size=None, shuffle=False, num_workers=workers,
+                         collate_fn=_no_convert)
+    for i, crop, M, com, cube, cam_para in tqdm(samples, ncols=50):
+        shard_id, row = divmod(i, shard_size)
+        shards[shard_id][row] = crop
+        index[i] = (shard_id, row)
+        all_M[i], all_com[i], all_cube[i], all_cam_para[i] = M, com, cube, cam_para
+
+    for shard in shards:
+        shard.flush()
+    np.save(osp.join(out_dir, 'index.npy'), index)
+    np.save(osp.join(out_dir, 'M.npy'), all_M)
+    np.save(osp.join(out_dir, 'com.npy'), all_com)
+    np.save(osp.join(out_dir, 'cube.npy'), all_cube)
+    np.save(osp.join(out_dir, 'cam_para.npy'), all_cam_para)
+    with open(osp.join(out_dir, META_NAME), 'w') as f:
+        json.dump({'img_size': img_size, 'num_samples': num_samples, 'shard_size': shard_size,
+                   'num_shards': num_shards}, f)
+
+
+class CropStore(object):
+    """
+    Read-only view of a store written by prepare_crop_store.
+    Shards are memory-mapped lazily so every DataLoader worker opens its own maps
+    and the page cache is shared between them.
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(osp.join(root, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.img_size = self.meta['img_size']
+        self.index = np.load(osp.join(root, 'index.npy'))
+        self.M = np.load(osp.join(root, 'M.npy'))
+        self.com = np.load(osp.join(root, 'com.npy'))
+        self.cube = np.load(osp.join(root, 'cube.npy'))
+        self.cam_para = np.load(osp.join(root, 'cam_para.npy'))
+        self.shards = None
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def _open(self):
+        self.shards = [np.load(osp.join(self.root, SHARD_NAME.format(i)), mmap_mode='r')
+                       for i in range(self.meta['num_shards'])]
+
+    def __getitem__(self, index):
+        """
+        :return: depth crop (float32, writable), M, com, cube, cam_para
+        """
+        if self.shards is None:
+            self._open()
+        shard_id, row = self.index[index]
+        com = self.com[index].copy()
+        depth_crop = decode_crop(self.shards[shard_id][row], com)
+        return depth_crop, self.M[index].copy(), com, self.cube[index].copy(), tuple(self.cam_para[index])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='dexycb', help='dataset name: nyu, dexycb')
+    parser.add_argument('--dataset_path', type=str, default='../dataset', help='dataset path')
+    parser.add_argument('--protocal', type=str, default='s0', help='evaluation setting')
+    parser.add_argument('--phase', type=str, default='train', help='train | test')
+    parser.add_argument('--out', type=str, required=True, help='output directory of the store')
+    parser.add_argument('--shard_size', type=int, default=4096, help='number of crops per shard')
+    parser.add_argument('--workers', type=int, default=8, help='number of crop workers')
+    opt = parser.parse_args()
+
+    from dataloader import loader
+    if opt.dataset == 'nyu':
+        data = loader.nyu_loader(opt.dataset_path, opt.phase)
+    elif opt.dataset == 'dexycb':
+        data = loader.DexYCBDataset(opt.protocal, opt.phase, opt.dataset_path)
+    else:
+        raise NotImplementedError()
+    prepare_crop_store(data, opt.out, shard_size=opt.shard_size, workers=opt.workers)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Packed uint16 depth frame archive.
+
+Reading one small png per sample is dominated by open/seek/metadata costs on
+network or spinning storage.  ``pack_depth_archive`` writes the raw depth frames
+of a split into one contiguous file and ``DepthArchive`` maps it back with
+``np.memmap``, so a whole split can sit in the page cache.
+
+Layout of an archive directory:
+
+    meta.json      num_frames, compression
+    depth.bin      frames back to back, raw uint16 or one compressed blob per frame
+    index.npy      [N, 4] int64, (byte offset, byte length, height, width)
+
+Frame ``i`` of the archive is the depth image of sample ``i`` of the dataset it
+was packed from.  The frames hold the raw sensor code, each dataset decodes it
+the same way it decodes its image files.
+"""
+import os
+import json
+import argparse
+import os.path as osp
+import numpy as np
+from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader
+
+META_NAME = 'meta.json'
+DATA_NAME = 'depth.bin'
+INDEX_NAME = 'index.npy'
+COMPRESSIONS = (None, 'lz4', 'zstd')
+
+
+def _codec(compression):
+    """
+    :return: (compress, decompress) functions of a per-frame codec
+    """
+    if compression is None:
+        return None, None
+    if compression == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('lz4 compressed depth archives need the lz4 package: pip install lz4')
+        return lz4.frame.compress, lz4.frame.decompress
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compressed depth archives need the zstandard package: pip install zstandard')
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError('unknown depth archive compression: %s' % compression)
+
+
+def _no_convert(sample):
+    return sample
+
+
+class _RawFrames(Dataset):
+    # thin wrapper so the frames can be read (and compressed) by DataLoader workers
+    def __init__(self, dataset, compression):
+        self.dataset = dataset
+        self.compression = compression
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        depth = np.ascontiguousarray(self.dataset.raw_depth(index), dtype=np.uint16)
+        buf = depth.tobytes()
+        compress, _ = _codec(self.compression)
+        if compress is not None:
+            buf = compress(buf)
+        return index, buf, depth.shape
+
+
+def pack_depth_archive(dataset, out_dir, compression=None, workers=8):
+    """
+    Write the raw depth frames of a split into one contiguous archive
+    :param dataset: dataset implementing raw_depth(index) -> uint16 [H, W]
+    :param out_dir: output directory
+    :param compression: None, 'lz4' or 'zstd', applied per frame
+    :param workers: number of worker processes used to read the frames
+    """
+    assert compression in COMPRESSIONS, 'compression must be one of %s' % str(COMPRESSIONS)
+    _codec(compression)
+    if not osp.exists(out_dir):
+        os.makedirs(out_dir)
+    num_frames = len(dataset)
+    index = np.zeros([num_frames, 4], dtype=np.int64)
+
+    # frames are appended in index order, so the file can be streamed sequentially
+    frames = DataLoader(_RawFrames(dataset, compression), batch_size=None, shuffle=False,
+                        num_workers=workers, collate_fn=_no_convert)
+    offset = 0
+    with open(osp.join(out_dir, DATA_NAME), 'wb') as f:
+        for i, buf, shape in tqdm(frames, ncols=50):
+            f.write(buf)
+            index[i] = (offset, len(buf), shape[0], shape[1])
+            offset += len(buf)
+
+    np.save(osp.join(out_dir, INDEX_NAME), index)
+    with open(osp.join(out_dir, META_NAME), 'w') as f:
+        json.dump({'num_frames': num_frames, 'compression': compression}, f)
+
+
+class DepthArchive(object):
+    """
+    Read-only view of an archive written by pack_depth_archive.
+    The data file is memory-mapped lazily so every DataLoader worker opens its own map.
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(osp.join(root, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.compression = self.meta['compression']
+        self.index = np.load(osp.join(root, INDEX_NAME))
+        _, self.decompress = _codec(self.compression)
+        self.data = None
+
+    def __len__(self):
+        return self.meta['num_frames']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        state['decompress'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _, self.decompress = _codec(self.compression)
+
+    def _open(self):
+        self.data = np.memmap(osp.join(self.root, DATA_NAME), dtype=np.uint8, mode='r')
+
+    def __getitem__(self, index):
+        """
+        :return: uint16 depth frame [H, W] (writable copy)
+        """
+        if self.data is None:
+            self._open()
+        offset, nbytes, h, w = self.index[index]
+        buf = self.data[offset:offset + nbytes]
+        if self.decompress is not None:
+            buf = self.decompress(buf.tobytes())
+            return np.frombuffer(buf, dtype=np.uint16).reshape(h, w).copy()
+        return buf.view(np.uint16).reshape(h, w).copy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='dexycb', help='dataset name: nyu, dexycb, ho3d')
+    parser.add_argument('--dataset_path', type=str, default='../dataset', help='dataset path')
+    parser.add_argument('--protocal', type=str, default='s0', help='evaluation setting')
+    parser.add_argument('--phase', type=str, default='train', help='train | test (ho3d: train_all | test)')
+    parser.add_argument('--out', type=str, required=True, help='output directory of the archive')
+    parser.add_argument('--compression', type=str, default='', help='per-frame compression: lz4 | zstd')
+    parser.add_argument('--workers', type=int, default=8, help='number of reader workers')
+    opt = parser.parse_args()
+
+    from dataloader import loader
+    if opt.dataset == 'nyu':
+        data = loader.nyu_loader(opt.dataset_path, opt.phase)
+    elif opt.dataset == 'dexycb':
+        data = loader.DexYCBDataset(opt.protocal, opt.phase, opt.dataset_path)
+    elif opt.dataset == 'ho3d':
+        from dataloader import ho3d_loader
+        data = ho3d_loader.HO3D(opt.phase, opt.dataset_path, dataset_version='v2', center_type='joint_mean')
+    else:
+        raise NotImplementedError()
+    pack_depth_archive(data, opt.out, compression=opt.compression or None, workers=opt.workers)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+DataLoader factory and device prefetcher.
+
+``make_dataloader`` builds a DataLoader with pinned memory, persistent workers
+and a configurable prefetch depth.  ``DevicePrefetcher`` wraps it and copies
+batch i+1 to the GPU on a side CUDA stream while batch i is being used, so the
+host-to-device transfer is hidden behind compute.  On CPU it is a plain iterator.
+"""
+import torch
+from torch.utils.data import DataLoader
+
+
+def make_dataloader(dataset, batch_size, shuffle, workers, pin_memory=True, persistent_workers=True,
+                    prefetch_factor=2, collate_fn=None, drop_last=False):
+    """
+    :param pin_memory: page-locked batches, needed for asynchronous copies (ignored without CUDA)
+    :param persistent_workers: keep the workers alive between epochs
+    :param prefetch_factor: batches loaded in advance by each worker
+    """
+    kwargs = {}
+    if workers > 0:
+        kwargs['persistent_workers'] = persistent_workers
+        kwargs['prefetch_factor'] = prefetch_factor
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=workers,
+                      pin_memory=pin_memory and torch.cuda.is_available(), collate_fn=collate_fn,
+                      drop_last=drop_last, **kwargs)
+
+
+def to_device(batch, device, non_blocking=False):
+    """
+    Move the tensors of a (nested) batch to device
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(b, device, non_blocking) for b in batch)
+    if isinstance(batch, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in batch.items()}
+    if hasattr(batch, 'to'):
+        return batch.to(device, non_blocking=non_blocking)
+    return batch
+
+
+def _record_stream(batch, stream):
+    # the tensors were allocated on the side stream but are used on the compute stream
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for b in batch:
+            _record_stream(b, stream)
+    elif isinstance(batch, dict):
+        for b in batch.values():
+            _record_stream(b, stream)
+    elif hasattr(batch, 'record_stream'):
+        batch.record_stream(stream)
+
+
+class DevicePrefetcher(object):
+    """
+    Iterate a DataLoader with the batches already on device.
+    With CUDA the copy of the next batch runs on a side stream and overlaps with the
+    work on the current one; otherwise the batches are moved synchronously.
+    """
+    def __init__(self, loader, device='cuda'):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda' or not torch.cuda.is_available():
+            for batch in self.loader:
+                yield to_device(batch, self.device)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        loader = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(loader)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return to_device(batch, self.device, non_blocking=True)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = next_batch
+            _record_stream(batch, current)
+            next_batch = preload()
+            yield batch
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Device-resident camera geometry.
+
+The tensor helpers of the loaders (``uvd_nl2xyznl_tensor`` & co.) invert the
+crop transforms with ``torch.linalg.inv`` (and, in one place, on the CPU), repeat
+the per-sample matrices once per point and rebuild pixel grids on every call.
+This module keeps everything on the device of its inputs, without host syncs:
+
+    * ``inverse_3x3``: closed-form (adjugate) batched 3x3 inverse;
+    * ``pixel_grid`` / ``uv_grid``: coordinate grids cached by (H, W, device, dtype);
+    * ``uvd_nl_to_xyz`` / ``xyz_nl_to_uvd_nl``: conversions between normalized
+      crop coordinates and camera space, broadcasting the per-sample [B, 3] /
+      [B, 3, 3] parameters over the points instead of repeating them.
+"""
+import torch
+
+_GRID_CACHE = {}
+
+
+def pixel_grid(H, W, device, dtype=torch.float32):
+    """
+    Cached pixel coordinates
+    :return: ys, xs [H, W]
+    """
+    key = (H, W, torch.device(device), dtype)
+    if key not in _GRID_CACHE:
+        _GRID_CACHE[key] = torch.meshgrid(torch.arange(H, dtype=dtype, device=device),
+                                          torch.arange(W, dtype=dtype, device=device), indexing='ij')
+    return _GRID_CACHE[key]
+
+
+def uv_grid(H, W, device, dtype=torch.float32):
+    """
+    Cached normalized coordinates of the pixel centers
+    :return: [2, H, W] (u, v) in [-1, 1], u along the width
+    """
+    key = ('uv', H, W, torch.device(device), dtype)
+    if key not in _GRID_CACHE:
+        ys, xs = pixel_grid(H, W, device, dtype)
+        _GRID_CACHE[key] = torch.stack((2.0 * (xs + 0.5) / W - 1.0, 2.0 * (ys + 0.5) / H - 1.0), dim=0)
+    return _GRID_CACHE[key]
+
+
+def inverse_3x3(M):
+    """
+    Closed-form inverse of a batch of 3x3 matrices, no pivoting and no singularity check
+    :param M: [..., 3, 3]
+    """
+    a, b, c = M[..., 0, 0], M[..., 0, 1], M[..., 0, 2]
+    d, e, f = M[..., 1, 0], M[..., 1, 1], M[..., 1, 2]
+    g, h, i = M[..., 2, 0], M[..., 2, 1], M[..., 2, 2]
+    # cofactors
+    A = e * i - f * h
+    B = f * g - d * i
+    C = d * h - e * g
+    det = a * A + b * B + c * C
+    adj = torch.stack((A, c * h - b * i, b * f - c * e,
+                       B, a * i - c * g, c * d - a * f,
+                       C, b * g - a * h, a * e - b * d), dim=-1)
+    return (adj / det.unsqueeze(-1)).view(M.shape)
+
+
+def transform_points(points, M):
+    """
+    Apply the affine crop transform to the (u, v) of points, d is unchanged (loader.get_trans_points)
+    :param points: [B, N, 3]
+    :param M: [B, 3, 3]
+    """
+    uv = torch.matmul(points[..., 0:2], M[:, 0:2, 0:2].transpose(1, 2)) + M[:, 0:2, 2].unsqueeze(1)
+    return torch.cat((uv, points[..., 2:]), dim=-1)
+
+
+def joint_img_to_3d(uvd, paras, flip=1):
+    """
+    :param uvd: [B, ..., 3] image coordinates
+    :param paras: [B, 4] (fx, fy, fu, fv)
+    """
+    shape = (-1,) + (1,) * (uvd.dim() - 2)
+    fx, fy, fu, fv = [p.view(shape) for p in paras.unbind(-1)]
+    x = (uvd[..., 0] - fu) * uvd[..., 2] / fx
+    y = flip * (uvd[..., 1] - fv) * uvd[..., 2] / fy
+    return torch.stack((x, y, uvd[..., 2]), dim=-1)
+
+
+def joint_3d_to_img(xyz, paras, flip=1):
+    """
+    :param xyz: [B, ..., 3] camera coordinates
+    :param paras: [B, 4] (fx, fy, fu, fv)
+    """
+    shape = (-1,) + (1,) * (xyz.dim() - 2)
+    fx, fy, fu, fv = [p.view(shape) for p in paras.unbind(-1)]
+    u = xyz[..., 0] * fx / xyz[..., 2] + fu
+    v = flip * xyz[..., 1] * fy / xyz[..., 2] + fv
+    return torch.stack((u, v, xyz[..., 2]), dim=-1)
+
+
+def uvd_nl_to_xyz(uvd, center, M, cube, paras, img_size, flip=1, normalize=True):
+    """
+    Normalized crop coordinates to camera space (loader.uvd_nl2xyz_tensor / uvd_nl2xyznl_tensor)
+    :param uvd: [B, N, 3], uv in [-1, 1] of the crop, d normalized by the cube
+    :param center: [B, 3] crop center in camera space
+    :param M: [B, 3, 3] crop transform
+    :param cube: [B, 3] cube size in mm
+    :param paras: [B, 4] (fx, fy, fu, fv)
+    :param normalize: return the points relative to center and normalized by the cube
+    """
+    device, dtype = uvd.device, uvd.dtype
+    B = uvd.size(0)
+    center = center.to(device, dtype).view(B, 1, 3)
+    half_cube = cube.to(device, dtype).view(B, 1, 3) / 2.0
+    M_inverse = inverse_3x3(M.to(device, dtype).view(B, 3, 3))
+
+    uv = (uvd[:, :, 0:2] + 1) * (img_size / 2)
+    d = uvd[:, :, 2:] * half_cube[:, :, 2:] + center[:, :, 2:]
+    uvd_world = transform_points(torch.cat((uv, d), dim=-1), M_inverse)
+    xyz = joint_img_to_3d(uvd_world, paras.to(device, dtype), flip)
+    if normalize:
+        xyz = (xyz - center) / half_cube
+    return xyz
+
+
+def xyz_nl_to_uvd_nl(xyz, center, M, cube, paras, img_size, flip=1):
+    """
+    Inverse of uvd_nl_to_xyz with normalize=True (loader.xyz_nl2uvdnl_tensor)
+    """
+    device, dtype = xyz.device, xyz.dtype
+    B = xyz.size(0)
+    center = center.to(device, dtype).view(B, 1, 3)
+    half_cube = cube.to(device, dtype).view(B, 1, 3) / 2.0
+
+    uvd = joint_3d_to_img(xyz * half_cube + center, paras.to(device, dtype), flip)
+    uvd = transform_points(uvd, M.to(device, dtype).view(B, 3, 3))
+    uv = uvd[:, :, 0:2] / img_size * 2.0 - 1
+    d = (uvd[:, :, 2:] - center[:, :, 2:]) / half_cube[:, :, 2:]
+    return torch.cat((uv, d), dim=-1)
@@ -7,9 +7,12 @@ import random
 import numpy as np
 import os.path as osp
 # from util import vis_tool
-from pycocotools.coco import COCO
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
+from dataloader.depth_archive import DepthArchive
+from dataloader.annot_index import AnnotIndex
+from dataloader import window_search
+from dataloader import geometry
 HO3D2MANO = [0,
              1, 2, 3,
              4, 5, 6,
@@ -495,50 +498,13 @@ class loader(Dataset):
         return joint
 
     def uvd_nl2xyz_tensor(self, uvd, center, m, cube, cam_paras):
-        batch_size, point_num, _ = uvd.size()
-        device = uvd.device
-        cube_size_t = cube.to(device).view(batch_size, 1, 3).repeat(1, point_num, 1)
-        center_t = center.to(device).view(batch_size, 1, 3).repeat(1, point_num, 1)
-        M_t = m.to(device).view(batch_size, 1, 3, 3)
-        M_inverse = torch.linalg.inv(M_t).repeat(1, point_num, 1, 1)
-
-        uv_unnormal = (uvd[:, :, 0:2] + 1) * (self.img_size / 2)
-        d_unnormal = (uvd[:, :, 2:]) * (cube_size_t[:, :, 2:] / 2.0) + center_t[:, :, 2:]
-        uvd_unnormal = torch.cat((uv_unnormal, d_unnormal), dim=-1)
-        uvd_world = self.get_trans_points(uvd_unnormal, M_inverse)
-        xyz = self.pointsImgTo3D(uvd_world, cam_paras)
-        return xyz
+        return geometry.uvd_nl_to_xyz(uvd, center, m, cube, cam_paras, self.img_size, self.flip, normalize=False)
 
     def uvd_nl2xyznl_tensor(self, uvd, center, m, cube, cam_paras):
-        batch_size, point_num, _ = uvd.size()
-        device = uvd.device
-        cube_size_t = cube.to(device).view(batch_size, 1, 3).repeat(1, point_num, 1)
-        center_t = center.to(device).view(batch_size, 1, 3).repeat(1, point_num, 1)
-        M_t = m.to(device).view(batch_size, 1, 3, 3)
-        M_inverse = torch.linalg.inv(M_t).repeat(1, point_num, 1, 1)
-
-        uv_unnormal= (uvd[:, :, 0:2] + 1) * (self.img_size / 2)
-        d_unnormal = (uvd[:, :, 2:]) * (cube_size_t[:, :, 2:] / 2.0) + center_t[:, :, 2:]
-        uvd_unnormal = torch.cat((uv_unnormal, d_unnormal), dim=-1)
-        uvd_world = self.get_trans_points(uvd_unnormal, M_inverse)
-        xyz = self.pointsImgTo3D(uvd_world, cam_paras)
-        xyz_noraml = (xyz - center_t) / (cube_size_t / 2.0)
-        return xyz_noraml
+        return geometry.uvd_nl_to_xyz(uvd, center, m, cube, cam_paras, self.img_size, self.flip)
 
     def xyz_nl2uvdnl_tensor(self, joint_xyz, center, M, cube_size, cam_paras):
-        device = joint_xyz.device
-        batch_size, joint_num, _ = joint_xyz.size()
-        cube_size_t = cube_size.to(device).view(batch_size, 1, 3).repeat(1, joint_num, 1)
-        center_t = center.to(device).view(batch_size, 1, 3).repeat(1, joint_num, 1)
-        M_t = M.to(device).view(batch_size, 1, 3, 3).repeat(1, joint_num, 1, 1)
-
-        joint_temp = joint_xyz * cube_size_t / 2.0 + center_t
-        joint_uvd = self.points3DToImg(joint_temp, cam_paras)
-        joint_uvd = self.get_trans_points(joint_uvd, M_t)
-        joint_uv = joint_uvd[:, :, 0:2] / self.img_size * 2.0 - 1
-        joint_d = (joint_uvd[:, :, 2:] - center_t[:, :, 2:]) / (cube_size_t[:, :, 2:] / 2)
-        joint = torch.cat((joint_uv, joint_d), dim=-1)
-        return joint
+        return geometry.xyz_nl_to_uvd_nl(joint_xyz, center, M, cube_size, cam_paras, self.img_size, self.flip)
 
     def get_trans_points(self, joints, M):
         device = joints.device
@@ -582,11 +548,12 @@ class loader(Dataset):
         return np.column_stack((row, col, depth))
 
 
-    def img2pcl_index(self, pcl, img, center, M, cube, cam_para, select_num=9):
+    def img2pcl_index(self, pcl, img, center, M, cube, cam_para, select_num=9, window=None):
         '''
         :param pcl: BxNx3 Tensor
         :param img: Bx1xWxH Tensor
         :param feature: BxCxWxH Tensor
+        :param window: only score the window x window pixels around the projection of each point, see dataloader/window_search.py
         :return: select_feature: BxCxN
         '''
 
@@ -594,16 +561,18 @@ class loader(Dataset):
         B, N, _ = pcl.size()
         B, _, W, H = img.size()
 
-        mesh_x = 2.0 * (torch.arange(W).unsqueeze(1).expand(W, W).float() + 0.5) / W - 1.0
-        mesh_y = 2.0 * (torch.arange(W).unsqueeze(0).expand(W, W).float() + 0.5) / W - 1.0
-        coords = torch.stack((mesh_y, mesh_x), dim=0)
-        coords = torch.unsqueeze(coords, dim=0).repeat(B, 1, 1, 1).to(device)
-        img_uvd = torch.cat((coords, img), dim=1).view(B, 3, H*W).permute(0, 2, 1)
+        coords = window_search.pixel_uv(W, H, device).unsqueeze(0).expand(B, H*W, 2)
+        img_uvd = torch.cat((coords, img.view(B, H*W, 1)), dim=-1)
         img_xyz = self.uvd_nl2xyznl_tensor(img_uvd, center, M, cube, cam_para)
 
-        # distance = torch.sqrt(torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1) + 1e-8)
-        distance = torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1)
-        distance_value, distance_index = torch.topk(distance, select_num, largest=False)
+        if window is not None:
+            pcl_uv = self.xyz_nl2uvdnl_tensor(pcl, center, M, cube, cam_para)[:, :, 0:2]
+            index, off = window_search.window_index(pcl_uv, W, H, window)
+            distance_value, distance_index = window_search.window_knn(pcl, img_xyz, index, select_num, off)
+        else:
+            # distance = torch.sqrt(torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1) + 1e-8)
+            distance = torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1)
+            distance_value, distance_index = torch.topk(distance, select_num, largest=False)
         # version 1
         closeness_value = 1 / (distance_value + 1e-8)
         closeness_value_normal = closeness_value / (closeness_value.sum(-1, keepdim=True) + 1e-8)
@@ -617,7 +586,8 @@ class loader(Dataset):
 
 
 class HO3D(loader):
-    def __init__(self, data_split, root_dir, dataset_version='v3', img_size=128, center_type='refine', aug_para=[10, 0.2, 180], cube_size=[280, 280, 280]):
+    def __init__(self, data_split, root_dir, dataset_version='v3', img_size=128, center_type='refine', aug_para=[10, 0.2, 180], cube_size=[280, 280, 280],
+                 depth_archive=None, annot_index=None):
         super(HO3D, self).__init__(root_dir, data_split, img_size, center_type, 'HO3D')
 
         self.data_split = data_split
@@ -632,10 +602,21 @@ class HO3D(loader):
         if center_type == 'refine':
             self.center_xyz = np.loadtxt(self.root_dir+'/annotations/%s_refine_center_xyz.txt'%(data_split))
         self.dataset_len = 0
-        self.datalist = self.load_data()
+        if annot_index is not None:
+            # compiled annotations, see dataloader/annot_index.py
+            self.datalist = AnnotIndex(annot_index)
+            self.dataset_len = len(self.datalist)
+        else:
+            self.datalist = self.load_data()
         print('Dataset len:' + str(self.dataset_len))
+        # packed depth frames, see dataloader/depth_archive.py
+        self.depth_archive = None
+        if depth_archive is not None:
+            self.depth_archive = DepthArchive(depth_archive)
+            assert len(self.depth_archive) == len(self), 'depth archive does not match the dataset'
 
     def load_data(self):
+        from pycocotools.coco import COCO
         db = COCO(osp.join(self.annot_path, "HO3D_{}_data.json".format(self.data_split)))
         datalist = []
         for aid in db.anns.keys():
@@ -680,10 +661,21 @@ class HO3D(loader):
         return self.dataset_len
 
     def __getitem__(self, idx):
-        data = copy.deepcopy(self.datalist[idx])
+        return self.get_sample(idx, self.datalist[idx])
+
+    def get_sample(self, idx, data, depth=None):
+        """
+        :param data: annotation record of sample idx
+        :param depth: raw depth code of the frame, read from the dataset if None (see dataloader/tar_shards.py)
+        """
         img_path, img_shape = data['img_path'], data['img_shape']
 
-        depth = self.read_depth_img(img_path.replace('rgb', 'depth'))
+        if depth is not None:
+            depth = self.decode_depth_img(depth)
+        elif self.depth_archive is not None:
+            depth = self.decode_depth_img(self.depth_archive[idx])
+        else:
+            depth = self.read_depth_img(img_path.replace('rgb', 'depth'))
 
         intrinsics = data['cam_param']
         cam_para = (intrinsics['focal'][0], intrinsics['focal'][1], intrinsics['princpt'][0], intrinsics['princpt'][1])
@@ -840,12 +832,22 @@ class HO3D(loader):
 
     def read_depth_img(self, depth_filename):
         """Read the depth image in dataset and decode it"""
-        depth_scale = 0.00012498664727900177
+        return self.decode_depth_img(self.read_depth_raw(depth_filename))
+
+    def read_depth_raw(self, depth_filename):
+        """Read the raw uint16 depth code of an image in dataset"""
         depth_img = cv2.imread(depth_filename)
-        dpt = depth_img[:, :, 2] + depth_img[:, :, 1] * 256
+        return depth_img[:, :, 2].astype(np.uint16) + depth_img[:, :, 1].astype(np.uint16) * 256
+
+    def decode_depth_img(self, dpt):
+        """Decode the raw depth code to mm"""
+        depth_scale = 0.00012498664727900177
         dpt = dpt * depth_scale * 1000
         return dpt
 
+    def raw_depth(self, idx):
+        return self.read_depth_raw(self.datalist[idx]['img_path'].replace('rgb', 'depth'))
+
     def read_seg_img(self, filename):
         """Read the depth image in dataset and decode it"""
         seg_img = cv2.imread(filename)
@@ -5,26 +5,24 @@ import cv2
 import yaml
 import torch
 import numpy as np
-import open3d as o3d
-import numpy as np
-from PIL import Image, ImageEnhance, ImageFilter
 import os.path as osp
 import copy
-# from pycocotools.coco import COCO
-from pycocotools.coco import COCO
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
 import sys
 import math
-import scipy.io as sio
 import random
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 sys.path.append('..')
 # from util import vis_tool
-from scipy import stats, ndimage
+# open3d, matplotlib, sklearn, pycocotools and scipy are imported where they are used,
+# so DataLoader workers and eval processes do not pay for them at startup
 import torch.nn.functional as F
+from dataloader.crop_store import CropStore
+from dataloader.depth_archive import DepthArchive
+from dataloader.annot_index import AnnotIndex
+from dataloader import batch_augment
+from dataloader import window_search
+from dataloader import geometry
 joint_select =  np.array([0, 3, 6, 9, 12, 15, 18, 21, 24, 25, 27, 30, 31, 32])
 # joint_select =  np.array([0, 1, 3, 5,
 #                          6, 7, 9, 11,
@@ -91,6 +89,7 @@ def calculateCoM(dpt, minDepth, maxDepth):
     dc = dpt.copy()
     dc[dc < minDepth] = 0
     dc[dc > maxDepth] = 0
+    from scipy import ndimage
     cc = ndimage.measurements.center_of_mass(dc > 0)
     num = np.count_nonzero(dc)
     com = np.array((cc[1] * num, cc[0] * num, dc.sum()), np.float64)
@@ -180,14 +179,16 @@ def transformPoints2D(pts, M):
     return ret
 
 
-def nyu_reader(img_path):
+def nyu_raw_reader(img_path):
     img = cv2.imread(img_path)
-    depth = np.asarray(img[:, :, 0] + img[:, :, 1] * 256, dtype=np.float32)
-    return depth
+    return img[:, :, 0].astype(np.uint16) + img[:, :, 1].astype(np.uint16) * 256
 
 
+def nyu_reader(img_path):
+    depth = np.asarray(nyu_raw_reader(img_path), dtype=np.float32)
+    return depth
+
 
-from sklearn.decomposition import PCA
 
 
 class loader(Dataset):
@@ -199,8 +200,30 @@ class loader(Dataset):
         self.img_size = img_size
         self.center_type = center_type
         self.allJoints = False
-        self.pca = PCA(n_components=3)
+        self.pca = None
         self.sample_num = 1024
+        self.depth_archive = None
+
+    def open_depth_archive(self, root):
+        """
+        Read depth frames from a packed archive instead of one image file per sample,
+        see dataloader/depth_archive.py
+        """
+        self.depth_archive = DepthArchive(root)
+        assert len(self.depth_archive) == len(self), 'depth archive does not match the dataset'
+
+    def raw_crop(self, depth_crop, gt3Dcrop, com, cube, M, cam_para):
+        """
+        Un-augmented training sample, augmented after collation by dataloader/batch_augment.py
+        :return: crop [1, H, W], gt3Dcrop, com (u, v, d), cube, M, cam_para
+        """
+        crop = torch.from_numpy(np.asarray(depth_crop, dtype=np.float32)).unsqueeze(0)
+        gt3Dcrop = torch.from_numpy(np.asarray(gt3Dcrop, dtype=np.float32))
+        com = torch.from_numpy(np.asarray(com, dtype=np.float64))
+        cube = torch.from_numpy(np.asarray(cube, dtype=np.float64))
+        M = torch.from_numpy(np.asarray(M, dtype=np.float64))
+        cam_para = torch.from_numpy(np.asarray(cam_para, dtype=np.float64))
+        return crop, gt3Dcrop, com, cube, M, cam_para
 
     # numpy
     def jointImgTo3D(self, uvd, paras=None, flip=None):
@@ -644,51 +667,13 @@ class loader(Dataset):
         return joint
 
     def uvd_nl2xyz_tensor(self, uvd, center, m, cube, cam_paras):
-        batch_size, point_num, _ = uvd.size()
-        device = uvd.device
-        cube_size_t = cube.to(device).view(batch_size, 1, 3).repeat(1, point_num, 1)
-        center_t = center.to(device).view(batch_size, 1, 3).repeat(1, point_num, 1)
-        M_t = m.to(device).view(batch_size, 1, 3, 3)
-        M_inverse = torch.linalg.inv(M_t).repeat(1, point_num, 1, 1)
-
-        uv_unnormal = (uvd[:, :, 0:2] + 1) * (self.img_size / 2)
-        d_unnormal = (uvd[:, :, 2:]) * (cube_size_t[:, :, 2:] / 2.0) + center_t[:, :, 2:]
-        uvd_unnormal = torch.cat((uv_unnormal, d_unnormal), dim=-1)
-        uvd_world = self.get_trans_points(uvd_unnormal, M_inverse)
-        xyz = self.pointsImgTo3D(uvd_world, cam_paras)
-        return xyz
+        return geometry.uvd_nl_to_xyz(uvd, center, m, cube, cam_paras, self.img_size, self.flip, normalize=False)
 
     def uvd_nl2xyznl_tensor(self, uvd, center, m, cube, cam_paras):
-        batch_size, point_num, _ = uvd.size()
-        device = uvd.device
-        cube_size_t = cube.to(device).view(batch_size, 1, 3).repeat(1, point_num, 1)
-        center_t = center.to(device).view(batch_size, 1, 3).repeat(1, point_num, 1)
-        M_t = m.to(device).view(batch_size, 1, 3, 3)
-        # M_inverse = torch.linalg.inv(M_t).repeat(1, point_num, 1, 1)
-        M_inverse = torch.linalg.inv(M_t.cpu()).cuda().repeat(1, point_num, 1, 1)
-
-        uv_unnormal= (uvd[:, :, 0:2] + 1) * (self.img_size / 2)
-        d_unnormal = (uvd[:, :, 2:]) * (cube_size_t[:, :, 2:] / 2.0) + center_t[:, :, 2:]
-        uvd_unnormal = torch.cat((uv_unnormal, d_unnormal), dim=-1)
-        uvd_world = self.get_trans_points(uvd_unnormal, M_inverse)
-        xyz = self.pointsImgTo3D(uvd_world, cam_paras)
-        xyz_noraml = (xyz - center_t) / (cube_size_t / 2.0)
-        return xyz_noraml
+        return geometry.uvd_nl_to_xyz(uvd, center, m, cube, cam_paras, self.img_size, self.flip)
 
     def xyz_nl2uvdnl_tensor(self, joint_xyz, center, M, cube_size, cam_paras):
-        device = joint_xyz.device
-        batch_size, joint_num, _ = joint_xyz.size()
-        cube_size_t = cube_size.to(device).view(batch_size, 1, 3).repeat(1, joint_num, 1)
-        center_t = center.to(device).view(batch_size, 1, 3).repeat(1, joint_num, 1)
-        M_t = M.to(device).view(batch_size, 1, 3, 3).repeat(1, joint_num, 1, 1)
-
-        joint_temp = joint_xyz * cube_size_t / 2.0 + center_t
-        joint_uvd = self.points3DToImg(joint_temp, cam_paras)
-        joint_uvd = self.get_trans_points(joint_uvd, M_t)
-        joint_uv = joint_uvd[:, :, 0:2] / self.img_size * 2.0 - 1
-        joint_d = (joint_uvd[:, :, 2:] - center_t[:, :, 2:]) / (cube_size_t[:, :, 2:] / 2)
-        joint = torch.cat((joint_uv, joint_d), dim=-1)
-        return joint
+        return geometry.xyz_nl_to_uvd_nl(joint_xyz, center, M, cube_size, cam_paras, self.img_size, self.flip)
 
     def get_trans_points(self, joints, M):
         device = joints.device
@@ -750,6 +735,9 @@ class loader(Dataset):
         return np.column_stack((row, col, depth))
 
     def pca_point(self, pcl, joint):
+        if self.pca is None:
+            from sklearn.decomposition import PCA
+            self.pca = PCA(n_components=3)
         self.pca.fit(pcl)
         coeff = self.pca.components_.T
         # if coeff[1, 0] < 0:
@@ -761,11 +749,12 @@ class loader(Dataset):
         joint_rotation = np.dot(joint, coeff)
         return points_rotation, joint_rotation, coeff
 
-    def img2pcl_index_softmax(self, pcl, img, center, M, cube, cam_para, select_num=64, scale=30):
+    def img2pcl_index_softmax(self, pcl, img, center, M, cube, cam_para, select_num=64, scale=30, window=None):
         '''
         :param pcl: BxNx3 Tensor
         :param img: Bx1xWxH Tensor
         :param feature: BxCxWxH Tensor
+        :param window: see img2pcl_index
         :return: select_feature: BxCxN
         '''
 
@@ -773,15 +762,17 @@ class loader(Dataset):
         B, N, _ = pcl.size()
         B, _, W, H = img.size()
 
-        mesh_x = 2.0 * (torch.arange(W).unsqueeze(1).expand(W, W).float() + 0.5) / W - 1.0
-        mesh_y = 2.0 * (torch.arange(W).unsqueeze(0).expand(W, W).float() + 0.5) / W - 1.0
-        coords = torch.stack((mesh_y, mesh_x), dim=0)
-        coords = torch.unsqueeze(coords, dim=0).repeat(B, 1, 1, 1).to(device)
-        img_uvd = torch.cat((coords, img), dim=1).view(B, 3, H*W).permute(0, 2, 1)
+        coords = window_search.pixel_uv(W, H, device).unsqueeze(0).expand(B, H*W, 2)
+        img_uvd = torch.cat((coords, img.view(B, H*W, 1)), dim=-1)
         img_xyz = self.uvd_nl2xyznl_tensor(img_uvd, center, M, cube, cam_para)
 
-        distance = torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1)
-        distance_value, distance_index = torch.topk(distance, select_num, largest=False)
+        if window is not None:
+            pcl_uv = self.xyz_nl2uvdnl_tensor(pcl, center, M, cube, cam_para)[:, :, 0:2]
+            index, off = window_search.window_index(pcl_uv, W, H, window)
+            distance_value, distance_index = window_search.window_knn(pcl, img_xyz, index, select_num, off)
+        else:
+            distance = torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1)
+            distance_value, distance_index = torch.topk(distance, select_num, largest=False)
 
         distance_value = torch.sqrt(distance_value + 1e-8)
         distance_value = distance_value - distance_value.min(dim=-1, keepdim=True)[0]
@@ -790,11 +781,12 @@ class loader(Dataset):
         closeness_value_normal = torch.softmax(closeness_value*scale, dim=-1)
         return closeness_value_normal, distance_index
 
-    def img2pcl_index(self, pcl, img, center, M, cube, cam_para, select_num=9):
+    def img2pcl_index(self, pcl, img, center, M, cube, cam_para, select_num=9, window=None):
         '''
         :param pcl: BxNx3 Tensor
         :param img: Bx1xWxH Tensor
         :param feature: BxCxWxH Tensor
+        :param window: only score the window x window pixels around the projection of each point, see dataloader/window_search.py
         :return: select_feature: BxCxN
         '''
 
@@ -802,16 +794,18 @@ class loader(Dataset):
         B, N, _ = pcl.size()
         B, _, W, H = img.size()
 
-        mesh_x = 2.0 * (torch.arange(W).unsqueeze(1).expand(W, W).float() + 0.5) / W - 1.0
-        mesh_y = 2.0 * (torch.arange(W).unsqueeze(0).expand(W, W).float() + 0.5) / W - 1.0
-        coords = torch.stack((mesh_y, mesh_x), dim=0)
-        coords = torch.unsqueeze(coords, dim=0).repeat(B, 1, 1, 1).to(device)
-        img_uvd = torch.cat((coords, img), dim=1).view(B, 3, H*W).permute(0, 2, 1)
+        coords = window_search.pixel_uv(W, H, device).unsqueeze(0).expand(B, H*W, 2)
+        img_uvd = torch.cat((coords, img.view(B, H*W, 1)), dim=-1)
         img_xyz = self.uvd_nl2xyznl_tensor(img_uvd, center, M, cube, cam_para)
 
-        # distance = torch.sqrt(torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1) + 1e-8)
-        distance = torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1)
-        distance_value, distance_index = torch.topk(distance, select_num, largest=False)
+        if window is not None:
+            pcl_uv = self.xyz_nl2uvdnl_tensor(pcl, center, M, cube, cam_para)[:, :, 0:2]
+            index, off = window_search.window_index(pcl_uv, W, H, window)
+            distance_value, distance_index = window_search.window_knn(pcl, img_xyz, index, select_num, off)
+        else:
+            # distance = torch.sqrt(torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1) + 1e-8)
+            distance = torch.sum(torch.pow(pcl.unsqueeze(2) - img_xyz.unsqueeze(1), 2), dim=-1)
+            distance_value, distance_index = torch.topk(distance, select_num, largest=False)
         # version 1
         closeness_value = 1 / (distance_value + 1e-8)
         closeness_value_normal = closeness_value / (closeness_value.sum(-1, keepdim=True) + 1e-8)
@@ -823,26 +817,31 @@ class loader(Dataset):
         # closeness_value_normal = torch.softmax(closeness_value*30, dim=-1)
         return closeness_value_normal, distance_index, img_xyz
 
-    def pcl2img_index(self, pcl, img_size, center, M, cube, cam_para, select_num=9):
+    def pcl2img_index(self, pcl, img_size, center, M, cube, cam_para, select_num=9, window=None):
         '''
         :param pcl: BxNx3 Tensor
         :param img: Bx1xWxH Tensor
         :param feature: BxCxWxH Tensor
+        :param window: only score the window x window pixels around the projection of each point,
+                       exact as long as the select_num nearest pixels fit in the window
         :return: select_feature: BxCxN
         '''
 
         device = pcl.device
         B, N, _ = pcl.size()
 
-        pcl_uvd = (self.xyz_nl2uvdnl_tensor(pcl, center, M, cube, cam_para)[:, :, :2] + 1) / 2 * img_size
-        mesh_x = (torch.arange(img_size).unsqueeze(1).expand(img_size, img_size).float() + 0.5)
-        mesh_y = (torch.arange(img_size).unsqueeze(0).expand(img_size, img_size).float() + 0.5)
-        coords = torch.stack((mesh_y, mesh_x), dim=0)
-        coords = torch.unsqueeze(coords, dim=0).repeat(B, 1, 1, 1).to(device)
-        coords = coords.view(B, 2, img_size*img_size).permute(0,2,1)
+        pcl_uv = self.xyz_nl2uvdnl_tensor(pcl, center, M, cube, cam_para)[:, :, :2]
+        pcl_uvd = (pcl_uv + 1) / 2 * img_size
+        coords = (window_search.pixel_uv(img_size, img_size, device) + 1) / 2 * img_size
+        coords = coords.unsqueeze(0).expand(B, img_size*img_size, 2)
 
-        distance = torch.sqrt(torch.sum(torch.pow(pcl_uvd.unsqueeze(2) - coords.unsqueeze(1), 2), dim=-1) + 1e-8)
-        distance_value, distance_index = torch.topk(distance, select_num, largest=False)
+        if window is not None:
+            index, off = window_search.window_index(pcl_uv, img_size, img_size, window)
+            distance_value, distance_index = window_search.window_knn(pcl_uvd, coords, index, select_num, off)
+            distance_value = torch.sqrt(distance_value + 1e-8)
+        else:
+            distance = torch.sqrt(torch.sum(torch.pow(pcl_uvd.unsqueeze(2) - coords.unsqueeze(1), 2), dim=-1) + 1e-8)
+            distance_value, distance_index = torch.topk(distance, select_num, largest=False)
         closeness_value = 1 / (distance_value + 1e-8)
         closeness_value_normal = closeness_value / (closeness_value.sum(-1, keepdim=True) + 1e-8)
         return closeness_value_normal, distance_index
@@ -889,25 +888,7 @@ class loader(Dataset):
         return heatmap.gt(0).sum(-1).sum(-1).gt(10)
 
     def mask_img(self, img, img_joint_uvd, mask_offset, mask_para, min_mask_num=3, max_mask_num=10):
-        device = img.device
-        S = img.size(-1)
-        mask_num = np.random.choice(np.arange(min_mask_num, max_mask_num), 1, replace=False)[0]
-        b, j, _ = img_joint_uvd.size()
-        joint_id = np.random.choice(np.arange(0, j), mask_num, replace=False)
-        mask_uvd = img_joint_uvd[:, joint_id, :]
-        uvd_offset = (torch.rand(mask_uvd.size()) - 0.5) * mask_offset * 2
-        mask_uvd = mask_uvd + uvd_offset.to(device)
-        mask_range = torch.rand([b, mask_num]).to(device) * mask_para
-        xx, yy = np.meshgrid(np.arange(S), np.arange(S))
-        xx = 2 * (xx + 0.5) / S - 1.0
-        yy = 2 * (yy + 0.5) / S - 1.0
-        mesh = np.stack((xx, yy), axis=-1).reshape([1, -1, 2])
-        mesh = torch.from_numpy(mesh).float().to(device).view(1, -1, 2).repeat(b, 1, 1)
-        mesh = torch.cat((mesh, img.view(b, -1, 1)), dim=-1).view(b, 1, -1, 3)
-        dis = torch.sqrt(torch.sum((mesh - mask_uvd.view(b, mask_num, 1, 3)) ** 2, dim=-1))
-        mask = dis.lt(mask_range.view([b, mask_num, 1])).float()
-        mask = ~mask.sum(1).gt(0)
-        return torch.where(mask.view(b, 1, img.size(-2), img.size(-1)), img, torch.ones_like(img).to(device))
+        return batch_augment.mask_img(img, img_joint_uvd, mask_offset, mask_para, min_mask_num, max_mask_num)
 
     def read_modelPara(self, data_rt, view):
         theta = np.loadtxt(data_rt+'/posePara_lm_collosion/'+self.dataset_name+'-'+self.phase+'-'+str(view)+'-pose.txt').reshape(-1, 45)
@@ -922,6 +903,7 @@ class loader(Dataset):
 
 
 def visualize_point_cloud(pcl_sample):
+    import open3d as o3d
     # 将点云数据转换为 Open3D 的 PointCloud 格式
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(pcl_sample)
@@ -931,7 +913,8 @@ def visualize_point_cloud(pcl_sample):
 
 class nyu_loader(loader):
     def __init__(self, root_dir, phase, aug_para=[10, 0.1, 180], img_size=128,
-                 cube_size=[250, 250, 250], center_type='refine', joint_num=23, loader=nyu_reader):
+                 cube_size=[250, 250, 250], center_type='refine', joint_num=23, loader=nyu_reader, crop_store=None,
+                 depth_archive=None, device_augment=False, annot_index=None):
         super(nyu_loader, self).__init__(root_dir, phase, img_size, center_type, 'nyu')
         self.paras = (588.03, 587.07, 320., 240.)
         self.cube_size = np.array(cube_size)
@@ -947,11 +930,18 @@ class nyu_loader(loader):
         data_path = '{}/{}'.format(self.root_dir, self.phase)
         label_path = '{}/joint_data.mat'.format(data_path)
         print('loading data...')
-        self.labels = sio.loadmat(label_path)
+        if annot_index is not None:
+            # compiled annotations, see dataloader/annot_index.py
+            annot = AnnotIndex(annot_index)
+            joint_uvd, joint_xyz = annot.column('joint_uvd'), annot.column('joint_xyz')
+        else:
+            import scipy.io as sio
+            self.labels = sio.loadmat(label_path)
+            joint_uvd, joint_xyz = self.labels['joint_uvd'][0], self.labels['joint_xyz'][0]
         self.data_path = data_path
             
-        self.all_joints_uvd = self.labels['joint_uvd'][0][:, joint_select, :][:, calculate, :]
-        self.all_joints_xyz = self.labels['joint_xyz'][0][:, joint_select, :][:, calculate, :]
+        self.all_joints_uvd = joint_uvd[:, joint_select, :][:, calculate, :]
+        self.all_joints_xyz = joint_xyz[:, joint_select, :][:, calculate, :]
         self.all_joints_xyz = self.jointImgTo3D(self.joint3DToImg(self.all_joints_xyz, flip=-1))
 
         print('finish!!')
@@ -981,28 +971,58 @@ class nyu_loader(loader):
                                      0.25, 0.25, 0.25, 0.35,
                                      0.4, 0.4, 0.4])*1.1
 
-    def __getitem__(self, index):
+        # preprocessed crops, see dataloader/crop_store.py
+        self.crop_store = None
+        if crop_store is not None:
+            self.crop_store = CropStore(crop_store)
+            assert len(self.crop_store) == len(self), 'crop store does not match the dataset'
+        if depth_archive is not None:
+            self.open_depth_archive(depth_archive)
+        # return the raw crop in training, see dataloader/batch_augment.py
+        self.device_augment = device_augment
+
+    def raw_depth(self, index):
         img_path = self.data_path + '/depth_1_{:07d}.png'.format(index + 1)
-        if not os.path.exists(img_path):
-            print(img_path)
-        depth = self.loader(img_path)
-        joint_xyz = self.all_joints_xyz[index].copy()
-        # model_para = np.loadtxt('{}/para/para_{}_1.txt'.format(self.root_dir, index))
-        # mesh_xyz = np.loadtxt('{}/mesh/mesh_{}_1.txt'.format(self.root_dir, index)).reshape([778, 3])
+        return nyu_raw_reader(img_path)
 
+    def crop_sample(self, index):
+        """
+        Deterministic part of __getitem__: read the depth frame and crop the hand
+        :return: depth crop, transform, crop centre (u, v, d), cube, camera parameters
+        """
+        if self.depth_archive is not None:
+            depth = self.depth_archive[index].astype(np.float32)
+        else:
+            img_path = self.data_path + '/depth_1_{:07d}.png'.format(index + 1)
+            if not os.path.exists(img_path):
+                print(img_path)
+            depth = self.loader(img_path)
         if self.phase == 'test':
             cube_size = self.test_cubesize[index]
         else:
             cube_size = self.cube_size
+        center_uvd = self.joint3DToImg(self.center_xyz[index])
+        depth_crop, trans = self.Crop_Image_deep_pp(depth, center_uvd, cube_size, (self.img_size,self.img_size), self.paras)
+        return depth_crop, trans, center_uvd, np.asarray(cube_size, dtype=np.float64), self.paras
+
+    def __getitem__(self, index):
+        joint_xyz = self.all_joints_xyz[index].copy()
+        # model_para = np.loadtxt('{}/para/para_{}_1.txt'.format(self.root_dir, index))
+        # mesh_xyz = np.loadtxt('{}/mesh/mesh_{}_1.txt'.format(self.root_dir, index)).reshape([778, 3])
 
+        if self.crop_store is not None:
+            depth_crop, trans, center_uvd, cube_size, _ = self.crop_store[index]
+        else:
+            depth_crop, trans, center_uvd, cube_size, _ = self.crop_sample(index)
         center_xyz = self.center_xyz[index]
-        center_uvd = self.joint3DToImg(center_xyz)
 
         gt3Dcrop = joint_xyz - center_xyz.reshape(1,3)
-        depth_crop, trans = self.Crop_Image_deep_pp(depth, center_uvd, cube_size, (self.img_size,self.img_size), self.paras)
         # save_path = 'path_to_save_depth_crop.png'
         # cv2.imwrite(save_path, depth_crop)
 
+        if self.phase == 'train' and self.device_augment:
+            return self.raw_crop(depth_crop, gt3Dcrop, center_uvd, self.cube_size, trans, self.paras)
+
         if self.phase == 'train':
             mode, off, rot, sc = self.rand_augment(sigma_com=self.aug_para[0], sigma_sc=self.aug_para[1], rot_range=self.aug_para[2])
             imgD,imgD_unnorm, curLabel,  cube, com2D, M, _ = self.augmentCrop(depth_crop, gt3Dcrop, center_uvd, self.cube_size,
@@ -1101,7 +1121,8 @@ class nyu_loader(loader):
 
 
 class DexYCBDataset(loader):
-  def __init__(self, setup, split, root_dir, img_size=128, aug_para=[10, 0.2, 180]):
+  def __init__(self, setup, split, root_dir, img_size=128, aug_para=[10, 0.2, 180], crop_store=None, depth_archive=None,
+               device_augment=False, annot_index=None):
     super(DexYCBDataset, self).__init__(root_dir, split, img_size, 'joint_mean', 'DexYCB')
 
     self.setup = setup
@@ -1113,11 +1134,26 @@ class DexYCBDataset(loader):
 
     self.root_dir = root_dir + '/DexYCB'
     self.annot_path = osp.join(self.root_dir, 'annotations')
-    self.datalist = self.load_data()
+    if annot_index is not None:
+        # compiled annotations, see dataloader/annot_index.py
+        self.datalist = AnnotIndex(annot_index)
+    else:
+        self.datalist = self.load_data()
     print('loading finish')
     print('len: %d' % (len(self.datalist)))
 
+    # preprocessed crops, see dataloader/crop_store.py
+    self.crop_store = None
+    if crop_store is not None:
+        self.crop_store = CropStore(crop_store)
+        assert len(self.crop_store) == len(self), 'crop store does not match the dataset'
+    if depth_archive is not None:
+        self.open_depth_archive(depth_archive)
+    # return the raw crop in training, see dataloader/batch_augment.py
+    self.device_augment = device_augment
+
   def load_data(self):
+      from pycocotools.coco import COCO
       db = COCO(osp.join(self.annot_path, "DEX_YCB_{}_{}_data.json".format(self.setup, self.split)))
       user_name = self.root_dir.split('/')[2]
       datalist = []
@@ -1163,38 +1199,76 @@ class DexYCBDataset(loader):
   def __len__(self):
     return len(self.datalist)
 
-  def __getitem__(self, idx):
-    # idx = idx + 11088
-    data = copy.deepcopy(self.datalist[idx])
-    img_path, img_shape = data['img_path'], data['img_shape']
-    hand_type = data['hand_type']
-    do_flip = (hand_type == 'left')
-    depth = cv2.imread(img_path.replace('color_', 'aligned_depth_to_color_').replace('jpg', 'png'), cv2.IMREAD_ANYDEPTH)
+  def hand_frame(self, data):
+    """
+    Joints and crop centre of an annotation record, left hands are mirrored
+    :return: camera parameters, flip flag, joints (xyz), crop centre (xyz), crop centre (uvd)
+    """
+    img_shape = data['img_shape']
+    do_flip = (data['hand_type'] == 'left')
     intrinsics = data['cam_param']
     cam_para = (intrinsics['focal'][0], intrinsics['focal'][1], intrinsics['princpt'][0], intrinsics['princpt'][1])
     joint_xyz = data['joints_coord_cam'].reshape([21, 3])[DexYCB2MANO, :]
     joint_uvd = self.joint3DToImg(joint_xyz, cam_para)
+    if do_flip:
+        joint_uvd[:, 0] = img_shape[1] - joint_uvd[:, 0] - 1
+        # mesh_uvd[:, 0] = img_shape[1] - mesh_uvd[:, 0] - 1
+    joint_xyz = self.jointImgTo3D(joint_uvd, cam_para)
+    center_xyz = joint_xyz.mean(0)
+    center_uvd = self.joint3DToImg(center_xyz, cam_para)
+    return cam_para, do_flip, joint_xyz, center_xyz, center_uvd
 
-    name_list = img_path.split('/')
-    dir_1, dir_2, dir_3, dir_4 = name_list[-4], name_list[-3], name_list[-2], name_list[-1]
-    dir_4 = dir_4.replace('color', 'mesh').replace('jpg', 'txt')
+  def raw_depth(self, idx):
+    img_path = self.datalist[idx]['img_path']
+    return cv2.imread(img_path.replace('color_', 'aligned_depth_to_color_').replace('jpg', 'png'), cv2.IMREAD_ANYDEPTH)
+
+  def crop_sample(self, idx):
+    """
+    Deterministic part of __getitem__: read the depth frame and crop the hand
+    :return: depth crop, transform, crop centre (u, v, d), cube, camera parameters
+    """
+    if self.depth_archive is not None:
+        depth = self.depth_archive[idx]
+    else:
+        depth = self.raw_depth(idx)
+    return self.crop_depth(self.datalist[idx], depth)
+
+  def crop_depth(self, data, depth):
+    """
+    crop_sample for an annotation record and its raw depth frame
+    """
+    cam_para, do_flip, _, _, center_uvd = self.hand_frame(data)
+    if do_flip:
+        depth = depth[:, ::-1].copy()
+    depth_crop, trans = self.Crop_Image_deep_pp(depth, center_uvd, self.cube_size, (self.img_size, self.img_size), cam_para)
+    return depth_crop, trans, center_uvd, np.asarray(self.cube_size, dtype=np.float64), cam_para
+
+  def __getitem__(self, idx):
+    # idx = idx + 11088
+    return self.get_sample(idx, self.datalist[idx])
+
+  def get_sample(self, idx, data, depth=None):
+    """
+    :param data: annotation record of sample idx
+    :param depth: raw depth frame, read from the crop store / dataset if None (see dataloader/tar_shards.py)
+    """
     # mesh_path = self.root_dir + '/mesh/%s/%s/%s/' % (dir_1, dir_2, dir_3)
     # mesh_xyz = np.loadtxt(mesh_path+dir_4)
     # mesh_xyz[:, 1] *= -1
     # mesh_xyz[:, 2] *= -1
     # mesh_uvd = self.joint3DToImg(mesh_xyz, cam_para)
 
-
-    if do_flip:
-        depth = depth[:, ::-1].copy()
-        joint_uvd[:, 0] = img_shape[1] - joint_uvd[:, 0] - 1
-        # mesh_uvd[:, 0] = img_shape[1] - mesh_uvd[:, 0] - 1
-
-    joint_xyz = self.jointImgTo3D(joint_uvd, cam_para)
-    center_xyz = joint_xyz.mean(0)
+    cam_para, _, joint_xyz, center_xyz, center_uvd = self.hand_frame(data)
     gt3Dcrop = joint_xyz - center_xyz
-    center_uvd = self.joint3DToImg(center_xyz, cam_para)
-    depth_crop, trans = self.Crop_Image_deep_pp(depth, center_uvd, self.cube_size, (self.img_size, self.img_size), cam_para)
+    if depth is not None:
+        depth_crop, trans = self.crop_depth(data, depth)[:2]
+    elif self.crop_store is not None:
+        depth_crop, trans = self.crop_store[idx][:2]
+    else:
+        depth_crop, trans = self.crop_sample(idx)[:2]
+
+    if self.phase == 'train' and self.device_augment:
+        return self.raw_crop(depth_crop, gt3Dcrop, center_uvd, self.cube_size, trans, cam_para)
 
     if self.phase == 'train':
         mode, off, rot, sc = self.rand_augment(sigma_com=self.aug_para[0], sigma_sc=self.aug_para[1],rot_range=self.aug_para[2])  # 10, 0.1, 180
@@ -1271,7 +1345,8 @@ class DexYCBDataset(loader):
 
 
 class HO3D(loader):
-    def __init__(self, data_split, root_dir, dataset_version='v3', img_size=128, center_type='refine', aug_para=[10, 0.2, 180], cube_size=[280, 280, 280]):
+    def __init__(self, data_split, root_dir, dataset_version='v3', img_size=128, center_type='refine', aug_para=[10, 0.2, 180], cube_size=[280, 280, 280],
+                 depth_archive=None, annot_index=None):
         super(HO3D, self).__init__(root_dir, data_split, img_size, center_type, 'HO3D')
 
         self.data_split = data_split
@@ -1286,10 +1361,18 @@ class HO3D(loader):
         if center_type == 'refine':
             self.center_xyz = np.loadtxt(self.root_dir+'/annotations/%s_refine_center_xyz.txt'%(data_split))
         self.dataset_len = 0
-        self.datalist = self.load_data()
+        if annot_index is not None:
+            # compiled annotations, see dataloader/annot_index.py
+            self.datalist = AnnotIndex(annot_index)
+            self.dataset_len = len(self.datalist)
+        else:
+            self.datalist = self.load_data()
         print('Dataset len:' + str(self.dataset_len))
+        if depth_archive is not None:
+            self.open_depth_archive(depth_archive)
 
     def load_data(self):
+        from pycocotools.coco import COCO
         db = COCO(osp.join(self.annot_path, "HO3D_{}_data.json".format(self.data_split)))
         datalist = []
         for aid in db.anns.keys():
@@ -1336,10 +1419,21 @@ class HO3D(loader):
 
     def __getitem__(self, idx):
         # idx = idx + 8460
-        data = copy.deepcopy(self.datalist[idx])
+        return self.get_sample(idx, self.datalist[idx])
+
+    def get_sample(self, idx, data, depth=None):
+        """
+        :param data: annotation record of sample idx
+        :param depth: raw depth code of the frame, read from the dataset if None (see dataloader/tar_shards.py)
+        """
         img_path, img_shape = data['img_path'], data['img_shape']
 
-        depth = self.read_depth_img(img_path.replace('rgb', 'depth'))
+        if depth is not None:
+            depth = self.decode_depth_img(depth)
+        elif self.depth_archive is not None:
+            depth = self.decode_depth_img(self.depth_archive[idx])
+        else:
+            depth = self.read_depth_img(img_path.replace('rgb', 'depth'))
         # seg = self.read_seg_img(img_path.replace('rgb', 'seg'))
 
         intrinsics = data['cam_param']
@@ -1509,12 +1603,22 @@ class HO3D(loader):
 
     def read_depth_img(self, depth_filename):
         """Read the depth image in dataset and decode it"""
-        depth_scale = 0.00012498664727900177
+        return self.decode_depth_img(self.read_depth_raw(depth_filename))
+
+    def read_depth_raw(self, depth_filename):
+        """Read the raw uint16 depth code of an image in dataset"""
         depth_img = cv2.imread(depth_filename)
-        dpt = depth_img[:, :, 2] + depth_img[:, :, 1] * 256
+        return depth_img[:, :, 2].astype(np.uint16) + depth_img[:, :, 1].astype(np.uint16) * 256
+
+    def decode_depth_img(self, dpt):
+        """Decode the raw depth code to mm"""
+        depth_scale = 0.00012498664727900177
         dpt = dpt * depth_scale * 1000
         return dpt
 
+    def raw_depth(self, idx):
+        return self.read_depth_raw(self.datalist[idx]['img_path'].replace('rgb', 'depth'))
+
     def read_seg_img(self, filename):
         """Read the depth image in dataset and decode it"""
         seg_img = cv2.imread(filename)
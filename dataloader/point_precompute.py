@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Stage-one point indices computed in the DataLoader workers.
+
+The first stage of ``PointMambaEncoder`` runs a furthest point sampling over the
+input cloud and a density-aware ball query (``pointnet2_utils.QueryAndGroup``
+with ``lambda_param`` / ``k_dense``) around the sampled centroids.  Both only
+depend on the input points, so ``PointPrecompute`` computes them per sample on
+the CPU of the workers, overlapped with the training step, and appends them to
+the sample:
+
+    fps_order     [F]         FPS ordering of the input points, starting at point 0
+                              (the first S indices are the FPS of S points, see
+                              PCM_utils.prefix_fps_index)
+    group_idx     [S, k]      neighbours of the stage-one centroids
+    group_radius  [S]         adjusted radius of every centroid
+
+The stage-one centroids are all the points when the first stage does not
+downsample (reducer 1), else the sorted first S indices of fps_order.
+``PointMambaEncoder.forward_cls_feat`` uses the indices when they are given.
+The points must reach the model as they were given to the transform: not
+rounded to float16 by the packed collate (train_mdda.py keeps them float32).
+
+Density-aware ball query, per centroid i:
+
+    rho_i = 1 / mean distance to its k_dense nearest input points
+    r_i   = max(radius * (1 + lambda_param * (1 - rho_i / mean(rho))), min_radius)
+
+the neighbours are the first k input points (in index order) within r_i,
+padded with the first neighbour, or with point 0 when there is none.
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+from torch.utils.data import Dataset, IterableDataset
+
+
+def furthest_point_sample(xyz, npoint):
+    """
+    :param xyz: [N, 3]
+    :return: [npoint] indices, starting at point 0
+    """
+    x, y, z = [np.ascontiguousarray(c, dtype=np.float32) for c in np.asarray(xyz).T]
+    order = np.zeros(npoint, dtype=np.int64)
+    distance = np.full(x.shape[0], np.inf, dtype=np.float32)
+    d, t = np.empty_like(x), np.empty_like(x)
+    farthest = 0
+    for i in range(npoint):
+        order[i] = farthest
+        # in place, per coordinate: no [N, 3] temporaries in the loop
+        np.subtract(x, x[farthest], out=d)
+        np.multiply(d, d, out=d)
+        for c in (y, z):
+            np.subtract(c, c[farthest], out=t)
+            np.multiply(t, t, out=t)
+            d += t
+        np.minimum(distance, d, out=distance)
+        farthest = int(np.argmax(distance))
+    return order
+
+
+def density_radius(xyz, new_xyz, radius, lambda_param, k_dense, min_radius=1e-4, tree=None):
+    """
+    Adjusted ball radius of every centroid
+    :param xyz: [N, 3] input points
+    :param new_xyz: [S, 3] centroids
+    :return: [S]
+    """
+    if tree is None:
+        tree = cKDTree(xyz)
+    distance, _ = tree.query(new_xyz, k=k_dense)
+    density = 1.0 / (distance.reshape(new_xyz.shape[0], -1).mean(-1) + 1e-8)
+    adjusted = radius * (1 + lambda_param * (1 - density / density.mean()))
+    return np.maximum(adjusted, min_radius).astype(np.float32)
+
+
+def ball_query(xyz, new_xyz, radius, nsample, tree=None):
+    """
+    First nsample points (in index order) within radius of every centroid
+    :param xyz: [N, 3]
+    :param new_xyz: [S, 3]
+    :param radius: [S] per-centroid radius
+    :return: [S, nsample] indices, padded with the first neighbour (0 if none)
+    """
+    if tree is None:
+        tree = cKDTree(xyz)
+    idx = np.zeros((new_xyz.shape[0], nsample), dtype=np.int64)
+    for i, neighbours in enumerate(tree.query_ball_point(new_xyz, radius, return_sorted=True)):
+        if neighbours:
+            neighbours = neighbours[:nsample]
+            idx[i] = neighbours[0]
+            idx[i, :len(neighbours)] = neighbours
+    return idx
+
+
+class PointPrecompute(object):
+    """
+    Sample transform appending (fps_order, group_idx, group_radius) to a loader sample.
+    The defaults match the first stage of the encoder of network_mdda.HandModel with prefix_fps, use
+    PointPrecompute.from_encoder to take the settings of a given encoder.
+    :param fps_num: length of fps_order, the largest number of points sampled by the encoder
+    :param sample_ratio: reducer of the first stage
+    :param radius, nsample, lambda_param, k_dense: ball query of the first stage
+    :param pcl_index: position of the points [N, 3] in the sample
+    """
+    def __init__(self, fps_num=512, sample_ratio=1, radius=0.1, nsample=12, lambda_param=0.3, k_dense=24, pcl_index=1):
+        self.fps_num = fps_num
+        self.sample_ratio = sample_ratio
+        self.radius = radius
+        self.nsample = nsample
+        self.lambda_param = lambda_param
+        self.k_dense = k_dense
+        self.pcl_index = pcl_index
+
+    @classmethod
+    def from_encoder(cls, encoder, num_points, pcl_index=1):
+        """
+        The transform computing the indices of the first stage of encoder (PointMambaEncoder)
+        :param num_points: points per input cloud
+        """
+        grouper = encoder.local_grouper_list[0]
+        assert grouper.radius is not None, 'the first stage groups the k nearest neighbours, not a ball query'
+        # points of every stage, the same lengths as PointMambaEncoder.forward_cls_feat
+        num = [num_points]
+        for local_grouper in encoder.local_grouper_list:
+            num.append(num[-1] // local_grouper.sample_ratio)
+        if encoder.prefix_fps:
+            fps_num = max([n for n in num if n < num_points] or [0])
+        else:
+            fps_num = num[1] if num[1] < num_points else 0
+        return cls(fps_num=fps_num, sample_ratio=grouper.sample_ratio, radius=grouper.radius,
+                   nsample=grouper.kneighbors, lambda_param=grouper.lambda_param, k_dense=grouper.k_dense,
+                   pcl_index=pcl_index)
+
+    def compute(self, xyz):
+        """
+        :param xyz: [N, 3]
+        :return: fps_order [fps_num], group_idx [S, nsample], group_radius [S]
+        """
+        xyz = np.asarray(xyz, dtype=np.float32)
+        N = xyz.shape[0]
+        S = N // self.sample_ratio
+        fps_order = furthest_point_sample(xyz, max(self.fps_num, S if S < N else 0))
+        center_idx = np.arange(N) if S == N else np.sort(fps_order[:S])
+        new_xyz = xyz[center_idx]
+        tree = cKDTree(xyz)
+        group_radius = density_radius(xyz, new_xyz, self.radius, self.lambda_param, self.k_dense, tree=tree)
+        group_idx = ball_query(xyz, new_xyz, group_radius, self.nsample, tree=tree)
+        return fps_order, group_idx, group_radius
+
+    def __call__(self, sample):
+        xyz = sample[self.pcl_index]
+        if isinstance(xyz, torch.Tensor):
+            xyz = xyz.numpy()
+        fps_order, group_idx, group_radius = self.compute(xyz)
+        return tuple(sample) + (torch.from_numpy(fps_order), torch.from_numpy(group_idx), torch.from_numpy(group_radius))
+
+
+class TransformDataset(Dataset):
+    """
+    Apply transform to the samples of a map-style dataset, in the DataLoader workers
+    """
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.transform(self.dataset[index])
+
+
+class TransformStream(IterableDataset):
+    """
+    Apply transform to the samples of an iterable dataset (e.g. TarShardDataset), in the DataLoader workers
+    """
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        for sample in self.dataset:
+            yield self.transform(sample)
+
+
+def precompute_dataset(dataset, transform):
+    if isinstance(dataset, IterableDataset):
+        return TransformStream(dataset, transform)
+    return TransformDataset(dataset, transform)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_points', type=int, default=1024, help='points per cloud')
+    parser.add_argument('--iters', type=int, default=50, help='timed clouds')
+    opt = parser.parse_args()
+
+    transform = PointPrecompute()
+    rng = np.random.RandomState(0)
+    clouds = [rng.uniform(-1, 1, (opt.num_points, 3)).astype(np.float32) for _ in range(opt.iters)]
+    t = time.time()
+    for xyz in clouds:
+        transform.compute(xyz)
+    print('%.2f ms per cloud of %d points' % ((time.time() - t) * 1000 / opt.iters, opt.num_points))
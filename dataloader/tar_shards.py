@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Sequential tar shards and a streaming dataset.
+
+DexYCB and HO3D read one depth png per sample from a deep directory tree, which
+turns every sample into a few small random reads; on object stores and network
+filesystems this is far below the sustained sequential bandwidth.
+``write_tar_shards`` writes the samples of a split (raw depth frame + annotation
+record) back to back into tar files of a fixed number of samples and
+``TarShardDataset`` streams them, in the same way as the tar parser of
+``openpoints/dataset/parsers/parser_image_in_tar.py`` (streaming ``'r|'`` mode,
+naturally sorted shard names):
+
+    * the shards are split between the DataLoader workers, each worker only
+      reads its own shards, front to back;
+    * the shard order is reshuffled every epoch and samples go through a
+      bounded shuffle buffer, since an IterableDataset can not be shuffled by
+      the DataLoader.
+
+Layout of a shard directory:
+
+    meta.json                     num_samples, shards: [[name, num_samples], ...]
+    shard-00000.tar               per sample, consecutive members
+        00000042.depth.png        raw depth frame, lossless uint16 png
+        00000042.annot.pkl        {'index': 42, 'data': datalist record}
+
+The samples are decoded by the dataset they were written from, through
+``dataset.get_sample(index, data, depth)``, so the output is the same as
+indexing the dataset.
+"""
+import io
+import os
+import re
+import json
+import pickle
+import tarfile
+import argparse
+import os.path as osp
+import cv2
+import numpy as np
+from tqdm import tqdm
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
+
+META_NAME = 'meta.json'
+SHARD_NAME = 'shard-%05d.tar'
+
+
+def natural_key(string_):
+    """See http://www.codinghorror.com/blog/archives/001018.html"""
+    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', string_.lower())]
+
+
+def _no_convert(sample):
+    return sample
+
+
+class _ShardSamples(Dataset):
+    # thin wrapper so the frames can be read and encoded by DataLoader workers
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        depth = np.ascontiguousarray(self.dataset.raw_depth(index), dtype=np.uint16)
+        ok, depth = cv2.imencode('.png', depth)
+        assert ok, 'can not encode depth frame %d' % index
+        annot = pickle.dumps({'index': index, 'data': self.dataset.datalist[index]}, protocol=pickle.HIGHEST_PROTOCOL)
+        return index, depth.tobytes(), annot
+
+
+def _add_member(tf, name, buf):
+    ti = tarfile.TarInfo(name)
+    ti.size = len(buf)
+    tf.addfile(ti, io.BytesIO(buf))
+
+
+def write_tar_shards(dataset, out_dir, shard_size=1000, workers=8):
+    """
+    Write the samples of a split into sequential tar shards
+    :param dataset: DexYCBDataset / HO3D, implementing raw_depth(index) and datalist
+    :param out_dir: output directory
+    :param shard_size: samples per shard
+    :param workers: number of worker processes used to read the frames
+    """
+    if not osp.exists(out_dir):
+        os.makedirs(out_dir)
+    num_samples = len(dataset)
+    samples = DataLoader(_ShardSamples(dataset), batch_size=None, shuffle=False,
+                         num_workers=workers, collate_fn=_no_convert)
+    shards = []
+    tf = None
+    for index, depth, annot in tqdm(samples, ncols=50):
+        if index % shard_size == 0:
+            if tf is not None:
+                tf.close()
+            shards.append([SHARD_NAME % len(shards), 0])
+            tf = tarfile.open(osp.join(out_dir, shards[-1][0]), mode='w')
+        _add_member(tf, '%08d.depth.png' % index, depth)
+        _add_member(tf, '%08d.annot.pkl' % index, annot)
+        shards[-1][1] += 1
+    if tf is not None:
+        tf.close()
+
+    with open(osp.join(out_dir, META_NAME), 'w') as f:
+        json.dump({'num_samples': num_samples, 'shards': shards}, f)
+
+
+def iter_shard(filename):
+    """
+    Stream the samples of one shard
+    :return: generator of (index, datalist record, raw uint16 depth frame)
+    """
+    sample = {}
+    with tarfile.open(filename, mode='r|') as tf:  # streaming mode, no seeks
+        for ti in tf:
+            if not ti.isfile():
+                continue
+            key, ext = ti.name.split('.', 1)
+            if sample and sample['key'] != key:
+                sample = {}
+            sample['key'] = key
+            sample[ext] = tf.extractfile(ti).read()
+            if 'depth.png' in sample and 'annot.pkl' in sample:
+                annot = pickle.loads(sample['annot.pkl'])
+                depth = cv2.imdecode(np.frombuffer(sample['depth.png'], dtype=np.uint8), cv2.IMREAD_ANYDEPTH)
+                yield annot['index'], annot['data'], depth
+                sample = {}
+
+
+class TarShardDataset(IterableDataset):
+    """
+    Stream the shards written by write_tar_shards through the dataset they were written from.
+    :param dataset: DexYCBDataset / HO3D of the same split, used to decode, crop and augment the samples
+    :param root: shard directory
+    :param shuffle_buffer: size of the shuffle buffer, 0 keeps the stored order (and the shard order)
+    """
+    def __init__(self, dataset, root, shuffle_buffer=1000):
+        self.dataset = dataset
+        self.root = root
+        self.shuffle_buffer = shuffle_buffer
+        with open(osp.join(root, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.shards = sorted(self.meta['shards'], key=lambda s: natural_key(s[0]))
+        # iterations started by this copy of the dataset, persistent workers keep their seed across epochs
+        self.epoch = 0
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def worker_shards(self, rng):
+        """
+        Shards read by the current worker: the same permutation in every worker, split round robin
+        """
+        shards = [s[0] for s in self.shards]
+        if self.shuffle_buffer > 0:
+            shards = [shards[i] for i in rng.permutation(len(shards))]
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return shards
+        return shards[worker_info.id::worker_info.num_workers]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        self.epoch += 1
+        if worker_info is None:
+            shard_rng = sample_rng = np.random.RandomState(np.random.randint(2 ** 31))
+        else:
+            # worker seeds are base_seed + id: the shard permutation must be the same in all workers
+            shard_rng = np.random.RandomState([(worker_info.seed - worker_info.id) % 2 ** 32, self.epoch])
+            sample_rng = np.random.RandomState([worker_info.seed % 2 ** 32, self.epoch])
+
+        buffer = []
+        for name in self.worker_shards(shard_rng):
+            for sample in iter_shard(osp.join(self.root, name)):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                if self.shuffle_buffer > 0:
+                    i = sample_rng.randint(len(buffer))
+                    buffer[i], sample = sample, buffer[i]
+                yield self.dataset.get_sample(*sample)
+        sample_rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.dataset.get_sample(*sample)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='dexycb', help='dataset name: dexycb, ho3d')
+    parser.add_argument('--dataset_path', type=str, default='../dataset', help='dataset path')
+    parser.add_argument('--protocal', type=str, default='s0', help='evaluation setting')
+    parser.add_argument('--phase', type=str, default='train', help='train | test (ho3d: train_all | test)')
+    parser.add_argument('--out', type=str, required=True, help='output directory of the shards')
+    parser.add_argument('--shard_size', type=int, default=1000, help='samples per shard')
+    parser.add_argument('--workers', type=int, default=8, help='number of reader workers')
+    opt = parser.parse_args()
+
+    if opt.dataset == 'dexycb':
+        from dataloader import loader
+        data = loader.DexYCBDataset(opt.protocal, opt.phase, opt.dataset_path)
+    elif opt.dataset == 'ho3d':
+        from dataloader import ho3d_loader
+        data = ho3d_loader.HO3D(opt.phase, opt.dataset_path, dataset_version='v2', center_type='joint_mean')
+    else:
+        raise NotImplementedError()
+    write_tar_shards(data, opt.out, shard_size=opt.shard_size, workers=opt.workers)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Projection-window search between a point cloud and a depth / feature map.
+
+``img2pcl_index`` finds the pixels of the (downsampled) depth map closest to
+each point by scoring a dense B x N x (H*W) distance tensor.  The points are
+sampled from the same depth map, so their nearest pixels lie around their own
+projection: ``window_index`` projects the points to the map and lists the
+k x k pixels around each projection, ``window_knn`` scores only those, so the
+cost is O(N*k^2) instead of O(N*H*W).  Points projecting more than k // 2
+pixels off the map fall back to the dense search, for those points only.
+"""
+import torch
+from dataloader.geometry import uv_grid
+
+
+def pixel_uv(H, W, device, dtype=torch.float32):
+    """
+    Normalized coordinates of the pixel centers, in the order of img.view(B, -1)
+    :return: [H*W, 2] (u, v) in [-1, 1]
+    """
+    return uv_grid(H, W, device, dtype).view(2, H * W).t()
+
+
+def window_index(uv, H, W, window=5):
+    """
+    Pixels of the window x window neighbourhood around each projection
+    :param uv: [B, N, 2] normalized image coordinates in [-1, 1], u along the width
+    :return: index [B, N, window*window] flat pixel indices (row * W + col),
+             off [B, N] projections that are more than window // 2 pixels off the map (or not finite)
+    """
+    assert window <= min(H, W), 'window larger than the map'
+    r = window // 2
+    col = torch.floor((uv[..., 0] + 1) / 2 * W)
+    row = torch.floor((uv[..., 1] + 1) / 2 * H)
+    off = (col < -r) | (col > W - 1 + r) | (row < -r) | (row > H - 1 + r) | ~torch.isfinite(col + row)
+    # windows touching the border are moved inside, so every window has window*window distinct pixels
+    col = torch.nan_to_num(col).clamp(r, W - window + r).long()
+    row = torch.nan_to_num(row).clamp(r, H - window + r).long()
+    offset = torch.arange(-r, window - r, device=uv.device)
+    index = (row.unsqueeze(-1) + offset).unsqueeze(-1) * W + (col.unsqueeze(-1) + offset).unsqueeze(-2)
+    return index.flatten(-2), off
+
+
+def window_knn(query, ref, index, select_num, off=None):
+    """
+    The select_num nearest reference points of each query among its candidates
+    :param query: [B, N, C]
+    :param ref: [B, M, C]
+    :param index: [B, N, K] candidate indices into ref, K >= select_num
+    :param off: [B, N] queries searched over all of ref instead
+    :return: squared distance [B, N, select_num] (ascending), index [B, N, select_num]
+    """
+    B, N, K = index.size()
+    C = ref.size(-1)
+    cand = torch.gather(ref, 1, index.view(B, N * K, 1).expand(B, N * K, C)).view(B, N, K, C)
+    distance = torch.sum(torch.pow(query.unsqueeze(2) - cand, 2), dim=-1)
+    distance_value, arg = torch.topk(distance, select_num, dim=-1, largest=False)
+    distance_index = torch.gather(index, -1, arg)
+
+    if off is not None and off.any():
+        b, n = torch.nonzero(off, as_tuple=True)
+        distance = torch.sum(torch.pow(query[b, n].unsqueeze(1) - ref[b], 2), dim=-1)
+        value, arg = torch.topk(distance, select_num, dim=-1, largest=False)
+        distance_value = distance_value.index_put((b, n), value)
+        distance_index = distance_index.index_put((b, n), arg)
+    return distance_value, distance_index
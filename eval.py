@@ -6,7 +6,6 @@ import os
 import random
 import time
 from tqdm import tqdm
-import open3d as o3d
 import numpy as np
 import importlib
 
@@ -40,8 +39,11 @@ parser.add_argument('--test_path', type=str, default = '../dataset',  help='mode
 parser.add_argument('--protocal', type=str, default = 's0',  help='model name for training resume')
 
 parser.add_argument('--dataset', type=str, default = 'dexycb', help='optimizer name for training resume')
+parser.add_argument('--fusion_window', type=int, default = 0,  help='search the fused image pixels in a window around the projection of each point (network_mdda), 0 searches the whole map')
+parser.add_argument('--prefix_fps', action='store_true', help='share one FPS over the input across the encoder stages (network_mdda)')
 parser.add_argument('--model_name', type=str, default = 'handdagt',  help='')
 parser.add_argument('--gpu', type=str, default = '3',  help='gpu')
+parser.add_argument('--device', type=str, default = 'cuda',  help='cuda | cpu, cpu runs the PyTorch versions of the CUDA ops')
 
 opt = parser.parse_args()
 # print (opt)
@@ -54,6 +56,13 @@ opt.manualSeed = 1
 random.seed(opt.manualSeed)
 torch.manual_seed(opt.manualSeed)
 
+device = torch.device(opt.device)
+
+def synchronize():
+	# wait for the CUDA kernels before reading the timer
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+
 
 if opt.dataset == 'dexycb':
 	save_dir = os.path.join(opt.save_root_dir, opt.dataset+ '_'+opt.protocal +'_' + opt.model_name+'_'+str(opt.stacks)+'stacks')
@@ -80,7 +89,13 @@ print (opt)
 
 
 # 2. Define model, loss
-model = getattr(module, 'HandModel')(joints=opt.JOINT_NUM, stacks=opt.stacks)
+# the optional settings of network_mdda.HandModel, only given when used
+model_kwargs = {}
+if opt.fusion_window > 0:
+	model_kwargs['fusion_window'] = opt.fusion_window
+if opt.prefix_fps:
+	model_kwargs['prefix_fps'] = True
+model = getattr(module, 'HandModel')(joints=opt.JOINT_NUM, stacks=opt.stacks, **model_kwargs)
 
 if opt.ngpu > 1:
     model.netR_1 = torch.nn.DataParallel(model.netR_1, range(opt.ngpu))
@@ -88,9 +103,9 @@ if opt.ngpu > 1:
     model.netR_3 = torch.nn.DataParallel(model.netR_3, range(opt.ngpu))
 if opt.model != '':
 
-	model.load_state_dict(torch.load(os.path.join(opt.save_root_dir, opt.model)), strict=False)
+	model.load_state_dict(torch.load(os.path.join(opt.save_root_dir, opt.model), map_location=device), strict=False)
 		
-model.cuda()
+model.to(device)
 # print(model)
 
 parameters = model.parameters()
@@ -98,7 +113,7 @@ total_params = sum(p.numel() for p in model.parameters() if p.requires_grad) #ad
 print(f"Total number of parameters: {total_params}")
 
 
-criterion = nn.MSELoss(size_average=True).cuda()
+criterion = nn.MSELoss(size_average=True).to(device)
 
 # # 3. evaluation
 # torch.cuda.synchronize()
@@ -162,7 +177,7 @@ criterion = nn.MSELoss(size_average=True).cuda()
 
 
 # 3. evaluation
-torch.cuda.synchronize()
+synchronize()
 
 model.eval()
 test_mse = 0.0
@@ -183,25 +198,24 @@ saved_length = []
 start_time = time.time()
 
 for i, data in enumerate(tqdm(test_dataloader, 0)):
-    torch.cuda.synchronize()
+    synchronize()
     with torch.no_grad():
         # 3.2.1 load inputs and targets
         if opt.dataset == "nyu":
             img, points, gt_xyz, uvd_gt, center, M, cube, cam_para, volume_length = data
-            volume_length = volume_length.cuda()
+            volume_length = volume_length.to(device)
         else:
             img, points, gt_xyz, uvd_gt, center, M, cube, cam_para = data
             volume_length = 250.
 
-        points, gt_xyz, img = points.cuda(),  gt_xyz.cuda(), img.cuda()
-        center, M, cube, cam_para = center.cuda(), M.cuda(), cube.cuda(), cam_para.cuda()
+        points, gt_xyz, img = points.to(device),  gt_xyz.to(device), img.to(device)
+        center, M, cube, cam_para = center.to(device), M.to(device), cube.to(device), cam_para.to(device)
 
         t = time.time()
         estimation = model(points.transpose(1,2), points.transpose(1,2), img, test_data, center, M, cube, cam_para)
+        synchronize()
         timer += time.time() - t
 
-        torch.cuda.synchronize()
-
         outputs_xyz = estimation.transpose(1,2)
         diff = torch.pow(outputs_xyz-gt_xyz, 2).view(-1,opt.JOINT_NUM,3)
         diff_sum = torch.sum(diff,2)
@@ -214,7 +228,7 @@ for i, data in enumerate(tqdm(test_dataloader, 0)):
 
         total_samples += points.size(0)  # 假设每个batch的图像数是固定的
 
-torch.cuda.synchronize()
+synchronize()
 # timer = time.time() - timer
 timer = timer / total_samples
 print('==> time to learn 1 sample = %f (ms)' %(timer*1000))
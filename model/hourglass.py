@@ -2,6 +2,7 @@ from torch import nn
 import torch
 import torch.nn.functional as F
 import math
+from dataloader.geometry import uv_grid
 
 ReLU = nn.ReLU
 Pool = nn.MaxPool2d
@@ -15,21 +16,15 @@ def offset2joint_softmax(offset, depth, kernel_size, scale=30):
         depth = F.interpolate(depth, size=[feature_size, feature_size])
     offset_unit = offset[:, :joint_num * 3, :, :].contiguous()
     heatmap = offset[:, joint_num * 3:, :, :].contiguous()
-    mesh_x = 2.0 * (torch.arange(feature_size).unsqueeze(1).expand(feature_size,
-                                                                   feature_size).float() + 0.5) / feature_size - 1.0
-    mesh_y = 2.0 * (torch.arange(feature_size).unsqueeze(0).expand(feature_size,
-                                                                   feature_size).float() + 0.5) / feature_size - 1.0
-    coords = torch.stack((mesh_y, mesh_x), dim=0)
-    coords = torch.unsqueeze(coords, dim=0).repeat(batch_size, 1, 1, 1).to(device)
-    coords = torch.cat((coords, depth), dim=1).repeat(1, joint_num, 1, 1).view(batch_size, joint_num, 3, -1)
+    coords = uv_grid(feature_size, feature_size, device, depth.dtype).unsqueeze(0).expand(batch_size, 2, feature_size, feature_size)
+    coords = torch.cat((coords, depth), dim=1).view(batch_size, 1, 3, -1)
     mask = depth.lt(0.99).float().view(batch_size, 1, feature_size, feature_size)
     offset_mask = (offset_unit * mask).view(batch_size, joint_num, 3, -1)
     heatmap_mask = (heatmap * mask).view(batch_size, joint_num, -1)
     normal_heatmap = F.softmax(heatmap_mask * scale, dim=-1)
 
     dist = kernel_size - heatmap_mask * kernel_size
-    joint = torch.sum((offset_mask * dist.unsqueeze(2).repeat(1, 1, 3, 1) + coords) * normal_heatmap.unsqueeze(2).repeat(1, 1, 3, 1),
-        dim=-1)
+    joint = torch.sum((offset_mask * dist.unsqueeze(2) + coords) * normal_heatmap.unsqueeze(2), dim=-1)
     return joint
 
 
@@ -38,18 +33,10 @@ def joint2offset(joint, img, kernel_size, feature_size):
     batch_size, _, img_height, img_width = img.size()
     img = F.interpolate(img, size=[feature_size, feature_size])
     _, joint_num, _ = joint.view(batch_size, -1, 3).size()
-    joint_feature = joint.reshape(joint.size(0), -1, 1, 1).repeat(1, 1, feature_size, feature_size)
-    # mesh_x = 2.0 * torch.arange(feature_size).unsqueeze(1).expand(feature_size, feature_size).float() / (feature_size - 1.0) - 1.0
-    # mesh_y = 2.0 * torch.arange(feature_size).unsqueeze(0).expand(feature_size, feature_size).float() / (feature_size - 1.0) - 1.0
-    mesh_x = 2.0 * (torch.arange(feature_size).unsqueeze(1).expand(feature_size,
-                                                                   feature_size).float() + 0.5) / feature_size - 1.0
-    mesh_y = 2.0 * (torch.arange(feature_size).unsqueeze(0).expand(feature_size,
-                                                                   feature_size).float() + 0.5) / feature_size - 1.0
-    coords = torch.stack((mesh_y, mesh_x), dim=0)
-    coords = torch.unsqueeze(coords, dim=0).repeat(batch_size, 1, 1, 1).to(device)
-    coords = torch.cat((coords, img), dim=1).repeat(1, joint_num, 1, 1)
+    joint_feature = joint.reshape(batch_size, joint_num, 3, 1, 1)
+    coords = uv_grid(feature_size, feature_size, device, img.dtype).unsqueeze(0).expand(batch_size, 2, feature_size, feature_size)
+    coords = torch.cat((coords, img), dim=1).view(batch_size, 1, 3, feature_size, feature_size)
     offset = joint_feature - coords
-    offset = offset.view(batch_size, joint_num, 3, feature_size, feature_size)
     dist = torch.sqrt(torch.sum(torch.pow(offset, 2), dim=2) + 1e-8)
     offset_norm = (offset / (dist.unsqueeze(2)))
     heatmap = (kernel_size - dist) / kernel_size
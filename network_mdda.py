@@ -10,8 +10,12 @@ import numpy as np
 # from models import standard_transformer, PointCAT
 from openpoints.models import PointMambaEncoder
 from openpoints.models.PCM.PCM_utils import index_points
+from openpoints.models.PCM.knn import knn_query
 # from pointcat_part import PointCAT_part
-from pointnet2 import pointnet2_utils
+try:
+    from pointnet2 import pointnet2_utils
+except ImportError:
+    pointnet2_utils = None
 from pointutil import Conv1d, Conv2d, PointNetSetAbstraction, BiasConv1d, square_distance, index_points_group, \
     index_points_group_self
 import torch.nn.functional as F
@@ -73,12 +77,55 @@ weight_url_22k = {
 
 
 
+class NeighbourCache(object):
+    '''
+    kNN candidates of the joints in a fixed point cloud, shared by the refinement stacks of one forward.
+    Built once with the candidates around the initial joints j0, then a joint j only re-ranks its
+    candidates: a point outside them is at least bound - |j - j0| away from j, so the candidate kNN is
+    exact whenever its k-th distance is within that, and joints that moved further fall back to a full search.
+    xyz1: joints [B, N1, 3]
+    xyz2: points [B, N2, 3]
+    '''
+    def __init__(self, xyz1, xyz2, candidates=256):
+        xyz1 = xyz1.detach()
+        self.xyz1 = xyz1
+        self.xyz2 = xyz2.detach()
+        N2 = xyz2.size(1)
+        dists, self.idx = knn_query(min(candidates, N2), self.xyz2, xyz1, return_dist=True)
+        if candidates >= N2:
+            self.bound = torch.full_like(dists[..., 0], float('inf'))
+        else:
+            self.bound = torch.sqrt(dists.max(-1)[0])
+
+    def knn(self, xyz1, nsample):
+        '''
+        xyz1: joints [B, N1, 3]
+        return: knn_idx [B, N1, nsample], the same neighbours as topk(square_distance(xyz1, xyz2))
+        '''
+        xyz1 = xyz1.detach()
+        B, N1, R = self.idx.shape
+        cand = torch.gather(self.xyz2, 1, self.idx.view(B, N1 * R, 1).expand(B, N1 * R, 3)).view(B, N1, R, 3)
+        dists = torch.sum(torch.pow(cand - xyz1.unsqueeze(2), 2), dim=-1)
+        dists, arg = torch.topk(dists, nsample, dim=-1, largest=False, sorted=False)
+        knn_idx = torch.gather(self.idx, -1, arg)
+
+        shift = torch.norm(xyz1 - self.xyz1, dim=-1)
+        exact = torch.sqrt(dists.max(-1)[0]) <= self.bound - shift
+        if not bool(exact.all()):
+            b, n = torch.nonzero(~exact, as_tuple=True)
+            sqrdists = torch.sum(torch.pow(self.xyz2[b] - xyz1[b, n].unsqueeze(1), 2), dim=-1)
+            knn_idx = knn_idx.index_put((b, n), torch.topk(sqrdists, nsample, dim=-1, largest=False, sorted=False)[1])
+        return knn_idx
+
+
 class GAT_GCN(nn.Module):
     def __init__(self, nsample, in_channel, latent_channel, graph_width, mlp, mlp2=None, bn=False, use_leaky=True,
-                 return_inter=False, radius=None, relu=False, bypass_gcn=False, bias=True, graph_bias=True):
+                 return_inter=False, radius=None, relu=False, bypass_gcn=False, bias=True, graph_bias=True, chunk=None):
         super(GAT_GCN, self).__init__()
         self.radius = radius
         self.nsample = nsample
+        # joints processed at once, bounds the B x C x nsample x N1 intermediates (not with BN in training)
+        self.chunk = chunk
         self.return_inter = return_inter
         self.mlp_q_convs = nn.ModuleList()
         self.mlp_g_convs = nn.ModuleList()
@@ -95,7 +142,7 @@ class GAT_GCN(nn.Module):
 
         last_channel = in_channel + 3
 
-        self.graph_a = nn.Parameter(torch.randn(1, latent_channel, graph_width, graph_width).cuda(), requires_grad=True)
+        self.graph_a = nn.Parameter(torch.randn(1, latent_channel, graph_width, graph_width), requires_grad=True)
         self.graph_w = nn.Sequential(nn.Conv1d(latent_channel, latent_channel, 1, bias=graph_bias),
                                      nn.BatchNorm1d(latent_channel) if bn else nn.Identity(),
                                      nn.ReLU(inplace=True) if not use_leaky else nn.LeakyReLU(0.1, inplace=True))
@@ -134,66 +181,63 @@ class GAT_GCN(nn.Module):
         if radius is not None:
             self.queryandgroup = pointnet2_utils.QueryAndGroup(radius, nsample,True)
 
-    def forward(self, xyz1, xyz2, points1, points2):
+    def first_layer_weights(self):
+        # the q, k and v branches all start with a 1x1 conv of the grouped points
+        convs = [self.mlp_q_convs[0], self.mlp_k_convs[0], self.fuse_v1]
+        weight = torch.cat([conv.weight.flatten(1) for conv in convs], 0)
+        bias = torch.cat([conv.bias if conv.bias is not None else conv.weight.new_zeros(conv.out_channels)
+                          for conv in convs], 0)
+        return weight, bias, [conv.out_channels for conv in convs]
+
+    def group_first_layer(self, xyz1, xyz2, points2, knn_idx):
         '''
-        add fuse_v
-        xyz1: joints [B, 3, N1]   32,3,14
-        xyz2: local points [B, 3, N2]   32,3,512
-        points1: joints features [B, C, N1]  32,3,14
-        points2: local features [B, C, N2]   32,256,512
+        First layer of the q, k and v branches on cat([grouped points2, direction]) without building the
+        grouped tensor: the points2 slice of the weights is applied to the N2 points, then gathered
+        xyz1: joints [B, n, 3]
+        xyz2: local points [B, N2, 3]
+        points2: local features [B, D2, N2]
+        knn_idx: [B, n, nsample]
+        return: q, k, v [B, C, nsample, n]
         '''
-
-        B, C, N1 = xyz1.shape
-        _, _, N2 = xyz2.shape
-        _, D1, _ = points1.shape
-        _, D2, _ = points2.shape
-        xyz1 = xyz1.permute(0, 2, 1)
-        xyz2 = xyz2.permute(0, 2, 1)
-
-        if self.radius is None:
-            sqrdists = square_distance(xyz1, xyz2)
-            dists, knn_idx = torch.topk(sqrdists, self.nsample, dim=-1, largest=False, sorted=False)
-            # neighbor_xyz = index_points_group(xyz2, knn_idx)
-            neighbor_xyz = index_points(xyz2, knn_idx)
-            direction_xyz = neighbor_xyz - xyz1.view(B, N1, 1, C)
-
-            # grouped_points2 = index_points_group(points2.permute(0, 2, 1), knn_idx)  # B, N1, nsample, D2
-            grouped_points2 = index_points(points2.permute(0, 2, 1), knn_idx)  # B, N1, nsample, D2
-            new_points = torch.cat([grouped_points2, direction_xyz], dim=-1)  # B, N1, nsample, D1+D2+3
-            new_points = new_points.permute(0, 3, 2, 1)  # [B, D2+3, nsample, N1]
-        else:
-            new_points = self.queryandgroup(xyz2.contiguous(), xyz1.contiguous(), points2.contiguous())
-            new_points = new_points.permute(0, 1, 3, 2)
-
-        point1_graph = self.graph_w(torch.matmul(points1.unsqueeze(-2), self.graph_a).squeeze(-2))  # E‘=AEW
-
-        # q
-        q = new_points
+        B, n, S = knn_idx.shape
+        D2 = points2.size(1)
+        weight, bias, split = self.first_layer_weights()
+        index = knn_idx.transpose(1, 2).reshape(B, 1, S * n)
+        feat = torch.matmul(weight[:, :D2], points2)  # B, 3C, N2
+        out = torch.gather(feat, 2, index.expand(B, feat.size(1), S * n)).view(B, -1, S, n)
+        neighbor_xyz = torch.gather(xyz2, 1, index.view(B, S * n, 1).expand(B, S * n, 3)).view(B, S, n, 3)
+        direction_xyz = (neighbor_xyz - xyz1.unsqueeze(1)).permute(0, 3, 1, 2)  # B, 3, nsample, n
+        out = out + torch.einsum('oc,bcsn->bosn', weight[:, D2:], direction_xyz) + bias.view(1, -1, 1, 1)
+        return torch.split(out, split, 1)
+
+    def first_layer(self, new_points):
+        weight, bias, split = self.first_layer_weights()
+        out = F.conv2d(new_points, weight.view(weight.size(0), -1, 1, 1), bias)
+        return torch.split(out, split, 1)
+
+    def refine(self, q, k, v, points1, point1_graph):
+        '''
+        q, k, v: first layer outputs [B, C, nsample, n]
+        points1: joints features [B, D1, n]
+        point1_graph: [B, D1, n]
+        '''
+        # the joint terms are broadcast over the neighbours
+        q = q + self.fuse_q(point1_graph).unsqueeze(2)
         for i, conv in enumerate(self.mlp_q_convs):
-            q = conv(q)
-            if i == 0:
-                grouped_points1 = self.fuse_q(point1_graph)
-                q = q + grouped_points1.view(B, grouped_points1.size(1), 1, N1).repeat(1, 1, self.nsample, 1)
-                # q = q
+            if i > 0:
+                q = conv(q)
             if self.bn:
                 q = self.mlp_q_bns[i](q)
-            if i == len(self.mlp_q_convs) - 1:
-                q = q
-            else:
+            if i < len(self.mlp_q_convs) - 1:
                 q = self.relu(q)
 
-        k = new_points
+        k = k + self.fuse_k(point1_graph).unsqueeze(2)
         for i, conv in enumerate(self.mlp_k_convs):
-            k = conv(k)
-            if i == 0:
-                grouped_points1 = self.fuse_k(point1_graph)
-                k = k + grouped_points1.view(B, grouped_points1.size(1), 1, N1).repeat(1, 1, self.nsample, 1)
-                # k = k
+            if i > 0:
+                k = conv(k)
             if self.bn:
                 k = self.mlp_k_bns[i](k)
-            if i == len(self.mlp_k_convs) - 1:
-                k = k
-            else:
+            if i < len(self.mlp_k_convs) - 1:
                 k = self.relu(k)
             if i == len(self.mlp_k_convs) - 2:
                 k = torch.max(k, -2)[0].unsqueeze(-2)
@@ -202,15 +246,10 @@ class GAT_GCN(nn.Module):
 
         g1, g2 = torch.chunk(a, 2, 1)
 
-        v = new_points
-        v = self.fuse_v1(v)
-
-        point1_graph_expand = point1_graph.view(B, point1_graph.size(1), 1, N1).repeat(1, 1, self.nsample, 1)
-        point1_expand = g2 * point1_graph_expand
-        point1_expand = self.fuse_v2(point1_expand)
+        point1_expand = self.fuse_v2(g2 * point1_graph.unsqueeze(2))
 
-        v = self.relu(v * g1 + point1_expand) + points1.unsqueeze(2).repeat(1, 1, self.nsample, 1)
-        # v = self.relu(v * a) + points1.unsqueeze(2).repeat(1, 1, self.nsample, 1)
+        v = self.relu(v * g1 + point1_expand) + points1.unsqueeze(2)
+        # v = self.relu(v * a) + points1.unsqueeze(2)
 
         v_res = v.mean(2)
 
@@ -221,26 +260,61 @@ class GAT_GCN(nn.Module):
                 # v = v * a
             if self.bn:
                 v = self.mlp_v_bns[i](v)
-            if i == len(self.mlp_v_convs) - 1:
-                v = self.relu(v)
-            else:
-                v = self.relu(v)
+            v = self.relu(v)
             if i == len(self.mlp_v_convs) - 2:
                 v = torch.max(v, -2)[0].unsqueeze(-2)
 
-        v = v.squeeze(-2)
+        return v.squeeze(-2) + v_res
+
+    def forward(self, xyz1, xyz2, points1, points2, cache=None):
+        '''
+        add fuse_v
+        xyz1: joints [B, 3, N1]   32,3,14
+        xyz2: local points [B, 3, N2]   32,3,512
+        points1: joints features [B, C, N1]  32,3,14
+        points2: local features [B, C, N2]   32,256,512
+        cache: NeighbourCache of xyz2, replaces the full kNN search
+        '''
+
+        B, C, N1 = xyz1.shape
+        xyz1 = xyz1.permute(0, 2, 1)
+        xyz2 = xyz2.permute(0, 2, 1)
 
-        if self.mlp2:
-            for _, conv in enumerate(self.mlp2):
-                new_points = conv(new_points)
+        point1_graph = self.graph_w(torch.matmul(points1.unsqueeze(-2), self.graph_a).squeeze(-2))  # E‘=AEW
 
-        return v + v_res
+        if self.radius is None:
+            if cache is not None:
+                knn_idx = cache.knn(xyz1, self.nsample)
+            else:
+                knn_idx = knn_query(self.nsample, xyz2, xyz1)
+            group = lambda j: self.group_first_layer(xyz1[:, j], xyz2, points2, knn_idx[:, j])
+        else:
+            new_points = self.queryandgroup(xyz2.contiguous(), xyz1.contiguous(), points2.contiguous())
+            new_points = new_points.permute(0, 1, 3, 2)  # [B, D2+3, nsample, N1]
+            group = lambda j: self.first_layer(new_points[..., j])
+
+        # batch norm statistics are taken over all the joints
+        chunk = N1 if self.chunk is None or (self.bn and self.training) else self.chunk
+        v = []
+        for start in range(0, N1, chunk):
+            j = slice(start, start + chunk)
+            q, k, v0 = group(j)
+            v.append(self.refine(q, k, v0, points1[..., j], point1_graph[..., j]))
+        return torch.cat(v, -1)
 
 
 
 
 class HandModel(nn.Module):
-    def __init__(self, joints=21, stacks=10):
+    def __init__(self, joints=21, stacks=10, fusion_window=None, prefix_fps=False):
+        """
+        :param fusion_window: search the image pixels fused with the points in the fusion_window x fusion_window
+                              pixels around their projection (dataloader/window_search.py) instead of the whole map,
+                              approximate, None searches the whole map
+        :param prefix_fps: one FPS over the input shared by the stages of the point encoder (PointMambaEncoder), the
+                           stages sample from input point 0 instead of the first serialized point, not the sampling
+                           the checkpoints trained without it have seen
+        """
         super(HandModel, self).__init__()
 
         self.backbone = MLLA(img_size=128, patch_size=2, in_chans=1, num_classes=14, embed_dim=96, depths=[2, 2, 6, 2],
@@ -259,7 +333,8 @@ class HandModel(nn.Module):
                                                 drop_path_rate=0.1, mamba_pos=True,
                                                 mamba_layers_orders=["xyz", "xzy", "yxz", "yzx", "zxy", "zyx"],
                                                 use_order_prompt=True,
-                                                prompt_num_per_order=6, radius=self.radius,lambda_param=0.3,k_dense=24
+                                                prompt_num_per_order=6, radius=self.radius,lambda_param=0.3,k_dense=24,
+                                                prefix_fps=prefix_fps
                                                 )
 
 
@@ -285,6 +360,9 @@ class HandModel(nn.Module):
 
         self.stacks = stacks
         self.joints = joints
+        # kNN candidates per joint kept for the refinement stacks, see NeighbourCache
+        self.knn_candidates = 256
+        self.fusion_window = fusion_window
 
     def log_snr(self, t):
         return -torch.log(torch.special.expm1(1e-4 + 10 * (t ** 2)))
@@ -292,10 +370,11 @@ class HandModel(nn.Module):
     def log_snr_to_alpha_sigma(self, log_snr):
         return torch.sqrt(torch.sigmoid(log_snr)), torch.sqrt(torch.sigmoid(-log_snr))
 
-    def encode(self, pc, feat, img, loader, center, M, cube, cam_para):
+    def encode(self, pc, feat, img, loader, center, M, cube, cam_para, precomputed=None):
         # x: B*INPUT_FEATURE_NUM*sample_num_level1*knn_K, y: B*3*sample_num_level1*1
+        # precomputed: stage-one indices from the DataLoader workers, see dataloader/point_precompute.py
 
-        pc1, feat1, pc2, feat2,adjust_radius= self.encoder_global(pc, feat)
+        pc1, feat1, pc2, feat2,adjust_radius= self.encoder_global(pc, feat, precomputed)
 
 
         code = self.encoder_3(torch.cat((pc2, feat2), 1))
@@ -308,9 +387,10 @@ class HandModel(nn.Module):
         B, _, N = pc1.size()
 
         pcl_closeness, pcl_index, img_xyz = loader.img2pcl_index(pc1.transpose(1, 2).contiguous(), img_down, center, M,
-                                                                 cube, cam_para, select_num=4)
+                                                                 cube, cam_para, select_num=4,
+                                                                 window=self.fusion_window)
 
-        pcl_feat_index = pcl_index.view(B, 1, -1).repeat(1, C, 1)  # B*128*(K*1024)
+        pcl_feat_index = pcl_index.view(B, 1, -1).expand(B, C, pcl_index.size(1) * pcl_index.size(2))  # B*128*(K*1024)
         pcl_feat = torch.gather(pc_img_feat.view(B, C, -1), -1, pcl_feat_index).view(B, C, N, -1)
         pcl_feat = torch.sum(pcl_feat * pcl_closeness.unsqueeze(1), dim=-1)  #
 
@@ -327,38 +407,54 @@ class HandModel(nn.Module):
         return latents,joints, pc1, feat1,adjust_radius
 
 
-    def forward(self, pc, feat, img, loader, center, M, cube, cam_para):
+    def forward(self, pc, feat, img, loader, center, M, cube, cam_para, precomputed=None):
         # embed,joint, pc1, feat1,dynamic_radius= self.encode(pc, feat, img, loader, center, M, cube, cam_para)
-        embed,joint, pc1, feat1,dynamic_radius= self.encode(pc, feat, img, loader, center, M, cube, cam_para)
+        embed,joint, pc1, feat1,dynamic_radius= self.encode(pc, feat, img, loader, center, M, cube, cam_para, precomputed)
         # joint = torch.randn_like(joint) * 0.1 + joint  # (B, d, J) original training
         # joint = torch.randn_like(joint) * 3 + joint  # (B, d, J)
 
+        cache = NeighbourCache(joint.transpose(1, 2), pc1.transpose(1, 2), self.knn_candidates)
         for i in range(self.stacks):
-            embed = self.trans[i](joint, pc1, embed, feat1)
+            embed = self.trans[i](joint, pc1, embed, feat1, cache)
             joint = self.regress(embed)
         return joint
 
     def get_loss(self, pc, feat, img, loader, center, M, cube, cam_para, gt):
+        return self.forward_with_loss(pc, feat, img, loader, center, M, cube, cam_para, gt, noise=True)[1]
+
+    def forward_with_loss(self, pc, feat, img, loader, center, M, cube, cam_para, gt, noise=None, precomputed=None):
+        '''
+        Encode once, refine through the stacks and accumulate the loss of every prediction
+        :param noise: perturb the encoder estimate before the stacks (training), defaults to self.training
+        :param precomputed: stage-one indices from the DataLoader workers, see dataloader/point_precompute.py
+        :return: joints (stacks+1)xBx3xJ, the encoder estimate then one per stack; loss
+        '''
+        if noise is None:
+            noise = self.training
         # embed,joint, pc1, feat1,dynamic_radius = self.encode(pc, feat, img, loader, center, M, cube, cam_para)
-        embed,joint, pc1, feat1,dynamic_radius = self.encode(pc, feat, img, loader, center, M, cube, cam_para)
+        embed,joint, pc1, feat1,dynamic_radius = self.encode(pc, feat, img, loader, center, M, cube, cam_para, precomputed)
 
         radius_loss = radius_regularization_loss(dynamic_radius,radius_min=0.1,radius_max=0.3)
         loss = smooth_l1_loss(joint, gt) + radius_loss
+        joints = [joint]
 
-        times = torch.zeros(
-            (joint.size(0),), device=joint.device).float().uniform_(0.5, 1)
-        log_snr = self.log_snr(times)
-        alpha, sigma = self.log_snr_to_alpha_sigma(times)
-        # c0 = alpha.view(-1, 1, 1)   # (B, 1, 1)
-        c1 = torch.sqrt(torch.sigmoid(-log_snr)).view(-1, 1, 1)  # (B, 1, 1) 计算噪声的幅度c1
+        if noise:
+            times = torch.zeros(
+                (joint.size(0),), device=joint.device).float().uniform_(0.5, 1)
+            log_snr = self.log_snr(times)
+            alpha, sigma = self.log_snr_to_alpha_sigma(times)
+            # c0 = alpha.view(-1, 1, 1)   # (B, 1, 1)
+            c1 = torch.sqrt(torch.sigmoid(-log_snr)).view(-1, 1, 1)  # (B, 1, 1) 计算噪声的幅度c1
 
-        e_rand = torch.randn_like(joint)  # (B, d, J)
-        joint = joint + c1 * e_rand
+            e_rand = torch.randn_like(joint)  # (B, d, J)
+            joint = joint + c1 * e_rand
 
 
+        cache = NeighbourCache(joint.transpose(1, 2), pc1.transpose(1, 2), self.knn_candidates)
         for i in range(self.stacks):
-            embed = self.trans[i](joint, pc1, embed, feat1)
+            embed = self.trans[i](joint, pc1, embed, feat1, cache)
             joint = self.regress(embed)
             loss += smooth_l1_loss(joint, gt)
+            joints.append(joint)
 
-        return loss
+        return torch.stack(joints, 0), loss
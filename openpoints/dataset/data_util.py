@@ -1,4 +1,3 @@
-from curses import keyname
 import numpy as np
 import torch
 import os
@@ -6,7 +5,6 @@ import os.path as osp
 import ssl
 import sys
 import urllib
-import h5py
 from typing import Optional
 
 
@@ -44,6 +42,7 @@ class IO:
 
     @classmethod
     def _read_h5(cls, file_path):
+        import h5py
         f = h5py.File(file_path, 'r')
         return f['data'][()]
 
@@ -1,14 +1,17 @@
-from pointnet2.pointnet2_utils import DynamicBallRadiusAdjustment
 from ..build import MODELS
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from functools import partial
-from mamba_ssm.ops.triton.layernorm import RMSNorm, layer_norm_fn, rms_norm_fn
+try:
+    from mamba_ssm.ops.triton.layernorm import RMSNorm, layer_norm_fn, rms_norm_fn
+except ImportError:
+    # no Triton: PyTorch norms, see mamba_ssm/ops/cpu_interface.py
+    from mamba_ssm.ops.cpu_interface import RMSNorm, layer_norm_fn, rms_norm_fn
 from .mamba_layer import MambaBlock
-from .PCM_utils import MLP, serialization, _init_weights, index_points, square_distance
+from .PCM_utils import MLP, serialization, SerializationCache, _init_weights, index_points, square_distance, prefix_fps_index
 from .PointMLP_layers import ConvBNReLU1D, LocalGrouper, PreExtraction, PreExtraction_Replace,\
-    PosExtraction, get_activation, PointNetFeaturePropagation
+    PosExtraction, get_activation, PointNetFeaturePropagation, pointnet2_utils
 from typing import List
 from ..layers import furthest_point_sample
 
@@ -26,7 +29,8 @@ class PointMambaEncoder(nn.Module):
                  mamba_pos=False, pos_type='share', pos_proj_type="linear",
                  grid_size=0.02, combine_pos=False, block_residual=True,
                  use_windows=False, windows_size=1200,
-                 cls_pooling="max",lambda_param=0.1,k_dense=32,
+                 windows_mode='fps', windows_shift=False, windows_overlap=0,
+                 cls_pooling="max",lambda_param=0.1,k_dense=32, prefix_fps=False,
                  **kwargs):
         super(PointMambaEncoder, self).__init__()
 
@@ -39,6 +43,23 @@ class PointMambaEncoder(nn.Module):
         self.windows_size = windows_size
         if not isinstance(self.windows_size, list):
             self.windows_size = [windows_size] * len(mamba_blocks)
+        # 'fps': FPS subsampled windows (pre_split_windows), 'serialized': windows of consecutive points of the
+        # serialized sequence, all the points are kept (pre_serialized_windows)
+        assert windows_mode in ['fps', 'serialized'], 'windows_mode should be fps or serialized'
+        self.windows_mode = windows_mode
+        # serialized windows: shift the windows by half a window on every other mamba layer of a stage,
+        # and let consecutive windows share windows_overlap points, averaged
+        self.windows_shift = windows_shift
+        self.windows_overlap = windows_overlap
+        if not isinstance(self.windows_overlap, list):
+            self.windows_overlap = [windows_overlap] * len(mamba_blocks)
+        assert all(o < w for o, w in zip(self.windows_overlap, self.windows_size)), \
+            'windows_overlap should be smaller than windows_size'
+
+        # one FPS over the input shared by all the stages, see PCM_utils.prefix_fps_index
+        # (the fps windows subsample the points with their own FPS)
+        self.prefix_fps = prefix_fps
+        assert not (prefix_fps and use_windows and windows_mode == 'fps'), 'prefix_fps does not support fps windows'
 
         self.combine_pos = combine_pos
         self.local_rank = None
@@ -135,7 +156,7 @@ class PointMambaEncoder(nn.Module):
             local_grouper = LocalGrouper(last_channel, reduce, kneighbor, use_xyz, normalize,
                                          k_stride=kstride,radius=radius_1,lambda_param=lambda_param,k_dense=k_dense)  # [b,g,k,d]
             self.local_grouper_list.append(local_grouper)
-            self.dynamic_ball_radius_adjustment = DynamicBallRadiusAdjustment(radius_1,lambda_param,k_dense)
+            self.dynamic_ball_radius_adjustment = pointnet2_utils.DynamicBallRadiusAdjustment(radius_1,lambda_param,k_dense)
 
             # append pre_block_list
             if pre_block_num == 0:
@@ -194,12 +215,17 @@ class PointMambaEncoder(nn.Module):
         self.radius = 0.3
         # self.nsample = 64
 
-    def forward(self, x, f0=None):
-        return self.forward_cls_feat(x,f0)
+    def forward(self, x, f0=None, precomputed=None):
+        return self.forward_cls_feat(x,f0,precomputed)
 
-    def serialization_func(self, p, x, x_res, order, layers_outputs=[]):
+    def serialization_func(self, p, x, x_res, order, layers_outputs=[], cache=None):
         if order == self.order:
             return p, x, x_res
+        elif cache is not None and order in cache:
+            p, x, x_res = cache.serialization(p, x, x_res=x_res, order=order,
+                                              layers_outputs=layers_outputs)
+            self.order = order
+            return p, x, x_res
         else:
             p, x, x_res = serialization(p, x, x_res=x_res, order=order,
                                         layers_outputs=layers_outputs,
@@ -207,8 +233,25 @@ class PointMambaEncoder(nn.Module):
             self.order = order
             return p, x, x_res
 
-    def forward_cls_feat(self, p, x=None):
-
+    def stage_serialization_cache(self, p, layer_orders):
+        """
+        SerializationCache of the orders the mamba layers of a stage switch to, None if they all keep self.order
+        (the fps windows subsample the points between the layers, no cache with them)
+        """
+        if self.use_windows and self.windows_mode == 'fps':
+            return None
+        orders, current = [], self.order
+        for order in layer_orders:
+            if order != current:
+                orders.append(order)
+            current = order
+        return SerializationCache(p, orders, self.grid_size) if len(orders) > 0 else None
+
+    def forward_cls_feat(self, p, x=None, precomputed=None):
+        """
+        :param precomputed: (fps_order [B, F], group_idx [B, S, k], group_radius [B, S]) of the first stage,
+                            computed by the DataLoader workers, see dataloader/point_precompute.py
+        """
         self.order = "original"
         # p = cartesian_to_polar(p)
         p = p.permute(0,2,1)
@@ -220,24 +263,60 @@ class PointMambaEncoder(nn.Module):
         x = self.embedding(x)  # B,D,N
         x_res = None
 
+        num_input = p.size(1)
+        fps_order, group_idx, group_radius = precomputed if precomputed is not None else (None, None, None)
+        if self.prefix_fps:
+            num_points = [num_input]
+            for grouper in self.local_grouper_list:
+                num_points.append(num_points[-1] // grouper.sample_ratio)
+            fps_num = max([n for n in num_points if n < num_input] or [0])
+            if fps_order is None:
+                fps_order = furthest_point_sample(p.contiguous(), fps_num).long() if fps_num > 0 else None
+            else:
+                assert fps_order.size(1) >= fps_num, 'fps_order has %d points, expected %d' % (fps_order.size(1), fps_num)
+            # input index of every point, follows the points through sampling and serialization
+            orig_idx = torch.arange(num_input, device=p.device).view(1, num_input, 1).repeat(batch_size, 1, 1)
+
         pos_proj_idx = 0
         mamba_layer_idx = 0
         for i in range(self.stages):
 
+            fps_idx = None
+            S = p.size(1) // self.local_grouper_list[i].sample_ratio
+            if self.prefix_fps:
+                if S < p.size(1):
+                    fps_idx = prefix_fps_index(orig_idx.squeeze(-1), fps_order[:, :S], num_input)
+                    orig_idx = index_points(orig_idx, fps_idx)
+            elif i == 0 and fps_order is not None and S < num_input:
+                fps_idx = torch.sort(fps_order[:, :S], dim=-1)[0]
+
             # GAM forward
-            p, x, x_res,adjust_radius = self.local_grouper_list[i](p, x.permute(0, 2, 1), x_res)  # [b,g,3]  [b,g,k,d]
+            if i == 0 and group_idx is not None:
+                p, x, x_res,adjust_radius = self.local_grouper_list[i](p, x.permute(0, 2, 1), x_res, fps_idx,
+                                                                       group_idx, group_radius)
+            else:
+                p, x, x_res,adjust_radius = self.local_grouper_list[i](p, x.permute(0, 2, 1), x_res, fps_idx)  # [b,g,3]  [b,g,k,d]
             x = self.pre_blocks_list[i](x)  # [b,d,g] 从局部邻域中提取特征
 
             x = x.permute(0, 2, 1).contiguous()
             if not self.block_residual:
                 x_res = None
             x_res = self.residual_proj_blocks_list[i](x_res)
+            # orderings of the stage, computed once
+            stage_orders = self.mamba_layers_orders[mamba_layer_idx:mamba_layer_idx + len(self.mamba_blocks_list[i])]
+            cache = self.stage_serialization_cache(p, stage_orders)
             # mamba forward
-            for layer in self.mamba_blocks_list[i]:
-                p, x, x_res = self.serialization_func(p, x, x_res, self.mamba_layers_orders[mamba_layer_idx])
+            for j, layer in enumerate(self.mamba_blocks_list[i]):
+                if self.prefix_fps:
+                    layers_outputs = [orig_idx]
+                    p, x, x_res = self.serialization_func(p, x, x_res, self.mamba_layers_orders[mamba_layer_idx],
+                                                          layers_outputs, cache)
+                    orig_idx = layers_outputs[0]
+                else:
+                    p, x, x_res = self.serialization_func(p, x, x_res, self.mamba_layers_orders[mamba_layer_idx],
+                                                          cache=cache)
                 if self.use_windows:
-                    p, x, x_res, n_windows, p_base = self.pre_split_windows(
-                        p, x, x_res, windows_size=self.windows_size[i])
+                    p, x, x_res, windows = self.split_windows(p, x, x_res, i, shift=j % 2 == 1)
                 if self.mamba_pos:
                     if self.pos_type == 'share':
                         if self.block_pos_share:
@@ -262,7 +341,7 @@ class PointMambaEncoder(nn.Module):
                 else:
                     x, x_res = layer(x, x_res)
                 if self.use_windows:
-                    p, x, x_res = self.post_split_windows(p, x, x_res, n_windows, p_base)
+                    p, x, x_res = self.merge_windows(p, x, x_res, windows)
                 mamba_layer_idx += 1
             x = x.permute(0, 2, 1).contiguous()
 
@@ -323,11 +402,10 @@ class PointMambaEncoder(nn.Module):
             if not self.block_residual:
                 x_res = None
             x_res = self.residual_proj_blocks_list[i](x_res)
-            for layer in self.mamba_blocks_list[i]:
+            for j, layer in enumerate(self.mamba_blocks_list[i]):
                 p, x, x_res = self.serialization_func(p, x, x_res, self.mamba_layers_orders[mamba_layer_idx])
                 if self.use_windows:
-                    p, x, x_res, n_windows, p_base, p_std = self.pre_split_windows(
-                        p, x, x_res, windows_size=self.windows_size[i])
+                    p, x, x_res, windows = self.split_windows(p, x, x_res, i, shift=j % 2 == 1)
                 if self.mamba_pos:
                     if self.pos_type == 'share':
                         if self.block_pos_share:
@@ -352,7 +430,7 @@ class PointMambaEncoder(nn.Module):
                 else:
                     x, x_res = layer(x, x_res)
                 if self.use_windows:
-                    p, x, x_res = self.post_split_windows(p, x, x_res, n_windows, p_base, p_std)
+                    p, x, x_res = self.merge_windows(p, x, x_res, windows)
                 mamba_layer_idx += 1
             x = x.permute(0, 2, 1).contiguous()
             x = self.pos_blocks_list[i](x)  # [b,d,g]
@@ -362,6 +440,70 @@ class PointMambaEncoder(nn.Module):
 
         return p_list, x_list
 
+    def split_windows(self, p, x, x_res, stage, shift=False):
+        """
+        Windows of the points of a stage for a mamba layer, batched: [B * n_windows, windows_size, .]
+        :param shift: shift the serialized windows by half a window (with windows_shift)
+        :return: p, x, x_res of the windows, windows to give to merge_windows
+        """
+        windows_size = self.windows_size[stage]
+        if self.windows_mode == 'serialized':
+            shift = windows_size // 2 if shift and self.windows_shift else 0
+            p_windows, x, x_res, window_idx = self.pre_serialized_windows(
+                p, x, x_res, windows_size, shift=shift, overlap=self.windows_overlap[stage])
+            return p_windows, x, x_res, (p, window_idx)
+        p, x, x_res, n_windows, p_base, p_std = self.pre_split_windows(p, x, x_res, windows_size=windows_size)
+        return p, x, x_res, (n_windows, p_base, p_std)
+
+    def merge_windows(self, p, x, x_res, windows):
+        if self.windows_mode == 'serialized':
+            p, window_idx = windows
+            x, x_res = self.post_serialized_windows(x, x_res, window_idx, p.size(1))
+            return p, x, x_res
+        return self.post_split_windows(p, x, x_res, *windows)
+
+    def pre_serialized_windows(self, p, x, x_res, windows_size=1024, shift=0, overlap=0):
+        """
+        Windows of windows_size consecutive points of the serialized sequence, one every windows_size - overlap
+        points from -shift; the starts are clamped into the sequence, so the first and last windows overlap
+        their neighbours instead of being padded.
+        :param p: [B, N, 3], x: [B, N, C], x_res: [B, N, C] or None
+        :return: p (normalized per window), x, x_res of the windows [B * n_windows, windows_size, .],
+                 window_idx [n_windows, windows_size] (None when N <= windows_size, the inputs are returned)
+        """
+        bs, n, c = x.shape
+        if n <= windows_size:
+            return p, x, x_res, None
+
+        stride = windows_size - overlap
+        n_windows = -(-(n + shift - windows_size) // stride) + 1
+        starts = (torch.arange(n_windows, device=x.device) * stride - shift).clamp(0, n - windows_size)
+        window_idx = starts[:, None] + torch.arange(windows_size, device=x.device)
+        new_p = p[:, window_idx].flatten(0, 1)
+        new_x = x[:, window_idx].flatten(0, 1)
+        new_x_res = x_res[:, window_idx].flatten(0, 1) if x_res is not None else None
+
+        p_base = torch.min(new_p, dim=1, keepdim=True)[0]
+        p_std = torch.max(new_p, dim=1, keepdim=True)[0] - p_base + 1e-6
+        new_p = (new_p - p_base) / p_std
+        return new_p.contiguous(), new_x.contiguous(), new_x_res, window_idx
+
+    def post_serialized_windows(self, x, x_res, window_idx, n):
+        # back to [B, N, C], the outputs of the points in several windows are averaged
+        if window_idx is None:
+            return x, x_res
+        idx = window_idx.flatten()
+        count = torch.bincount(idx, minlength=n)[None, :, None]
+        outputs = []
+        for y in [x, x_res]:
+            if y is None:
+                outputs.append(None)
+                continue
+            y = y.reshape(-1, idx.size(0), y.size(-1))
+            merged = y.new_zeros(y.size(0), n, y.size(-1)).index_add_(1, idx, y)
+            outputs.append(merged / count)
+        return outputs[0], outputs[1]
+
     def pre_split_windows(self, p, x, x_res, windows_size=1024):
         # x (bs, n, c), p (bs, n, 3)
         bs, n, c = x.shape
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from .serialization import Point
+from .knn import knn_query
 import math
 
 class MLP(nn.Module):
@@ -18,11 +19,8 @@ class MLP(nn.Module):
             x = F.relu(layer(x)) if i < self.num_layers - 1 else layer(x)
         return x
 
-def serialization(pos, feat, x_res=None, order="z", layers_outputs=[], grid_size=0.02):
-    bs, n_p, _ = pos.size()
-    if not isinstance(order, list):
-        order = [order]
-
+def _serialize(pos, order, grid_size=0.02):
+    # serialized_order / serialized_inverse [len(order), B*N] of the points pos [B, N, 3], one argsort for all orders
     scaled_coord = pos / grid_size
     grid_coord = torch.floor(scaled_coord).to(torch.int64) # 得到网格坐标
     min_coord = grid_coord.min(dim=1, keepdim=True)[0]
@@ -33,10 +31,11 @@ def serialization(pos, feat, x_res=None, order="z", layers_outputs=[], grid_size
     point_dict = {'batch': batch_idx.flatten(), 'grid_coord': grid_coord.flatten(0, 1), }
     point_dict = Point(**point_dict)
     point_dict.serialization(order=order)
+    return point_dict.serialized_order, point_dict.serialized_inverse
 
-    order = point_dict.serialized_order
-    inverse_order = point_dict.serialized_inverse
 
+def _permute(order, pos, feat, x_res, layers_outputs):
+    bs, n_p, _ = pos.size()
     pos = pos.flatten(0, 1)[order].reshape(bs, n_p, -1).contiguous()
     feat = feat.flatten(0, 1)[order].reshape(bs, n_p, -1).contiguous()
     if x_res is not None:
@@ -47,6 +46,68 @@ def serialization(pos, feat, x_res=None, order="z", layers_outputs=[], grid_size
     return pos, feat, x_res
 
 
+def serialization(pos, feat, x_res=None, order="z", layers_outputs=[], grid_size=0.02):
+    if not isinstance(order, list):
+        order = [order]
+    order, _ = _serialize(pos, order, grid_size)
+    return _permute(order, pos, feat, x_res, layers_outputs)
+
+
+class SerializationCache(object):
+    """
+    Serializations of the points of one encoder stage.
+    The points only change order between the mamba layers of a stage, so the orderings they
+    use are computed once, in one batched pass over the points as they are when the cache is
+    built (the base), with their inverse permutations.  Going from order a to order b is then
+    a single gather with the composed permutation inverse_a[order_b], without new codes or argsort.
+    pos: points of the stage, [B, N, 3]
+    orders: serialization orders used in the stage
+    """
+    def __init__(self, pos, orders, grid_size=0.02):
+        self.orders = list(dict.fromkeys(orders))
+        self.serialized_order, self.serialized_inverse = _serialize(pos, self.orders, grid_size)
+        # order of the current arrangement, None for the base
+        self.current = None
+
+    def __contains__(self, order):
+        return order in self.orders
+
+    def permutation(self, order):
+        """
+        Flat gather index [B*N] from the current arrangement to order
+        """
+        target = self.serialized_order[self.orders.index(order)]
+        if self.current is None:
+            return target
+        return self.serialized_inverse[self.orders.index(self.current)][target]
+
+    def serialization(self, pos, feat, x_res=None, order="z", layers_outputs=[]):
+        """
+        Same as serialization() for the points of the cache, in any of the cached orders
+        """
+        permutation = self.permutation(order)
+        self.current = order
+        return _permute(permutation, pos, feat, x_res, layers_outputs)
+
+
+def prefix_fps_index(orig_idx, fps_prefix, num_input):
+    """
+    Positions in the current point order of a prefix of an FPS ordering of the input points.
+    FPS is greedy, so the first S indices of one FPS run over the input are also an FPS of any
+    larger prefix: the stages of the encoder can share a single run.
+    Input:
+        orig_idx: input index of every current point, [B, N]
+        fps_prefix: input indices, [B, S], a subset of orig_idx
+        num_input: number of input points
+    Return:
+        fps_idx: sorted positions of fps_prefix in the current order, [B, S]
+    """
+    B, N = orig_idx.shape
+    position = torch.zeros(B, num_input, dtype=torch.long, device=orig_idx.device)
+    position.scatter_(1, orig_idx, torch.arange(N, device=orig_idx.device).view(1, N).expand(B, N))
+    return torch.sort(torch.gather(position, 1, fps_prefix), dim=-1)[0]
+
+
 def square_distance(src, dst):
     """
     Calculate Euclid distance between each two points.
@@ -144,28 +205,11 @@ def knn_point(nsample, xyz, new_xyz, training=True):
         nsample: max sample number in local region
         xyz: all points, [B, N, C]
         new_xyz: query points, [B, S, C]
+        training: unused, the search is tiled in both modes (see knn.knn_query)
     Return:
         group_idx: grouped points index, [B, S, nsample]
     """
-    if training:
-        sqrdists = square_distance(new_xyz, xyz)
-        _, group_idx = torch.topk(sqrdists, nsample, dim=-1, largest=False, sorted=True)
-    else:
-        N = new_xyz.shape[1]
-        idx_list = []
-        n_splits = N // 1024
-        if n_splits * 1024 != N:
-            n_splits += 1
-        start, end = 0, 1024
-        for i in range(n_splits):
-            end = min(end, N)
-            sqrdists = square_distance(new_xyz[:, start: end], xyz)
-            _, group_idx = torch.topk(sqrdists, nsample, dim=-1, largest=False, sorted=True)
-            idx_list.append(group_idx)
-            start += 1024
-            end += 1024
-        group_idx = torch.cat(idx_list, dim=1)
-    return group_idx
+    return knn_query(nsample, xyz, new_xyz)
 
 # https://github.com/huggingface/transformers/blob/c28d04e9e252a1a099944e325685f14d242ecdcd/src/transformers/models/gpt2/modeling_gpt2.py#L454
 def _init_weights(
@@ -3,7 +3,17 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from .PCM_utils import knn_point, index_points, square_distance
-from pointnet2 import pointnet2_utils
+from .knn import knn_query
+from . import ball_query
+
+try:
+    from pointnet2 import pointnet2_utils
+
+    has_pointnet2 = True
+except ImportError:
+    # density-aware ball query in PyTorch, see ball_query.py
+    pointnet2_utils = ball_query
+    has_pointnet2 = False
 
 def get_activation(activation):
     if activation.lower() == 'gelu':
@@ -27,6 +37,7 @@ class LocalGrouper(nn.Module):
         Give xyz[b,p,3] and fea[b,p,d], return new_xyz[b,g,3] and new_fea[b,g,k,d]
         :param groups: groups number
         :param kneighbors: k-nerighbors
+        :param radius: ball radius of the density-aware query, None groups the k nearest neighbours (knn.knn_query)
         :param kwargs: others
         """
         super(LocalGrouper, self).__init__()
@@ -34,7 +45,17 @@ class LocalGrouper(nn.Module):
         self.kneighbors = kneighbors
         self.use_xyz = use_xyz
         self.k_stride = k_stride
-        self.queryandgroup = pointnet2_utils.QueryAndGroup(radius, kneighbors,lambda_param,k_dense, self.use_xyz)
+        # ball query settings, read by dataloader/point_precompute.py (PointPrecompute.from_encoder)
+        self.radius = radius
+        self.lambda_param = lambda_param
+        self.k_dense = k_dense
+        if radius is not None:
+            self.queryandgroup = pointnet2_utils.QueryAndGroup(radius, kneighbors,lambda_param,k_dense, self.use_xyz)
+            # CPU tensors: the extension only has CUDA kernels
+            self.queryandgroup_torch = self.queryandgroup if not has_pointnet2 else \
+                ball_query.QueryAndGroup(radius, kneighbors, lambda_param, k_dense, self.use_xyz)
+        else:
+            self.queryandgroup = None
         if normalize is not None:
             self.normalize = normalize.lower()
         else:
@@ -47,7 +68,12 @@ class LocalGrouper(nn.Module):
             self.affine_alpha = nn.Parameter(torch.ones([1, 1, 1, channel + add_channel]))
             self.affine_beta = nn.Parameter(torch.zeros([1, 1, 1, channel + add_channel]))
 
-    def forward(self, xyz, points, points_res):
+    def forward(self, xyz, points, points_res, fps_idx=None, group_idx=None, group_radius=None):
+        """
+        :param fps_idx: [B, npoint] sorted sample indices, replaces the FPS of this stage (see PCM_utils.prefix_fps_index)
+        :param group_idx: [B, npoint, k] neighbour indices, replaces the ball query (see dataloader/point_precompute.py)
+        :param group_radius: [B, npoint] adjusted radius of the precomputed ball query
+        """
         B, N, C = xyz.shape
         S = N // self.sample_ratio
         xyz = xyz.contiguous()  # xyz [btach, points, xyz]
@@ -56,21 +82,28 @@ class LocalGrouper(nn.Module):
             new_xyz = xyz  # [B, npoint, 3]
             new_points = points  # [B, npoint, d]
         else:
-            fps_idx = furthest_point_sample(xyz, S).long()  # [B, npoint]
-            fps_idx = torch.sort(fps_idx, dim=-1)[0]
+            if fps_idx is None:
+                fps_idx = furthest_point_sample(xyz, S).long()  # [B, npoint]
+                fps_idx = torch.sort(fps_idx, dim=-1)[0]
             new_xyz = index_points(xyz, fps_idx)  # [B, npoint, 3]
             new_points = index_points(points, fps_idx)  # [B, npoint, d]
             if points_res is not None:
                 points_res = index_points(points_res, fps_idx)
 
-        # idx = knn_point(self.kneighbors, xyz, new_xyz, training=self.training)
-        # idx = idx[:, :, ::self.k_stride]
-        # grouped_xyz = index_points(xyz, idx)  # [B, npoint, k, 3]
-        # grouped_points = index_points(points, idx)  # [B, npoint, k, d]
-
-        if self.use_xyz:
+        if group_idx is None and self.queryandgroup is None:
+            group_idx = knn_query(self.kneighbors, xyz, new_xyz)[:, :, ::self.k_stride]  # [B, npoint, k]
+            group_radius = None
+        if group_idx is not None:
+            assert group_idx.size(-1) == self.kneighbors // self.k_stride, \
+                'group_idx has %d neighbours, expected %d' % (group_idx.size(-1), self.kneighbors // self.k_stride)
+            grouped_points = index_points(points, group_idx)  # [B, npoint, k, d]
+            if self.use_xyz:
+                grouped_points = torch.cat([grouped_points, index_points(xyz, group_idx)], dim=-1)  # [B, npoint, k, d+3]
+            adjust_radius = group_radius
+        elif self.use_xyz:
             ##############################################################################################
-            grouped_points,adjust_radius = self.queryandgroup(xyz, new_xyz.contiguous(), points.permute(0, 2, 1)) # (32,259,512,24)
+            queryandgroup = self.queryandgroup if xyz.is_cuda else self.queryandgroup_torch
+            grouped_points,adjust_radius = queryandgroup(xyz, new_xyz.contiguous(), points.permute(0, 2, 1)) # (32,259,512,24)
             grouped_points=grouped_points.permute(0, 2, 3, 1)
             ################################################################################################
             # grouped_points = torch.cat([grouped_points, grouped_xyz], dim=-1)  # [B, npoint, k, d+3]
@@ -263,27 +296,7 @@ class PointNetFeaturePropagation(nn.Module):
         if S == 1:
             interpolated_points = points2.repeat(1, N, 1)
         else:
-            if self.training:
-                dists = square_distance(xyz1, xyz2)
-                dists, idx = dists.sort(dim=-1)
-                dists, idx = dists[:, :, :3], idx[:, :, :3]  # [B, N, 3]
-            else:
-                dists_list = []
-                idx_list = []
-                n_splits = N // 1024
-                if n_splits * 1024 != N:
-                    n_splits += 1
-                start, end = 0, 1024
-                for i in range(n_splits):
-                    end = min(end, N)
-                    dists = square_distance(xyz1[:, start: end], xyz2)
-                    dists, idx = torch.topk(dists, k, dim=-1, largest=False, sorted=True)
-                    dists_list.append(dists)
-                    idx_list.append(idx)
-                    start += 1024
-                    end += 1024
-                dists = torch.cat(dists_list, dim=1)
-                idx = torch.cat(idx_list, dim=1)
+            dists, idx = knn_query(k, xyz2, xyz1, return_dist=True)  # [B, N, k]
 
             # dists, idx = dists.sort(dim=-1)
             # dists, idx = dists[:, :, :3], idx[:, :, :3]  # [B, N, 3]
@@ -292,7 +305,7 @@ class PointNetFeaturePropagation(nn.Module):
             norm = torch.sum(dist_recip, dim=2, keepdim=True)
             weight = dist_recip / norm
             # print(points2.shape, '  ', idx.shape)
-            interpolated_points = torch.sum(index_points(points2, idx) * weight.view(B, N, 3, 1), dim=2)
+            interpolated_points = torch.sum(index_points(points2, idx) * weight.view(B, N, k, 1), dim=2)
 
         if points1 is not None:
             points1 = points1.permute(0, 2, 1)
@@ -0,0 +1,128 @@
+"""
+Density-aware ball query in PyTorch.
+
+Same interface as the ``QueryAndGroup`` / ``DynamicBallRadiusAdjustment`` of the
+``pointnet2`` CUDA extension, used by ``LocalGrouper`` and ``PointMambaEncoder``
+when the extension is not built, on any device:
+
+    rho_i = 1 / mean distance to the k_dense nearest points (knn.knn_query)
+    r_i   = max(radius * (1 + lambda_param * (1 - rho_i / mean(rho))), min_radius)
+
+then the first nsample points, in index order, with d^2 < r_i^2; missing slots
+are padded with the first one, or with point 0 when the ball is empty.  The
+selection masks the indices of the points outside the ball and keeps the
+nsample smallest (topk over the masked indices rather than a full sort), one
+block of centroids at a time so the memory is O(B * query_block * N).
+dataloader/point_precompute.py computes the same indices on CPU, in numpy.
+"""
+import torch
+import torch.nn as nn
+from .knn import knn_query
+from .PCM_utils import index_points
+
+
+def _default_block(xyz):
+    # centroids per tile: large tiles on GPU, cache sized ones on CPU
+    return 512 if xyz.is_cuda else 128
+
+
+@torch.no_grad()
+def density_radius(xyz, new_xyz, radius, lambda_param, k_dense, min_radius=1e-4):
+    """
+    Input:
+        xyz: all points, [B, N, 3]
+        new_xyz: centroids, [B, S, 3]
+    Return:
+        adjusted_radius: [B, S]
+    """
+    dist, _ = knn_query(k_dense, xyz, new_xyz, return_dist=True)
+    density = 1.0 / (dist.sqrt().mean(-1) + 1e-8)
+    adjusted = radius * (1 + lambda_param * (1 - density / density.mean(-1, keepdim=True)))
+    return adjusted.clamp(min=min_radius)
+
+
+@torch.no_grad()
+def ball_query(radius, nsample, xyz, new_xyz, query_block=None):
+    """
+    Input:
+        radius: ball radius, float or per centroid [B, S]
+        nsample: max sample number in local region
+        xyz: all points, [B, N, 3]
+        new_xyz: centroids, [B, S, 3]
+    Return:
+        group_idx: grouped points index, [B, S, nsample]
+    """
+    B, N, _ = xyz.shape
+    S = new_xyz.size(1)
+    if not torch.is_tensor(radius):
+        radius = torch.full((B, S), float(radius), device=xyz.device, dtype=xyz.dtype)
+    query_block = query_block or _default_block(xyz)
+    xyz_t = xyz.transpose(1, 2).contiguous()  # [B, 3, N]
+    index = torch.arange(N, device=xyz.device, dtype=torch.int32).view(1, 1, N)
+    outside = torch.full_like(index, N)
+    k = min(nsample, N)
+    idx_list = []
+    for start in range(0, S, query_block):
+        end = min(start + query_block, S)
+        # exact differences, in place: duplicate points must stay inside tiny balls
+        diff = new_xyz[:, start:end, 0].unsqueeze(-1) - xyz_t[:, 0].unsqueeze(1)
+        dist = diff.square_()
+        for c in range(1, xyz.size(-1)):
+            diff = new_xyz[:, start:end, c].unsqueeze(-1) - xyz_t[:, c].unsqueeze(1)
+            dist.addcmul_(diff, diff)
+        inside = dist < radius[:, start:end].unsqueeze(-1) ** 2
+        # points outside the ball get index N, the k smallest indices are the first k inside
+        key = torch.where(inside, index, outside)
+        idx_list.append(torch.topk(key, k, dim=-1, largest=False, sorted=True)[0].long())
+    group_idx = torch.cat(idx_list, dim=1)
+    first = group_idx[:, :, :1].masked_fill(group_idx[:, :, :1] == N, 0)
+    if k < nsample:
+        group_idx = torch.cat([group_idx, group_idx.new_full((B, S, nsample - k), N)], dim=-1)
+    return torch.where(group_idx == N, first, group_idx)
+
+
+class DynamicBallRadiusAdjustment(nn.Module):
+    def __init__(self, radius, lambda_param, k_dense):
+        super(DynamicBallRadiusAdjustment, self).__init__()
+        self.radius = radius
+        self.lambda_param = lambda_param
+        self.k_dense = k_dense
+
+    def forward(self, xyz, new_xyz):
+        """
+        :param xyz: [B, N, 3]
+        :param new_xyz: [B, S, 3]
+        :return: adjusted radius [B, S]
+        """
+        return density_radius(xyz, new_xyz, self.radius, self.lambda_param, self.k_dense)
+
+
+class QueryAndGroup(nn.Module):
+    def __init__(self, radius, nsample, lambda_param, k_dense, use_xyz=True, query_block=None):
+        """
+        :param radius: base ball radius
+        :param nsample: max sample number in local region
+        :param use_xyz: append the (absolute) coordinates of the neighbours to their features
+        """
+        super(QueryAndGroup, self).__init__()
+        self.nsample = nsample
+        self.use_xyz = use_xyz
+        self.query_block = query_block
+        self.radius_adjustment = DynamicBallRadiusAdjustment(radius, lambda_param, k_dense)
+
+    def forward(self, xyz, new_xyz, features=None):
+        """
+        :param xyz: [B, N, 3]
+        :param new_xyz: [B, S, 3]
+        :param features: [B, C, N]
+        :return: new_features [B, C+3, S, nsample] (features then xyz), adjusted radius [B, S]
+        """
+        adjusted_radius = self.radius_adjustment(xyz, new_xyz)
+        idx = ball_query(adjusted_radius, self.nsample, xyz, new_xyz, self.query_block)
+        grouped = []
+        if features is not None:
+            grouped.append(index_points(features.transpose(1, 2), idx))  # [B, S, nsample, C]
+        if self.use_xyz or features is None:
+            grouped.append(index_points(xyz, idx))  # [B, S, nsample, 3]
+        new_features = torch.cat(grouped, dim=-1).permute(0, 3, 1, 2)
+        return new_features, adjusted_radius
@@ -301,3 +301,115 @@ def decode(hilberts, num_dims, num_bits):
 
     # Return them in the expected shape.
     return flat_locs.reshape((*orig_shape, num_dims))
+
+
+class HilbertLUT:
+    """3D Hilbert encoder as a state machine over look up tables.
+
+    The loop of encode() applies, at every bit level, the same permutation and
+    inversion of the axes to all the lower bits, and the Gray decoding is a
+    prefix xor over all the bits: the (permutation, inversion, parity) reached
+    after the higher levels is a state, and each table maps a state and the
+    bits of steps levels of x, y and z to the next state and to the 3 * steps
+    bits of the code, as ``next_state << (3 * steps) | code``.
+    """
+
+    def __init__(self, steps=3):
+        self.steps = steps
+        out, next_state = self.level_table()
+        device = torch.device("cpu")
+
+        self._encode = {
+            device: tuple(self.steps_table(out, next_state, k) for k in range(1, steps + 1))
+        }
+
+    def encode_lut(self, device=torch.device("cpu")):
+        if device not in self._encode:
+            cpu = torch.device("cpu")
+            self._encode[device] = tuple(e.to(device) for e in self._encode[cpu])
+        return self._encode[device]
+
+    def level_table(self):
+        # one bit level of encode(): the bits of the level are raw[perm[d]] ^ inv[d]
+        start = ((0, 1, 2), (0, 0, 0), 0)
+        states, index = [start], {start: 0}
+        out, next_state = [], []
+        i = 0
+        while i < len(states):
+            perm, inv, parity = states[i]
+            out.append([]), next_state.append([])
+            for raw in range(8):
+                gray = [(raw >> (2 - perm[d]) & 1) ^ inv[d] for d in range(3)]
+                perm_, inv_, parity_, code = list(perm), list(inv), parity, 0
+                for d in range(3):
+                    if gray[d]:
+                        # invert the 0 dimension for lower bits
+                        inv_[0] ^= 1
+                    else:
+                        # exchange the lower bits with the 0 dimension
+                        perm_[0], perm_[d] = perm_[d], perm_[0]
+                        inv_[0], inv_[d] = inv_[d], inv_[0]
+                    parity_ ^= gray[d]
+                    code = code << 1 | parity_
+                state = (tuple(perm_), tuple(inv_), parity_)
+                if state not in index:
+                    index[state] = len(states)
+                    states.append(state)
+                out[i].append(code)
+                next_state[i].append(index[state])
+            i += 1
+        return torch.tensor(out, dtype=torch.int64), torch.tensor(next_state, dtype=torch.int64)
+
+    def steps_table(self, out, next_state, steps):
+        # entry state * 8 ** steps + (x << 2 * steps | y << steps | z), for the top level first
+        bits = torch.arange(8 ** steps, dtype=torch.int64)
+        state = torch.arange(out.shape[0], dtype=torch.int64)[:, None].repeat(1, 8 ** steps)
+        code = torch.zeros_like(state)
+        for level in range(steps - 1, -1, -1):
+            raw = (
+                ((bits >> (2 * steps + level)) & 1) << 2
+                | ((bits >> (steps + level)) & 1) << 1
+                | ((bits >> level) & 1)
+            )
+            code = code << 3 | out[state, raw]
+            state = next_state[state, raw]
+        return (state << (3 * steps) | code).flatten()
+
+
+_hilbert_lut = HilbertLUT()
+
+
+def xyz2key(x, y, z, depth=16):
+    """Encodes x, y, z coordinates to the same Hilbert integers as
+    encode(torch.stack([x, y, z], -1), 3, depth), with one table look up per
+    3 bit levels instead of the loop over the bits.
+
+    Params:
+    -------
+     x, y, z - Integer tensors of the same shape, from 0 to 2**depth-1.
+
+     depth - The number of bits for each dimension, at most 21.
+
+    Returns:
+    --------
+     An int64 tensor with the shape of x.
+    """
+    if depth > 21:
+        raise ValueError("depth=%d needs %d bits, more than an int64" % (depth, 3 * depth))
+
+    luts = _hilbert_lut.encode_lut(x.device)
+    x, y, z = x.long(), y.long(), z.long()
+    key = torch.zeros_like(x)
+    state = torch.zeros_like(x)
+
+    # the remaining levels on top, then steps levels per look up
+    steps = _hilbert_lut.steps
+    shift = depth
+    for k in ([depth % steps] if depth % steps else []) + [steps] * (depth // steps):
+        shift -= k
+        mask = (1 << k) - 1
+        bits = ((x >> shift) & mask) << (2 * k) | ((y >> shift) & mask) << k | ((z >> shift) & mask)
+        entry = luts[k - 1][state << (3 * k) | bits]
+        key = key << (3 * k) | (entry & ((1 << (3 * k)) - 1))
+        state = entry >> (3 * k)
+    return key
@@ -0,0 +1,194 @@
+"""
+k nearest neighbour search with bounded memory.
+
+The kNN helpers of the encoder, the refinement stacks and pointutil score a full
+B x S x N distance matrix before topk.  ``knn_query`` is the single entry point
+for all of them, with two backends:
+
+    * ``knn_tiled``: brute force over query x reference tiles, every tile keeps
+      its own top-k which is merged into the running top-k, so the memory is
+      O(B * query_block * (ref_block + k)) whatever N;
+    * ``knn_grid``: uniform grid hashing, for large clouds.  The reference points
+      are sorted by cell and every query only scores the points of the 3 x 3 x 3
+      cells around its own.  The cell size is the kth-neighbour distance of a few
+      sampled queries; a query whose kth distance exceeds its distance to the
+      faces of the block (the block may miss closer points) is searched by
+      brute force, so the result is exact.
+
+The search itself is not differentiable; the distances returned with
+``return_dist=True`` are recomputed from the selected points and carry gradients.
+"""
+import torch
+
+# reference points from which knn_query(backend='auto') switches to the grid
+GRID_MIN_POINTS = 16384
+
+
+def square_distance(src, dst):
+    """
+    Calculate Euclid distance between each two points.
+    dist = sum(src**2,dim=-1)+sum(dst**2,dim=-1)-2*src^T*dst
+    Input:
+        src: source points, [B, N, C]
+        dst: target points, [B, M, C]
+    Output:
+        dist: per-point square distance, [B, N, M]
+    """
+    B, N, _ = src.shape
+    _, M, _ = dst.shape
+    dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
+    dist += torch.sum(src ** 2, -1).view(B, N, 1)
+    dist += torch.sum(dst ** 2, -1).view(B, 1, M)
+    return dist.clamp_(min=0)
+
+
+def _merge_topk(dist, idx, new_dist, new_idx, nsample):
+    if dist is not None:
+        new_dist = torch.cat([dist, new_dist], dim=-1)
+        new_idx = torch.cat([idx, new_idx], dim=-1)
+    k = min(nsample, new_dist.size(-1))
+    new_dist, arg = torch.topk(new_dist, k, dim=-1, largest=False, sorted=False)
+    return new_dist, torch.gather(new_idx, -1, arg)
+
+
+@torch.no_grad()
+def knn_tiled(nsample, xyz, new_xyz, query_block=1024, ref_block=4096):
+    """
+    Input:
+        nsample: number of neighbours
+        xyz: all points, [B, N, C]
+        new_xyz: query points, [B, S, C]
+    Return:
+        dist: square distance, [B, S, nsample], ascending
+        group_idx: neighbour index, [B, S, nsample]
+    """
+    N = xyz.size(1)
+    assert nsample <= N, 'nsample %d larger than the number of points %d' % (nsample, N)
+    dist_list, idx_list = [], []
+    for start in range(0, new_xyz.size(1), query_block):
+        query = new_xyz[:, start:start + query_block]
+        dist, idx = None, None
+        for ref_start in range(0, N, ref_block):
+            tile = square_distance(query, xyz[:, ref_start:ref_start + ref_block])
+            tile_dist, tile_idx = torch.topk(tile, min(nsample, tile.size(-1)), dim=-1, largest=False, sorted=False)
+            dist, idx = _merge_topk(dist, idx, tile_dist, tile_idx + ref_start, nsample)
+        dist_list.append(dist)
+        idx_list.append(idx)
+    dist, idx = torch.cat(dist_list, dim=1), torch.cat(idx_list, dim=1)
+    dist, arg = torch.sort(dist, dim=-1)
+    return dist, torch.gather(idx, -1, arg)
+
+
+@torch.no_grad()
+def _knn_rows(nsample, xyz, batch, query, **kwargs):
+    # knn_tiled for the queries query [R, C] of the clouds xyz[batch], one cloud at a time
+    dist = query.new_empty(query.size(0), nsample)
+    idx = torch.empty(query.size(0), nsample, dtype=torch.long, device=query.device)
+    for b in torch.unique(batch).tolist():
+        rows = torch.nonzero(batch == b, as_tuple=True)[0]
+        row_dist, row_idx = knn_tiled(nsample, xyz[b:b + 1], query[rows].unsqueeze(0), **kwargs)
+        dist[rows], idx[rows] = row_dist[0], row_idx[0]
+    return dist, idx
+
+
+@torch.no_grad()
+def knn_grid(nsample, xyz, new_xyz, query_block=1024, max_candidates=8192, probe=64):
+    """
+    Uniform grid hashing, 3D points only
+    Input:
+        nsample: number of neighbours
+        xyz: all points, [B, N, 3]
+        new_xyz: query points, [B, S, 3]
+        max_candidates: candidates per query above which the grid is given up for knn_tiled
+        probe: sampled queries setting the cell size
+    Return:
+        dist: square distance, [B, S, nsample], ascending
+        group_idx: neighbour index, [B, S, nsample]
+    """
+    B, N, C = xyz.shape
+    S = new_xyz.size(1)
+    assert C == 3, 'knn_grid works on 3D points'
+    assert nsample <= N, 'nsample %d larger than the number of points %d' % (nsample, N)
+    device = xyz.device
+
+    # cell size: kth-neighbour distance of sampled queries, per cloud
+    probe_idx = torch.randint(0, S, (B, min(probe, S)), device=device)
+    probe_dist, _ = knn_tiled(nsample, xyz, torch.gather(new_xyz, 1, probe_idx.unsqueeze(-1).expand(-1, -1, 3)))
+    cell_size = torch.quantile(probe_dist[..., -1].sqrt(), 0.9, dim=-1).clamp(min=1e-6).view(B, 1, 1)
+
+    low = torch.minimum(xyz.min(1, keepdim=True)[0], new_xyz.min(1, keepdim=True)[0])
+    cell = torch.floor((xyz - low) / cell_size).long()  # [B, N, 3]
+    query_pos = (new_xyz - low) / cell_size
+    query_cell = torch.floor(query_pos).long()  # [B, S, 3]
+    # distance from the queries to the faces of their 3 x 3 x 3 block: points outside are further
+    frac = query_pos - query_cell
+    bound = (1 + torch.minimum(frac, 1 - frac).min(-1)[0]) * cell_size.view(B, 1)  # [B, S]
+    dims = torch.maximum(cell.flatten(0, 1).max(0)[0], query_cell.flatten(0, 1).max(0)[0]) + 1
+    D0, D1, D2 = [int(d) for d in dims.tolist()]
+
+    def cell_key(b, c):
+        return ((b * D0 + c[..., 0]) * D1 + c[..., 1]) * D2 + c[..., 2]
+
+    batch = torch.arange(B, device=device)
+    sorted_key, order = torch.sort(cell_key(batch.view(B, 1), cell).view(-1))
+
+    r = torch.arange(-1, 2, device=device)
+    offsets = torch.stack(torch.meshgrid(r, r, r, indexing='ij'), dim=-1).view(27, 3)
+    points = xyz.reshape(B * N, 3)
+
+    dist_list, idx_list = [], []
+    for start in range(0, S, query_block):
+        query = new_xyz[:, start:start + query_block]
+        neighbour_cell = query_cell[:, start:start + query_block].unsqueeze(2) + offsets  # [B, s, 27, 3]
+        valid = ((neighbour_cell >= 0) & (neighbour_cell < dims)).all(-1)
+        key = cell_key(batch.view(B, 1, 1), neighbour_cell)
+        first = torch.searchsorted(sorted_key, key.view(-1)).view(key.shape)
+        count = (torch.searchsorted(sorted_key, key.view(-1), right=True).view(key.shape) - first) * valid
+        max_count = int(count.max())
+        if 27 * max_count > max_candidates or 27 * max_count < nsample:
+            return knn_tiled(nsample, xyz, new_xyz, query_block=query_block)
+
+        slot = torch.arange(max_count, device=device)
+        cand = order[(first.unsqueeze(-1) + slot).clamp(max=B * N - 1)].flatten(2)  # [B, s, 27*max_count], into B*N
+        dist = torch.sum((points[cand] - query.unsqueeze(2)) ** 2, dim=-1)
+        dist = dist.masked_fill(~(slot < count.unsqueeze(-1)).flatten(2), float('inf'))
+        dist, arg = torch.topk(dist, nsample, dim=-1, largest=False, sorted=True)
+        idx = torch.gather(cand, -1, arg) - batch.view(B, 1, 1) * N
+
+        inexact = ~(dist[..., -1].sqrt() <= bound[:, start:start + query_block])
+        if bool(inexact.any()):
+            b, n = torch.nonzero(inexact, as_tuple=True)
+            row_dist, row_idx = _knn_rows(nsample, xyz, b, query[b, n], query_block=query_block)
+            dist = dist.index_put((b, n), row_dist)
+            idx = idx.index_put((b, n), row_idx)
+        dist_list.append(dist)
+        idx_list.append(idx)
+    return torch.cat(dist_list, dim=1), torch.cat(idx_list, dim=1)
+
+
+def knn_query(nsample, xyz, new_xyz, backend='auto', return_dist=False, **kwargs):
+    """
+    Input:
+        nsample: number of neighbours
+        xyz: all points, [B, N, C]
+        new_xyz: query points, [B, S, C]
+        backend: 'tiled', 'grid', or 'auto' (grid for 3D clouds of GRID_MIN_POINTS points or more)
+        return_dist: also return the square distances (differentiable)
+        kwargs: options of the backend
+    Return:
+        group_idx: neighbour index, [B, S, nsample], nearest first
+        (dist: square distance, [B, S, nsample], with return_dist)
+    """
+    if backend == 'auto':
+        backend = 'grid' if xyz.size(-1) == 3 and xyz.size(1) >= GRID_MIN_POINTS else 'tiled'
+    if backend == 'grid':
+        _, idx = knn_grid(nsample, xyz, new_xyz, **kwargs)
+    elif backend == 'tiled':
+        _, idx = knn_tiled(nsample, xyz, new_xyz, **kwargs)
+    else:
+        raise NotImplementedError(backend)
+    if not return_dist:
+        return idx
+    B, S, K = idx.shape
+    neighbours = torch.gather(xyz, 1, idx.view(B, S * K, 1).expand(-1, -1, xyz.size(-1))).view(B, S, K, -1)
+    return torch.sum((neighbours - new_xyz.unsqueeze(2)) ** 2, dim=-1), idx
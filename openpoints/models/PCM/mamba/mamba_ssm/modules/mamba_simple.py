@@ -13,12 +13,15 @@ from einops import rearrange, repeat
 try:
     from causal_conv1d import causal_conv1d_fn, causal_conv1d_update
 except ImportError:
-    causal_conv1d_fn, causal_conv1d_update = None
+    causal_conv1d_fn, causal_conv1d_update = None, None
 
 try:
     from mamba_ssm.ops.selective_scan_interface import selective_scan_fn, mamba_inner_fn, bimamba_inner_fn, mamba_inner_fn_no_out_proj
 except ImportError:
-    selective_scan_fn, mamba_inner_fn, bimamba_inner_fn, mamba_inner_fn_no_out_proj = None, None, None, None, None
+    selective_scan_fn, mamba_inner_fn, bimamba_inner_fn, mamba_inner_fn_no_out_proj = None, None, None, None
+
+from mamba_ssm.ops.selective_scan_interface import selective_scan_cuda
+from mamba_ssm.ops.cpu_interface import causal_conv1d_ref, selective_scan_cpu, mamba_inner_cpu_no_out_proj
 
 try:
     from mamba_ssm.ops.triton.selective_state_update import selective_state_update
@@ -28,7 +31,7 @@ except ImportError:
 try:
     from mamba_ssm.ops.triton.layernorm import RMSNorm, layer_norm_fn, rms_norm_fn
 except ImportError:
-    RMSNorm, layer_norm_fn, rms_norm_fn = None, None, None
+    from mamba_ssm.ops.cpu_interface import RMSNorm, layer_norm_fn, rms_norm_fn
 
 
 class Mamba(nn.Module):
@@ -50,7 +53,8 @@ class Mamba(nn.Module):
         layer_idx=None,
         device=None,
         dtype=None,
-        bimamba_type="none"
+        bimamba_type="none",
+        bimamba_fused=True,
     ):
         factory_kwargs = {"device": device, "dtype": dtype}
         super().__init__()
@@ -63,6 +67,7 @@ class Mamba(nn.Module):
         self.use_fast_path = use_fast_path
         self.layer_idx = layer_idx
         self.bimamba_type = bimamba_type
+        self.bimamba_fused = bimamba_fused
 
         self.in_proj = nn.Linear(self.d_model, self.d_inner * 2, bias=bias, **factory_kwargs)
 
@@ -176,8 +181,19 @@ class Mamba(nn.Module):
             xz = xz + rearrange(self.in_proj.bias.to(dtype=xz.dtype), "d -> d 1")
 
         A = -torch.exp(self.A_log.float())  # (d_inner, d_state)
+        # the fused kernels are CUDA only
+        use_kernels = xz.is_cuda and selective_scan_cuda is not None
+        # inference on the kernels: one conv and one scan launch for both directions. Training keeps
+        # mamba_inner_fn_no_out_proj, which recomputes the conv and delta in the backward pass, and on CPU
+        # (no launches to save) the two directions are as fast apart
+        fuse_directions = self.bimamba_type == "v2" and self.bimamba_fused and inference_params is None \
+            and use_kernels and not torch.is_grad_enabled()
+        if fuse_directions:
+            A_b = -torch.exp(self.A_b_log.float())
+            out = self.bidirectional_inner(xz, A, A_b, use_kernels)
+            out = F.linear(rearrange(out, "b d l -> b l d"), self.out_proj.weight, self.out_proj.bias)
         # In the backward pass we write dx and dz next to each other to avoid torch.cat
-        if self.use_fast_path and inference_params is None:  # Doesn't support outputting the states
+        elif self.use_fast_path and inference_params is None and use_kernels:  # Doesn't support outputting the states
             if self.bimamba_type == "v2":
                 A_b = -torch.exp(self.A_b_log.float())
                 out = mamba_inner_fn_no_out_proj(
@@ -224,12 +240,42 @@ class Mamba(nn.Module):
                     delta_bias=self.dt_proj.bias.float(),
                     delta_softplus=True,
                 )
+        elif self.bimamba_type == "v2" and inference_params is None:
+            # same as the fast path, in PyTorch
+            A_b = -torch.exp(self.A_b_log.float())
+            out = mamba_inner_cpu_no_out_proj(
+                xz,
+                self.conv1d.weight,
+                self.conv1d.bias,
+                self.x_proj.weight,
+                self.dt_proj.weight,
+                A,
+                None,
+                None,
+                self.D.float(),
+                delta_bias=self.dt_proj.bias.float(),
+                delta_softplus=True,
+            )
+            out_b = mamba_inner_cpu_no_out_proj(
+                xz.flip([-1]),
+                self.conv1d_b.weight,
+                self.conv1d_b.bias,
+                self.x_proj_b.weight,
+                self.dt_proj_b.weight,
+                A_b,
+                None,
+                None,
+                self.D_b.float(),
+                delta_bias=self.dt_proj_b.bias.float(),
+                delta_softplus=True,
+            )
+            out = F.linear(rearrange(out + out_b.flip([-1]), "b d l -> b l d"), self.out_proj.weight, self.out_proj.bias)
         else:
             x, z = xz.chunk(2, dim=1)
             # Compute short convolution
             if conv_state is not None:
                 conv_state.copy_(x[:, :, -self.d_conv :])  # Update state (B D W)
-            if causal_conv1d_fn is None:
+            if causal_conv1d_fn is None or not use_kernels:
                 x = self.act(self.conv1d(x)[..., :seqlen])
             else:
                 assert self.activation in ["silu", "swish"]
@@ -250,7 +296,7 @@ class Mamba(nn.Module):
             B = rearrange(B, "(b l) dstate -> b dstate l", l=seqlen).contiguous()
             C = rearrange(C, "(b l) dstate -> b dstate l", l=seqlen).contiguous()
             assert self.activation in ["silu", "swish"]
-            y = selective_scan_fn(
+            y = (selective_scan_fn if use_kernels else selective_scan_cpu)(
                 x,
                 dt,
                 A,
@@ -269,6 +315,47 @@ class Mamba(nn.Module):
             out = self.out_proj(y)
         return out
 
+    def bidirectional_inner(self, xz, A, A_b, use_kernels):
+        """
+        Both directions of bimamba v2 in one pass, same output as the two mamba_inner_fn_no_out_proj calls:
+        the reversed sequence is stacked along the channels, so the depthwise conv and the scan run once on
+        2 * d_inner channels (B and C in 2 groups), the x and dt projections of the two directions are one
+        bmm each, and z gates the sum of the two directions once, unflipped.
+        xz: (B, 2 * d_inner, L)
+        Returns: (B, d_inner, L)
+        """
+        seqlen = xz.shape[-1]
+        x, z = xz.chunk(2, dim=1)
+        x = torch.cat([x, x.flip([-1])], dim=1)  # (B 2D L)
+        conv_weight = rearrange(torch.cat([self.conv1d.weight, self.conv1d_b.weight], dim=0), "d 1 w -> d w")
+        conv_bias = torch.cat([self.conv1d.bias, self.conv1d_b.bias], dim=0) if self.conv1d.bias is not None else None
+        if use_kernels and causal_conv1d_fn is not None:
+            x = causal_conv1d_fn(x, conv_weight, conv_bias, self.activation)
+        else:
+            x = causal_conv1d_ref(x, conv_weight, conv_bias, self.activation)
+        x_dbl = torch.bmm(
+            rearrange(x, "b (two d) l -> two (b l) d", two=2),
+            torch.stack([self.x_proj.weight, self.x_proj_b.weight]).transpose(1, 2),
+        )  # (2 bl d)
+        dt, B, C = torch.split(x_dbl, [self.dt_rank, self.d_state, self.d_state], dim=-1)
+        dt = torch.bmm(torch.stack([self.dt_proj.weight, self.dt_proj_b.weight]), dt.transpose(1, 2))
+        dt = rearrange(dt, "two d (b l) -> b (two d) l", l=seqlen)
+        B = rearrange(B, "two (b l) dstate -> b two dstate l", l=seqlen).contiguous()
+        C = rearrange(C, "two (b l) dstate -> b two dstate l", l=seqlen).contiguous()
+        y = (selective_scan_fn if use_kernels else selective_scan_cpu)(
+            x,
+            dt,
+            torch.cat([A, A_b], dim=0),
+            B,
+            C,
+            torch.cat([self.D, self.D_b], dim=0).float(),
+            z=None,
+            delta_bias=torch.cat([self.dt_proj.bias, self.dt_proj_b.bias], dim=0).float(),
+            delta_softplus=True,
+        )
+        y, y_b = y.chunk(2, dim=1)
+        return (y + y_b.flip([-1])) * self.act(z)
+
     def step(self, hidden_states, conv_state, ssm_state):
         dtype = hidden_states.dtype
         assert hidden_states.shape[1] == 1, "Only support decoding with 1 token at a time for now"
@@ -0,0 +1,235 @@
+# Pure PyTorch versions of the fused Mamba ops, for CPU tensors and for builds without
+# the selective_scan_cuda / causal_conv1d_cuda extensions or Triton.
+
+import torch
+import torch.nn.functional as F
+
+from einops import rearrange
+
+from mamba_ssm.ops.selective_scan_interface import selective_scan_ref
+
+
+def causal_conv1d_ref(x, weight, bias=None, activation=None):
+    """
+    x: (batch, dim, seqlen)
+    weight: (dim, width)
+    bias: (dim,)
+
+    out: (batch, dim, seqlen)
+    """
+    if activation not in [None, "silu", "swish"]:
+        raise NotImplementedError("activation must be None, silu, or swish")
+    dtype_in = x.dtype
+    x = x.to(weight.dtype)
+    seqlen = x.shape[-1]
+    dim, width = weight.shape
+    out = F.conv1d(x, weight.unsqueeze(1), bias, padding=width - 1, groups=dim)
+    out = out[..., :seqlen]
+    return (out if activation is None else F.silu(out)).to(dtype=dtype_in)
+
+
+def _scan_chunk(deltaA, states, x, parallel=False):
+    """
+    In place scan of one chunk: states_t = deltaA_t * states_{t-1} + states_t, from states_{-1} = x
+    deltaA: (B l D N), overwritten when parallel
+    states: (B l D N), B * u on input, the states on output
+    x: (B D N)
+
+    last_state: (B D N)
+    """
+    if not parallel:
+        for i in range(states.shape[1]):
+            x = states[:, i].addcmul_(deltaA[:, i], x)
+        return x.clone()
+    # log-depth (Hillis-Steele) scan of the pairs (deltaA, states):
+    # (a2, b2) o (a1, b1) = (a2 * a1, a2 * b1 + b2), the right hand sides are computed before the writes
+    offset = 1
+    while offset < states.shape[1]:
+        states[:, offset:] = torch.addcmul(states[:, offset:], deltaA[:, offset:], states[:, :-offset])
+        deltaA[:, offset:] = deltaA[:, offset:] * deltaA[:, :-offset]
+        offset *= 2
+    # deltaA now holds the products from the start of the chunk
+    states.addcmul_(deltaA, x.unsqueeze(1))
+    return states[:, -1].clone()
+
+
+def selective_scan_cpu(u, delta, A, B, C, D=None, z=None, delta_bias=None, delta_softplus=False,
+                       return_last_state=False, chunk_size=64, parallel=False):
+    """
+    Same arguments and outputs as selective_scan_ref, for real A.
+    The sequence runs in chunks of chunk_size steps: the discretized A and B * u of a chunk are
+    computed at once in two (B chunk_size D N) buffers, reused from chunk to chunk, the scan runs in
+    place in the second one (_scan_chunk, sequential or log-depth with parallel) and the output of
+    the chunk is one contraction with C; the last state is carried to the next chunk.
+    Complex A, and inputs requiring grad (the buffers are written in place), go to selective_scan_ref.
+    """
+    requires_grad = torch.is_grad_enabled() and any(
+        t is not None and t.requires_grad for t in (u, delta, A, B, C, D, z, delta_bias))
+    if A.is_complex() or requires_grad:
+        return selective_scan_ref(u, delta, A, B, C, D, z=z, delta_bias=delta_bias,
+                                  delta_softplus=delta_softplus, return_last_state=return_last_state)
+    dtype_in = u.dtype
+    u = u.float()
+    delta = delta.float()
+    if delta_bias is not None:
+        delta = delta + delta_bias[..., None].float()
+    if delta_softplus:
+        delta = F.softplus(delta)
+    A = A.float()
+    batch, dim, seqlen = u.shape
+    dstate = A.shape[1]
+    # (B L D) and (B L G N), contiguous: the states of one step are contiguous.
+    # Variable B and C are in G groups (1 for (B N L)) of dim / G channels
+    delta_t = rearrange(delta, "b d l -> b l d").contiguous()
+    deltau_t = rearrange(delta * u, "b d l -> b l d").contiguous()
+    if B.dim() >= 3:
+        B = rearrange(B.float() if B.dim() == 4 else B.float().unsqueeze(1), "b g n l -> b l g n").contiguous()
+    if C.dim() >= 3:
+        C = rearrange(C.float() if C.dim() == 4 else C.float().unsqueeze(1), "b g n l -> b l g n").contiguous()
+    chunk_size = min(chunk_size, seqlen)
+    deltaA_buffer = u.new_empty((batch, chunk_size, dim, dstate))
+    states_buffer = torch.empty_like(deltaA_buffer)
+    x = u.new_zeros((batch, dim, dstate))
+    ys = []
+    for start in range(0, seqlen, chunk_size):
+        end = min(start + chunk_size, seqlen)
+        deltaA = deltaA_buffer[:, :end - start]
+        states = states_buffer[:, :end - start]
+        torch.mul(delta_t[:, start:end, :, None], A, out=deltaA).exp_()
+        if B.dim() == 2:
+            torch.mul(deltau_t[:, start:end, :, None], B.float(), out=states)
+        else:
+            G = B.shape[2]
+            torch.mul(rearrange(deltau_t[:, start:end], "b l (g h) -> b l g h 1", g=G), B[:, start:end, :, None],
+                      out=rearrange(states, "b l (g h) n -> b l g h n", g=G))
+        x = _scan_chunk(deltaA, states, x, parallel)
+        if C.dim() == 2:
+            ys.append(torch.einsum('bldn,dn->bdl', states, C.float()))
+        else:
+            G = C.shape[2]
+            y = torch.matmul(rearrange(states, "b l (g h) n -> b l g h n", g=G), C[:, start:end, :, :, None])
+            ys.append(rearrange(y, "b l g h 1 -> b (g h) l"))
+    y = torch.cat(ys, dim=-1)
+    out = y if D is None else y + u * rearrange(D, "d -> d 1")
+    if z is not None:
+        out = out * F.silu(z)
+    out = out.to(dtype=dtype_in)
+    return out if not return_last_state else (out, x)
+
+
+def mamba_inner_cpu_no_out_proj(
+    xz, conv1d_weight, conv1d_bias, x_proj_weight, delta_proj_weight,
+    A, B=None, C=None, D=None, delta_bias=None, B_proj_bias=None,
+    C_proj_bias=None, delta_softplus=True
+):
+    """
+    Forward of mamba_inner_fn_no_out_proj with causal_conv1d_ref and selective_scan_cpu
+    xz: (batch, dim, seqlen)
+
+    out: (batch, dim / 2, seqlen)
+    """
+    L = xz.shape[-1]
+    delta_rank = delta_proj_weight.shape[1]
+    d_state = A.shape[-1] * (1 if not A.is_complex() else 2)
+    x, z = xz.chunk(2, dim=1)
+    x = causal_conv1d_ref(x, rearrange(conv1d_weight, "d 1 w -> d w"), conv1d_bias, "silu")
+    x_dbl = F.linear(rearrange(x, 'b d l -> (b l) d'), x_proj_weight)  # (bl d)
+    delta = delta_proj_weight @ x_dbl[:, :delta_rank].t()
+    delta = rearrange(delta, "d (b l) -> b d l", l=L)
+    if B is None:  # variable B
+        B = x_dbl[:, delta_rank:delta_rank + d_state]  # (bl d)
+        if B_proj_bias is not None:
+            B = B + B_proj_bias.to(dtype=B.dtype)
+        if not A.is_complex():
+            B = rearrange(B, "(b l) dstate -> b dstate l", l=L).contiguous()
+        else:
+            B = rearrange(B, "(b l) (dstate two) -> b dstate (l two)", l=L, two=2).contiguous()
+    if C is None:  # variable C
+        C = x_dbl[:, -d_state:]  # (bl d)
+        if C_proj_bias is not None:
+            C = C + C_proj_bias.to(dtype=C.dtype)
+        if not A.is_complex():
+            C = rearrange(C, "(b l) dstate -> b dstate l", l=L).contiguous()
+        else:
+            C = rearrange(C, "(b l) (dstate two) -> b dstate (l two)", l=L, two=2).contiguous()
+    return selective_scan_cpu(x, delta, A, B, C, D, z=z, delta_bias=delta_bias, delta_softplus=delta_softplus)
+
+
+def layer_norm_ref(x, weight, bias, residual=None, eps=1e-6, prenorm=False, upcast=False):
+    dtype = x.dtype
+    if upcast:
+        weight = weight.float()
+        bias = bias.float() if bias is not None else None
+    if upcast:
+        x = x.float()
+        residual = residual.float() if residual is not None else residual
+    if residual is not None:
+        x = (x + residual).to(x.dtype)
+    out = F.layer_norm(x.to(weight.dtype), x.shape[-1:], weight=weight, bias=bias, eps=eps).to(
+        dtype
+    )
+    return out if not prenorm else (out, x)
+
+
+def rms_norm_ref(x, weight, bias, residual=None, eps=1e-6, prenorm=False, upcast=False):
+    dtype = x.dtype
+    if upcast:
+        weight = weight.float()
+        bias = bias.float() if bias is not None else None
+    if upcast:
+        x = x.float()
+        residual = residual.float() if residual is not None else residual
+    if residual is not None:
+        x = (x + residual).to(x.dtype)
+    rstd = torch.rsqrt((x.square()).mean(dim=-1, keepdim=True) + eps)
+    out = (x * rstd * weight) + bias if bias is not None else (x * rstd * weight)
+    out = out.to(dtype)
+    return out if not prenorm else (out, x)
+
+
+def layer_norm_fn(
+    x,
+    weight,
+    bias,
+    residual=None,
+    eps=1e-6,
+    prenorm=False,
+    residual_in_fp32=False,
+    is_rms_norm=False,
+):
+    """
+    Fused add + norm of ops.triton.layernorm: the norm is computed in fp32, the residual
+    is returned in the dtype of residual, else fp32 with residual_in_fp32, else the dtype of x
+    """
+    residual_dtype = residual.dtype if residual is not None else (torch.float32 if residual_in_fp32 else x.dtype)
+    norm_ref = rms_norm_ref if is_rms_norm else layer_norm_ref
+    out, residual_out = norm_ref(x, weight, bias, residual=residual, eps=eps, prenorm=True, upcast=True)
+    return out if not prenorm else (out, residual_out.to(residual_dtype))
+
+
+def rms_norm_fn(x, weight, bias, residual=None, prenorm=False, residual_in_fp32=False, eps=1e-6):
+    return layer_norm_fn(x, weight, bias, residual, eps, prenorm, residual_in_fp32, True)
+
+
+class RMSNorm(torch.nn.Module):
+    def __init__(self, hidden_size, eps=1e-5, device=None, dtype=None):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        self.eps = eps
+        self.weight = torch.nn.Parameter(torch.empty(hidden_size, **factory_kwargs))
+        self.register_parameter("bias", None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        torch.nn.init.ones_(self.weight)
+
+    def forward(self, x, residual=None, prenorm=False, residual_in_fp32=False):
+        return rms_norm_fn(
+            x,
+            self.weight,
+            self.bias,
+            residual=residual,
+            eps=self.eps,
+            prenorm=prenorm,
+            residual_in_fp32=residual_in_fp32,
+        )
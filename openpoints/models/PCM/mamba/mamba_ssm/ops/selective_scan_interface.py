@@ -6,9 +6,17 @@ from torch.cuda.amp import custom_bwd, custom_fwd
 
 from einops import rearrange, repeat
 
-from causal_conv1d import causal_conv1d_fn
-import causal_conv1d_cuda
-import selective_scan_cuda
+try:
+    from causal_conv1d import causal_conv1d_fn
+    import causal_conv1d_cuda
+except ImportError:
+    causal_conv1d_fn, causal_conv1d_cuda = None, None
+
+try:
+    import selective_scan_cuda
+except ImportError:
+    # CPU only builds: see cpu_interface.py
+    selective_scan_cuda = None
 
 
 class SelectiveScanFn(torch.autograd.Function):
@@ -15,37 +15,8 @@ from torch.cuda.amp import custom_fwd, custom_bwd
 import triton
 import triton.language as tl
 
-
-def layer_norm_ref(x, weight, bias, residual=None, eps=1e-6, prenorm=False, upcast=False):
-    dtype = x.dtype
-    if upcast:
-        weight = weight.float()
-        bias = bias.float() if bias is not None else None
-    if upcast:
-        x = x.float()
-        residual = residual.float() if residual is not None else residual
-    if residual is not None:
-        x = (x + residual).to(x.dtype)
-    out = F.layer_norm(x.to(weight.dtype), x.shape[-1:], weight=weight, bias=bias, eps=eps).to(
-        dtype
-    )
-    return out if not prenorm else (out, x)
-
-
-def rms_norm_ref(x, weight, bias, residual=None, eps=1e-6, prenorm=False, upcast=False):
-    dtype = x.dtype
-    if upcast:
-        weight = weight.float()
-        bias = bias.float() if bias is not None else None
-    if upcast:
-        x = x.float()
-        residual = residual.float() if residual is not None else residual
-    if residual is not None:
-        x = (x + residual).to(x.dtype)
-    rstd = 1 / torch.sqrt((x.square()).mean(dim=-1, keepdim=True) + eps)
-    out = (x * rstd * weight) + bias if bias is not None else (x * rstd * weight)
-    out = out.to(dtype)
-    return out if not prenorm else (out, x)
+from mamba_ssm.ops import cpu_interface
+from mamba_ssm.ops.cpu_interface import layer_norm_ref, rms_norm_ref
 
 
 @triton.autotune(
@@ -471,10 +442,14 @@ def layer_norm_fn(
     residual_in_fp32=False,
     is_rms_norm=False,
 ):
+    if not x.is_cuda:
+        return cpu_interface.layer_norm_fn(x, weight, bias, residual, eps, prenorm, residual_in_fp32, is_rms_norm)
     return LayerNormFn.apply(x, weight, bias, residual, eps, prenorm, residual_in_fp32, is_rms_norm)
 
 
 def rms_norm_fn(x, weight, bias, residual=None, prenorm=False, residual_in_fp32=False, eps=1e-6):
+    if not x.is_cuda:
+        return cpu_interface.rms_norm_fn(x, weight, bias, residual, prenorm, residual_in_fp32, eps)
     return LayerNormFn.apply(x, weight, bias, residual, eps, prenorm, residual_in_fp32, True)
 
 
@@ -12,6 +12,8 @@ from einops import rearrange
 from mamba_ssm.ops.selective_scan_interface import selective_scan_fn, selective_scan_ref
 from mamba_ssm.ops.selective_scan_interface import mamba_inner_fn, mamba_inner_ref
 from mamba_ssm.ops.selective_scan_interface import bimamba_inner_fn, bimamba_inner_ref
+from mamba_ssm.ops.cpu_interface import selective_scan_cpu
+from mamba_ssm.modules.mamba_simple import Mamba
 
 
 # @pytest.mark.parametrize('wtype', [torch.float32, torch.complex64])
@@ -413,11 +415,104 @@ def test_bimamba_inner_fn_grad_check(is_variable_B, is_variable_C, seqlen, itype
     print(f'* {gradok} check_gradient_numerical bimamba_inner_fn')
 
 
+@pytest.mark.parametrize('parallel', [False, True])
+# chunk_size 64: one partial chunk, whole chunks and a partial last chunk, longer than one chunk
+@pytest.mark.parametrize('seqlen', [37, 128, 200])
+@pytest.mark.parametrize("return_last_state", [False, True])
+@pytest.mark.parametrize('has_delta_bias', [False, True])
+@pytest.mark.parametrize('delta_softplus', [False, True])
+@pytest.mark.parametrize('has_z', [False, True])
+@pytest.mark.parametrize('has_D', [False, True])
+@pytest.mark.parametrize("varBC_groups", [1, 2])
+@pytest.mark.parametrize("is_variable_C", [False, True])
+@pytest.mark.parametrize("is_variable_B", [False, True])
+def test_selective_scan_cpu(is_variable_B, is_variable_C, varBC_groups, has_D, has_z, has_delta_bias,
+                            delta_softplus, return_last_state, seqlen, parallel):
+    if varBC_groups > 1 and (not is_variable_B or not is_variable_C):
+        pytest.skip()  # This config is not applicable
+    device = 'cpu'
+    rtol, atol = (6e-4, 2e-3)
+    torch.random.manual_seed(0)
+    batch_size = 2
+    dim = 4
+    dstate = 8
+    A = -0.5 * torch.rand(dim, dstate, device=device)
+    B_shape = (dim, dstate) if not is_variable_B else (
+        (batch_size, dstate, seqlen) if varBC_groups == 1 else (batch_size, varBC_groups, dstate, seqlen))
+    B = torch.randn(*B_shape, device=device)
+    C_shape = (dim, dstate) if not is_variable_C else (
+        (batch_size, dstate, seqlen) if varBC_groups == 1 else (batch_size, varBC_groups, dstate, seqlen))
+    C = torch.randn(*C_shape, device=device)
+    D = torch.randn(dim, device=device) if has_D else None
+    z = torch.randn(batch_size, dim, seqlen, device=device) if has_z else None
+    delta_bias = 0.5 * torch.rand(dim, device=device) if has_delta_bias else None
+    u = torch.randn(batch_size, dim, seqlen, device=device)
+    delta = 0.5 * torch.rand(batch_size, dim, seqlen, device=device)
+    out, *rest = selective_scan_cpu(
+        u, delta, A, B, C, D, z=z,
+        delta_bias=delta_bias, delta_softplus=delta_softplus,
+        return_last_state=return_last_state, chunk_size=64, parallel=parallel
+    )
+    out_ref, *rest_ref = selective_scan_ref(
+        u, delta, A, B, C, D, z=z,
+        delta_bias=delta_bias, delta_softplus=delta_softplus,
+        return_last_state=return_last_state
+    )
+    print(f'Output max diff: {(out - out_ref).abs().max().item()}')
+    assert out.shape == out_ref.shape
+    assert torch.allclose(out, out_ref, rtol=rtol, atol=atol)
+    if return_last_state:
+        print(f'State max diff: {(rest[0] - rest_ref[0]).abs().max().item()}')
+        assert torch.allclose(rest[0], rest_ref[0], rtol=rtol, atol=atol)
+
+
+@pytest.mark.parametrize("varBC_groups", [1, 2])
+@pytest.mark.parametrize('seqlen', [100])
+def test_selective_scan_cpu_backward(seqlen, varBC_groups):
+    # the chunked scan writes its buffers in place, inputs requiring grad take selective_scan_ref
+    device = 'cpu'
+    torch.random.manual_seed(0)
+    batch_size, dim, dstate = 2, 4, 8
+    A = (-0.5 * torch.rand(dim, dstate, device=device)).requires_grad_()
+    B = torch.randn(batch_size, varBC_groups, dstate, seqlen, device=device, requires_grad=True)
+    C = torch.randn(batch_size, varBC_groups, dstate, seqlen, device=device, requires_grad=True)
+    D = torch.randn(dim, device=device, requires_grad=True)
+    z = torch.randn(batch_size, dim, seqlen, device=device, requires_grad=True)
+    delta_bias = (0.5 * torch.rand(dim, device=device)).requires_grad_()
+    u = torch.randn(batch_size, dim, seqlen, device=device, requires_grad=True)
+    delta = (0.5 * torch.rand(batch_size, dim, seqlen, device=device)).requires_grad_()
+    inputs = [A, B, C, D, z, delta_bias, u, delta]
+    inputs_ref = [t.detach().clone().requires_grad_() for t in inputs]
+
+    def scan(fn, A, B, C, D, z, delta_bias, u, delta):
+        return fn(u, delta, A, B, C, D, z=z, delta_bias=delta_bias, delta_softplus=True)
+
+    out = scan(selective_scan_cpu, *inputs)
+    out_ref = scan(selective_scan_ref, *inputs_ref)
+    assert torch.allclose(out, out_ref)
+    g = torch.randn_like(out)
+    out.backward(g)
+    out_ref.backward(g)
+    for t, t_ref in zip(inputs, inputs_ref):
+        assert torch.allclose(t.grad, t_ref.grad)
+
+
+def test_mamba_cpu_backward():
+    # Mamba.forward without the CUDA kernels: causal_conv1d_ref and the PyTorch selective scans
+    torch.random.manual_seed(0)
+    model = Mamba(32, bimamba_type="v2")
+    hidden_states = torch.randn(2, 64, 32, requires_grad=True)
+    out = model(hidden_states)
+    out.sum().backward()
+    assert hidden_states.grad is not None and torch.isfinite(hidden_states.grad).all()
+    for name, param in model.named_parameters():
+        assert param.grad is not None and torch.isfinite(param.grad).all(), name
 
-# test_bimamba_inner_fn(True, True, 128, torch.float32, torch.float32)
-# test_mamba_inner_fn(True, True, 128, torch.float32, torch.float32)
-test_bimamba_inner_fn_grad_check(True, True, 128, torch.float32, torch.float32)
 
-# input = (torch.randn(20,20,dtype=torch.double,requires_grad=True), torch.randn(30,20,dtype=torch.double,requires_grad=True))
-# test = gradcheck(torch.nn.functional.linear, input, eps=1e-6, atol=1e-4)
-# print(test)
\ No newline at end of file
+if __name__ == '__main__':
+    # test_bimamba_inner_fn(True, True, 128, torch.float32, torch.float32)
+    # test_mamba_inner_fn(True, True, 128, torch.float32, torch.float32)
+    test_bimamba_inner_fn_grad_check(True, True, 128, torch.float32, torch.float32)
+    # input = (torch.randn(20,20,dtype=torch.double,requires_grad=True), torch.randn(30,20,dtype=torch.double,requires_grad=True))
+    # test = gradcheck(torch.nn.functional.linear, input, eps=1e-6, atol=1e-4)
+    # print(test)
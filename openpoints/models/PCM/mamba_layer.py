@@ -3,7 +3,11 @@ import torch.nn as nn
 from functools import partial
 
 from mamba_ssm.modules.mamba_simple import Mamba
-from mamba_ssm.ops.triton.layernorm import RMSNorm, layer_norm_fn, rms_norm_fn
+try:
+    from mamba_ssm.ops.triton.layernorm import RMSNorm, layer_norm_fn, rms_norm_fn
+except ImportError:
+    # no Triton: PyTorch norms, see mamba_ssm/ops/cpu_interface.py
+    from mamba_ssm.ops.cpu_interface import RMSNorm, layer_norm_fn, rms_norm_fn
 from timm.models.layers import DropPath
 
 class MambaBlock(nn.Module):
@@ -4,7 +4,7 @@ https://github.com/Pointcept/Pointcept
 """
 import torch
 from .z_order import xyz2key as z_order_encode_
-from .hilbert import encode as hilbert_encode_
+from .hilbert import xyz2key as hilbert_encode_
 from addict import Dict
 
 class Point(Dict):
@@ -179,5 +179,7 @@ def z_order_encode(grid_coord: torch.Tensor, depth: int = 16):
 
 
 def hilbert_encode(grid_coord: torch.Tensor, depth: int = 16):
-    return hilbert_encode_(grid_coord, num_dims=3, num_bits=depth)
+    x, y, z = grid_coord[:, 0].long(), grid_coord[:, 1].long(), grid_coord[:, 2].long()
+    # look up tables, same code as hilbert.encode(grid_coord, num_dims=3, num_bits=depth)
+    return hilbert_encode_(x, y, z, depth=depth)
 
@@ -0,0 +1,44 @@
+import torch
+import pytest
+
+from openpoints.models.PCM.hilbert import encode, xyz2key
+from openpoints.models.PCM.serialization import hilbert_encode
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+@pytest.mark.parametrize('device', DEVICES)
+# depths not divisible by 3 start with a 1 or 2 level table
+@pytest.mark.parametrize('depth', list(range(1, 22)))
+def test_xyz2key(depth, device):
+    torch.random.manual_seed(0)
+    grid_coord = torch.randint(0, 2 ** depth, (2000, 3), device=device)
+    # the corners of the grid
+    corners = torch.tensor([[i >> 2 & 1, i >> 1 & 1, i & 1] for i in range(8)], device=device) * (2 ** depth - 1)
+    grid_coord = torch.cat([grid_coord, corners])
+    code = xyz2key(grid_coord[:, 0], grid_coord[:, 1], grid_coord[:, 2], depth=depth)
+    assert code.dtype == torch.int64
+    assert torch.equal(code, encode(grid_coord, num_dims=3, num_bits=depth))
+
+
+@pytest.mark.parametrize('depth', [2, 3])
+def test_xyz2key_curve(depth):
+    # all the cells of the grid, each code once, consecutive codes in neighbouring cells
+    r = torch.arange(2 ** depth)
+    grid_coord = torch.stack(torch.meshgrid(r, r, r, indexing='ij'), dim=-1).view(-1, 3)
+    code = xyz2key(grid_coord[:, 0], grid_coord[:, 1], grid_coord[:, 2], depth=depth)
+    assert torch.equal(torch.sort(code)[0], torch.arange(2 ** (3 * depth)))
+    curve = grid_coord[torch.argsort(code)]
+    assert ((curve[1:] - curve[:-1]).abs().sum(-1) == 1).all()
+
+
+def test_hilbert_encode():
+    torch.random.manual_seed(0)
+    grid_coord = torch.randint(0, 2 ** 10, (2000, 3))
+    assert torch.equal(hilbert_encode(grid_coord, depth=16), encode(grid_coord, num_dims=3, num_bits=16))
+
+
+def test_xyz2key_depth():
+    x = torch.zeros(4, dtype=torch.long)
+    with pytest.raises(ValueError):
+        xyz2key(x, x, x, depth=22)
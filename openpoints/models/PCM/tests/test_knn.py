@@ -0,0 +1,73 @@
+import torch
+import pytest
+
+from openpoints.models.PCM.knn import knn_query, knn_tiled, knn_grid
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+def dense_knn_dist(nsample, xyz, new_xyz):
+    # exact square distances of the nsample nearest points, ascending
+    dist = torch.sum((new_xyz.unsqueeze(2) - xyz.unsqueeze(1)) ** 2, dim=-1)
+    return torch.topk(dist, nsample, dim=-1, largest=False, sorted=True)[0]
+
+
+def check_knn(idx, nsample, xyz, new_xyz):
+    # ties (duplicate points) may pick different indices: compare the distances of the selected points
+    B, S, K = idx.shape
+    assert K == nsample
+    assert idx.min() >= 0 and idx.max() < xyz.size(1)
+    assert (torch.sort(idx, dim=-1)[0].diff(dim=-1) != 0).all(), 'a neighbour is selected twice'
+    neighbours = torch.gather(xyz, 1, idx.view(B, S * K, 1).expand(-1, -1, 3)).view(B, S, K, 3)
+    dist = torch.sort(torch.sum((neighbours - new_xyz.unsqueeze(2)) ** 2, dim=-1), dim=-1)[0]
+    torch.testing.assert_close(dist, dense_knn_dist(nsample, xyz, new_xyz), rtol=1e-5, atol=1e-6)
+
+
+def make_cloud(case, B, N, S, device):
+    xyz = torch.rand(B, N, 3, device=device)
+    new_xyz = xyz[:, torch.randperm(N, device=device)[:S]]
+    if case == 'outside':
+        # queries inside and up to 0.2 outside the bounding box of the reference points
+        new_xyz = torch.rand(B, S, 3, device=device) * 1.4 - 0.2
+    elif case == 'duplicates':
+        # every point repeated 4 times
+        xyz = xyz[:, :N // 4].repeat(1, 4, 1)
+        new_xyz = xyz[:, torch.randperm(N, device=device)[:S]]
+    return xyz, new_xyz
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('case', ['uniform', 'outside', 'duplicates'])
+# smaller than ref_block, several ref_block tiles and query_block tiles
+@pytest.mark.parametrize('N, S, tiles', [(100, 30, {}), (1000, 300, {'query_block': 128, 'ref_block': 256})])
+@pytest.mark.parametrize('nsample', [1, 12])
+def test_knn_tiled(nsample, N, S, tiles, case, device):
+    torch.random.manual_seed(0)
+    xyz, new_xyz = make_cloud(case, 2, N, S, device)
+    dist, idx = knn_tiled(nsample, xyz, new_xyz, **tiles)
+    check_knn(idx, nsample, xyz, new_xyz)
+    torch.testing.assert_close(dist, dense_knn_dist(nsample, xyz, new_xyz), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('case', ['uniform', 'outside', 'duplicates'])
+@pytest.mark.parametrize('N, S', [(100, 30), (8192, 1024)])
+@pytest.mark.parametrize('nsample', [1, 16])
+def test_knn_grid(nsample, N, S, case, device):
+    torch.random.manual_seed(0)
+    xyz, new_xyz = make_cloud(case, 2, N, S, device)
+    _, idx = knn_grid(nsample, xyz, new_xyz, query_block=256)
+    check_knn(idx, nsample, xyz, new_xyz)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('backend', ['tiled', 'grid'])
+def test_knn_query_dist(backend, device):
+    torch.random.manual_seed(0)
+    xyz, new_xyz = make_cloud('uniform', 2, 2048, 256, device)
+    xyz.requires_grad_()
+    dist, idx = knn_query(16, xyz, new_xyz, backend=backend, return_dist=True)
+    check_knn(idx, 16, xyz.detach(), new_xyz.detach())
+    torch.testing.assert_close(dist.detach(), dense_knn_dist(16, xyz.detach(), new_xyz.detach()), rtol=1e-5, atol=1e-6)
+    dist.sum().backward()
+    assert xyz.grad is not None
@@ -7,7 +7,10 @@ import copy, logging
 import torch
 import torch.nn as nn
 from torch.autograd import Function
-from openpoints.cpp import pointnet2_cuda
+try:
+    from openpoints.cpp import pointnet2_cuda
+except ImportError:
+    pointnet2_cuda = None
 
 class KNN(nn.Module):
     def __init__(self, neighbors, transpose_mode=True):
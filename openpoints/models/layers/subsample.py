@@ -5,7 +5,12 @@ import torch
 import torch.nn as nn
 from torch.autograd import Function
 import math
-from openpoints.cpp.pointnet2_batch import pointnet2_cuda
+
+try:
+    from openpoints.cpp.pointnet2_batch import pointnet2_cuda
+except ImportError:
+    # CPU only builds: furthest_point_sample runs in PyTorch
+    pointnet2_cuda = None
 
 
 class BaseSampler(ABC):
@@ -102,7 +107,43 @@ class FurthestPointSampling(Function):
         return None, None
 
 
-furthest_point_sample = FurthestPointSampling.apply
+def furthest_point_sample_torch(xyz: torch.Tensor, npoint: int) -> torch.Tensor:
+    """
+    Furthest point sampling in PyTorch, same output as the CUDA kernel (starts at point 0)
+    :param xyz: (B, N, 3)
+    :param npoint: int, number of features in the sampled set
+    :return:
+         output: (B, npoint) int tensor containing the set (idx)
+    """
+    B, N, _ = xyz.size()
+    xyz_t = xyz.detach().float().transpose(1, 2).contiguous()  # (B, 3, N), one coordinate per row
+    batch = torch.arange(B, device=xyz.device)
+    output = torch.zeros(B, npoint, dtype=torch.int32, device=xyz.device)
+    temp = torch.full((B, N), 1e10, device=xyz.device)
+    dist = torch.empty_like(temp)
+    diff = torch.empty_like(temp)
+    farthest = torch.zeros(B, dtype=torch.long, device=xyz.device)
+    for i in range(npoint):
+        output[:, i] = farthest
+        # in place, per coordinate: no (B, N, 3) temporaries in the loop
+        centroid = xyz_t[batch, :, farthest]  # (B, 3)
+        torch.sub(xyz_t[:, 0], centroid[:, :1], out=dist)
+        dist.square_()
+        for c in range(1, 3):
+            torch.sub(xyz_t[:, c], centroid[:, c:c + 1], out=diff)
+            dist.addcmul_(diff, diff)
+        torch.minimum(temp, dist, out=temp)
+        farthest = torch.argmax(temp, dim=-1)
+    return output
+
+
+def furthest_point_sample(xyz: torch.Tensor, npoint: int) -> torch.Tensor:
+    """
+    CUDA kernel for CUDA tensors when the extension is built, furthest_point_sample_torch otherwise
+    """
+    if xyz.is_cuda and pointnet2_cuda is not None:
+        return FurthestPointSampling.apply(xyz, npoint)
+    return furthest_point_sample_torch(xyz, npoint)
 
 
 class GatherOperation(Function):
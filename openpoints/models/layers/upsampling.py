@@ -4,7 +4,10 @@ from torch.autograd import Function
 import torch
 import torch.nn as nn
 
-from openpoints.cpp.pointnet2_batch import pointnet2_cuda
+try:
+    from openpoints.cpp.pointnet2_batch import pointnet2_cuda
+except ImportError:
+    pointnet2_cuda = None
 from openpoints.models.layers import create_convblock1d
 
 
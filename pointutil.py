@@ -6,37 +6,21 @@ from time import time
 import numpy as np
 
 from openpoints.models.PCM.PCM_utils import index_points
+from openpoints.models.PCM.knn import knn_query, square_distance
 from openpoints.models.layers import furthest_point_sample
-from pointnet2 import pointnet2_utils
+try:
+    from pointnet2 import pointnet2_utils
+
+    has_pointnet2 = True
+except ImportError:
+    pointnet2_utils = None
+    has_pointnet2 = False
 # import pytorch3d.ops as torch3d
 
 LEAKY_RATE = 0.1
 use_bn = False
 
 
-def square_distance(src, dst):
-    """
-    Calculate Euclid distance between each two points.
-
-    src^T * dst = xn * xm + yn * ym + zn * zm；
-    sum(src^2, dim=-1) = xn*xn + yn*yn + zn*zn;
-    sum(dst^2, dim=-1) = xm*xm + ym*ym + zm*zm;
-    dist = (xn - xm)^2 + (yn - ym)^2 + (zn - zm)^2
-         = sum(src**2,dim=-1)+sum(dst**2,dim=-1)-2*src^T*dst
-
-    Input:
-        src: source points, [B, N, C]
-        dst: target points, [B, M, C]
-    Output:
-        dist: per-point square distance, [B, N, M]
-    """
-    B, N, _ = src.shape
-    _, M, _ = dst.shape
-    dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
-    dist += torch.sum(src ** 2, -1).view(B, N, 1)
-    dist += torch.sum(dst ** 2, -1).view(B, 1, M)
-    return dist
-
 def knn_point(nsample, xyz, new_xyz):
     """
     Input:
@@ -46,9 +30,7 @@ def knn_point(nsample, xyz, new_xyz):
     Return:
         group_idx: grouped points index, [B, S, nsample]
     """
-    sqrdists = square_distance(new_xyz, xyz)
-    _, group_idx = torch.topk(sqrdists, nsample, dim = -1, largest=False, sorted=False)
-    return group_idx
+    return knn_query(nsample, xyz, new_xyz)
 
 def index_points_gather(points, fps_idx):
     """
@@ -59,6 +41,8 @@ def index_points_gather(points, fps_idx):
         new_points:, indexed points data, [B, S, C]
     """
 
+    if not (points.is_cuda and has_pointnet2):
+        return index_points(points, fps_idx.long())
     points_flipped = points.permute(0, 2, 1).contiguous()
     new_points = pointnet2_utils.gather_operation(points_flipped, fps_idx)
     return new_points.permute(0, 2, 1).contiguous()
@@ -71,6 +55,8 @@ def index_points_group(points, knn_idx):
     Return:
         new_points:, indexed points data, [B, N, K, C]
     """
+    if not (points.is_cuda and has_pointnet2):
+        return index_points(points, knn_idx.long())
     points_flipped = points.permute(0, 2, 1).contiguous()
     new_points = pointnet2_utils.grouping_operation(points_flipped, knn_idx.int()).permute(0, 2, 3, 1)
 
@@ -286,8 +272,7 @@ class PointNetSetAbstraction(nn.Module):
 
         if self.knn:
             # sqrdists = square_distance(new_xyz.transpose(2, 1).contiguous(), xyz_t)
-            sqrdists = square_distance(new_xyz.contiguous(), xyz_t)
-            dists, knn_idx = torch.topk(sqrdists, self.nsample, dim = -1, largest=False, sorted=False)
+            knn_idx = knn_query(self.nsample, xyz_t, new_xyz.contiguous())
             neighbor_xyz = index_points_group(xyz_t, knn_idx)
             direction_xyz = neighbor_xyz - new_xyz.view(B, self.npoint, 1, C)
             # direction_xyz = neighbor_xyz - new_xyz.transpose(1,2).view(B, self.npoint, 1, C)
@@ -9,10 +9,6 @@ import pdb
 from tqdm import tqdm
 import numpy as np
 import importlib
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from PIL import Image
 
 import torch
 import torch.nn as nn
@@ -23,6 +19,7 @@ import torch.optim.lr_scheduler as lr_scheduler
 import torch.utils.data
 import torch.nn.functional as F
 from torch.autograd import Variable
+from dataloader.device_loader import make_dataloader, DevicePrefetcher
 
 
 
@@ -32,6 +29,11 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--batchSize', type=int, default=32, help='input batch size')
 # parser.add_argument('--workers', type=int, default=8, help='number of data loading workers')
 parser.add_argument('--workers', type=int, default=8, help='number of data loading workers')
+parser.add_argument('--prefetch_factor', type=int, default=2, help='batches loaded in advance by each worker')
+parser.add_argument('--pin_memory', type=int, default=1, help='page-locked batches for asynchronous copies to the GPU')
+parser.add_argument('--persistent_workers', type=int, default=1, help='keep data loading workers alive between epochs')
+parser.add_argument('--packed_collate', action='store_true', help='collate each batch into one shared buffer, see dataloader/collate.py')
+parser.add_argument('--half_transfer', action='store_true', help='ship depth and points as float16 with --packed_collate, the points stay float32 with --precompute_points')
 parser.add_argument('--nepoch', type=int, default=120, help='number of epochs to train for')
 parser.add_argument('--ngpu', type=int, default=1, help='# GPUs')
 parser.add_argument('--main_gpu', type=int, default=0, help='main GPU id') # CUDA_VISIBLE_DEVICES=0 python train.py
@@ -56,9 +58,18 @@ parser.add_argument('--optimizer', type=str, default = '', help='optimizer name
 parser.add_argument('--dataset', type=str, default = 'dexycb', help='dataset name: nyu, dexycb..')
 parser.add_argument('--dataset_path', type=str, default = '../dataset',  help='dataset path')
 parser.add_argument('--protocal', type=str, default = 's0',  help='evaluation setting')
+parser.add_argument('--crop_store', type=str, default = '',  help='root of preprocessed crop stores (train/ and test/), see dataloader/crop_store.py')
+parser.add_argument('--device_augment', action='store_true', help='augment collated batches on the GPU, see dataloader/batch_augment.py')
+parser.add_argument('--annot_index', type=str, default = '',  help='root of compiled annotation indexes (train/ and test/), see dataloader/annot_index.py')
+parser.add_argument('--depth_archive', type=str, default = '',  help='root of packed depth archives (train/ and test/), see dataloader/depth_archive.py')
+parser.add_argument('--tar_shards', type=str, default = '',  help='stream the training set from tar shards (root with train/), see dataloader/tar_shards.py')
+parser.add_argument('--precompute_points', action='store_true', help='compute the stage-one FPS and ball query in the data loading workers, see dataloader/point_precompute.py')
+parser.add_argument('--shuffle_buffer', type=int, default = 1000,  help='shuffle buffer size of each worker with --tar_shards')
 
 parser.add_argument('--test_path', type=str, default = '../dataset',  help='model name for training resume')
 
+parser.add_argument('--fusion_window', type=int, default = 0,  help='search the fused image pixels in a window around the projection of each point (network_mdda), 0 searches the whole map')
+parser.add_argument('--prefix_fps', action='store_true', help='share one FPS over the input across the encoder stages (network_mdda)')
 parser.add_argument('--model_name', type=str, default = 'handmdda',  help='')
 parser.add_argument('--gpu', type=str, default = '0',  help='gpu')
 
@@ -98,37 +109,86 @@ logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y/%m/%d %H:%M:%S
 					filename=os.path.join(save_dir, 'train.log'), level=logging.INFO)
 logging.info('======================================================')
 
+# the model is built before the data: the point precompute transform takes the settings of its encoder
+# (the optional settings of network_mdda.HandModel are only given when used)
+model_kwargs = {}
+if opt.fusion_window > 0:
+	model_kwargs['fusion_window'] = opt.fusion_window
+if opt.prefix_fps:
+	model_kwargs['prefix_fps'] = True
+model = getattr(module, 'HandModel')(joints=opt.JOINT_NUM, stacks=opt.stacks, **model_kwargs)
+
 # 1. Load data
+train_store = os.path.join(opt.crop_store, 'train') if opt.crop_store else None
+test_store = os.path.join(opt.crop_store, 'test') if opt.crop_store else None
+train_archive = os.path.join(opt.depth_archive, 'train') if opt.depth_archive else None
+test_archive = os.path.join(opt.depth_archive, 'test') if opt.depth_archive else None
+train_index = os.path.join(opt.annot_index, 'train') if opt.annot_index else None
+test_index = os.path.join(opt.annot_index, 'test') if opt.annot_index else None
 if opt.dataset == 'nyu':
-	train_data = loader.nyu_loader(opt.dataset_path, 'train', aug_para=[10, 0.2, 180], joint_num=opt.JOINT_NUM)
+	train_data = loader.nyu_loader(opt.dataset_path, 'train', aug_para=[10, 0.2, 180], joint_num=opt.JOINT_NUM, crop_store=train_store, depth_archive=train_archive,
+								   device_augment=opt.device_augment, annot_index=train_index)
 
 elif opt.dataset == 'ho3d':
-	train_data = ho3d_loader.HO3D('train_all', opt.dataset_path, aug_para=[10, 0.2, 180], dataset_version='v2', center_type='joint_mean' )
+	train_data = ho3d_loader.HO3D('train_all', opt.dataset_path, aug_para=[10, 0.2, 180], dataset_version='v2', center_type='joint_mean', depth_archive=train_archive, annot_index=train_index)
 elif opt.dataset == 'dexycb' :
-	train_data = loader.DexYCBDataset(opt.protocal, 'train', opt.dataset_path, aug_para=[10, 0.2, 180])
-
-train_dataloader = torch.utils.data.DataLoader(train_data, batch_size=opt.batchSize,
-										shuffle=True, num_workers=int(opt.workers), pin_memory=False)
+	train_data = loader.DexYCBDataset(opt.protocal, 'train', opt.dataset_path, aug_para=[10, 0.2, 180], crop_store=train_store, depth_archive=train_archive,
+									   device_augment=opt.device_augment, annot_index=train_index)
+
+if opt.device_augment:
+	assert opt.dataset in ['nyu', 'dexycb'], 'device augmentation is implemented for nyu and dexycb'
+	from dataloader.batch_augment import BatchAugment
+	augment = BatchAugment(img_size=train_data.img_size, aug_modes=train_data.aug_modes, aug_para=train_data.aug_para,
+						   flip=train_data.flip, sample_num=train_data.sample_num, pix_dropout=0.4 if opt.dataset == 'nyu' else 0.)
+
+train_collate, test_collate = None, None
+if opt.packed_collate:
+	from dataloader import collate
+	fields = {'nyu': collate.NYU_FIELDS, 'dexycb': collate.DEXYCB_FIELDS, 'ho3d': collate.HO3D_FIELDS}[opt.dataset]
+	if opt.precompute_points:
+		fields = fields + collate.PRECOMPUTE_FIELDS
+	half = collate.HALF_FIELDS if opt.half_transfer else ()
+	if opt.precompute_points:
+		# the indices are computed from the float32 points, the model must see the same points
+		half = tuple(f for f in half if f != 'pcl')
+	train_collate = collate.PackedCollate(collate.RAW_FIELDS if opt.device_augment else fields, half)
+	test_collate = collate.PackedCollate(fields, half)
+
+train_stream = train_data
+if opt.tar_shards:
+	assert opt.dataset in ['dexycb', 'ho3d'], 'tar shards are implemented for dexycb and ho3d'
+	from dataloader.tar_shards import TarShardDataset
+	train_stream = TarShardDataset(train_data, os.path.join(opt.tar_shards, 'train'), shuffle_buffer=opt.shuffle_buffer)
+if opt.precompute_points:
+	assert not opt.device_augment, 'the points of device augmentation are sampled on the GPU'
+	from dataloader.point_precompute import PointPrecompute, precompute_dataset
+	train_stream = precompute_dataset(train_stream, PointPrecompute.from_encoder(model.encoder_global, train_data.sample_num))
+
+train_dataloader = make_dataloader(train_stream, opt.batchSize, shuffle=not opt.tar_shards, workers=int(opt.workers),
+								   pin_memory=bool(opt.pin_memory), persistent_workers=bool(opt.persistent_workers),
+								   prefetch_factor=opt.prefetch_factor, collate_fn=train_collate)
 
 
 if opt.dataset == 'dexycb' :
-	test_data = loader.DexYCBDataset(opt.protocal, 'test', opt.dataset_path)
+	test_data = loader.DexYCBDataset(opt.protocal, 'test', opt.dataset_path, crop_store=test_store, depth_archive=test_archive, annot_index=test_index)
 elif opt.dataset == 'ho3d':
-	test_data = ho3d_loader.HO3D('test', opt.dataset_path, dataset_version='v2', center_type='joint_mean' )
+	test_data = ho3d_loader.HO3D('test', opt.dataset_path, dataset_version='v2', center_type='joint_mean', depth_archive=test_archive, annot_index=test_index)
 elif opt.dataset == 'nyu':
-	test_data = loader.nyu_loader(opt.dataset_path, 'test', joint_num=opt.JOINT_NUM)
+	test_data = loader.nyu_loader(opt.dataset_path, 'test', joint_num=opt.JOINT_NUM, crop_store=test_store, depth_archive=test_archive, annot_index=test_index)
 
+test_stream = test_data
+if opt.precompute_points:
+	test_stream = precompute_dataset(test_data, PointPrecompute.from_encoder(model.encoder_global, test_data.sample_num))
 
-test_dataloader = torch.utils.data.DataLoader(test_data, batch_size=opt.batchSize,
-										  shuffle=False, num_workers=int(opt.workers), pin_memory=False)
+test_dataloader = make_dataloader(test_stream, opt.batchSize, shuffle=False, workers=int(opt.workers),
+								  pin_memory=bool(opt.pin_memory), persistent_workers=bool(opt.persistent_workers),
+								  prefetch_factor=opt.prefetch_factor, collate_fn=test_collate)
 
 
 print('#Train data:', len(train_data), '#Test data:', len(test_data))
 print (opt)
 
 # 2. Define model, loss and optimizer
-model = getattr(module, 'HandModel')(joints=opt.JOINT_NUM, stacks=opt.stacks)
-
 if opt.ngpu > 1:
 	model.netR_1 = torch.nn.DataParallel(model.netR_1, range(opt.ngpu))
 	model.netR_2 = torch.nn.DataParallel(model.netR_2, range(opt.ngpu))
@@ -170,14 +230,20 @@ for epoch in range(opt.start_epoch, opt.nepoch):
 	train_mse_wld = 0.0
 	timer = time.time()
 
-	for i, data in enumerate(tqdm(train_dataloader, ncols=50)):
+	for i, data in enumerate(tqdm(DevicePrefetcher(train_dataloader), ncols=50)):
 		
 		if len(data[0]) == 1:
 			continue
-		torch.cuda.synchronize()       
 		# 3.1.1 load inputs and targets
-
-		if opt.dataset == "nyu":
+		precomputed = None
+		if opt.precompute_points:
+			precomputed, data = tuple(data[-3:]), data[:-3]
+
+		if opt.device_augment:
+			crop, gt3Dcrop, com2D, cube, M, cam_para = data
+			img, points, gt_xyz, center, M, cube = augment(crop, gt3Dcrop, com2D, cube, M, cam_para)
+			cam_para = cam_para.float()
+		elif opt.dataset == "nyu":
 			img, points, gt_xyz, uvd_gt, center, M, cube, cam_para, volume_length = data
 			# img,img_unnorm,points, gt_xyz,gt_xyz_unnorm, uvd_gt,uvd_gt_unnorm,center,center2d, M, cube, cam_para, volume_length,fx,fy,u0,v0 = data
 			# fx = fx[0].item() #add
@@ -186,8 +252,7 @@ for epoch in range(opt.start_epoch, opt.nepoch):
 			# v0 = v0[0].item()
 		else:
 			img, points, gt_xyz, uvd_gt, center, M, cube, cam_para = data
-		points, gt_xyz, img = points.cuda(),  gt_xyz.cuda(), img.cuda()
-		center, M, cube, cam_para = center.cuda(), M.cuda(), cube.cuda(), cam_para.cuda()
+		# inputs are already on the GPU, see DevicePrefetcher
 		# points, gt_xyz,gt_xyz_unnorm, img,img_unnorm = points.cuda(), gt_xyz.cuda(),gt_xyz_unnorm.cuda(), img.cuda(),img_unnorm.cuda()
 		# uvd_gt_unnorm = uvd_gt_unnorm.cuda()
 		# center,center2d, M, cube, cam_para = center.cuda(),center2d.cuda(), M.cuda(), cube.cuda(), cam_para.cuda()
@@ -195,7 +260,8 @@ for epoch in range(opt.start_epoch, opt.nepoch):
 
 		# 3.1.2 compute output
 		optimizer.zero_grad()
-		loss = model.get_loss(points.transpose(1,2), points.transpose(1,2), img, train_data, center, M, cube, cam_para, gt_xyz.transpose(1,2))
+		_, loss = model.forward_with_loss(points.transpose(1,2), points.transpose(1,2), img, train_data, center, M, cube, cam_para, gt_xyz.transpose(1,2),
+										  precomputed=precomputed)
 		# loss = model.get_loss(points, points, img, train_data, center, M, cube, cam_para, gt_xyz.transpose(1,2))
 
 
@@ -205,7 +271,6 @@ for epoch in range(opt.start_epoch, opt.nepoch):
 		torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
 		# torch.nn.utils.clip_grad_norm_(model.gru.parameters(), 0.25)
 		optimizer.step()
-		torch.cuda.synchronize()
 
 		# 3.1.4 update training error
 		train_mse = train_mse + loss.item()*len(points)
@@ -232,25 +297,25 @@ for epoch in range(opt.start_epoch, opt.nepoch):
 	test_mse = 0.0
 	test_wld_err = 0.0
 	timer = time.time()
-	for i, data in enumerate(tqdm(test_dataloader, ncols=50)):
-		torch.cuda.synchronize()
+	for i, data in enumerate(tqdm(DevicePrefetcher(test_dataloader), ncols=50)):
 		with torch.no_grad():
 			# 3.2.1 load inputs and targets
+			precomputed = None
+			if opt.precompute_points:
+				precomputed, data = tuple(data[-3:]), data[:-3]
 
 			if opt.dataset == "nyu":
 				img, points, gt_xyz, uvd_gt, center, M, cube, cam_para, volume_length = data
-				volume_length = volume_length.cuda()
 			else:
 				img, points, gt_xyz, uvd_gt, center, M, cube, cam_para = data
 				volume_length = 250.
-			points, gt_xyz, img = points.cuda(),  gt_xyz.cuda(), img.cuda()
-			center, M, cube, cam_para = center.cuda(), M.cuda(), cube.cuda(), cam_para.cuda()
 
 
-			estimation = model(points.transpose(1,2), points.transpose(1,2), img, test_data, center, M, cube, cam_para)
-			loss = model.get_loss(points.transpose(1,2), points.transpose(1,2), img, test_data, center, M, cube, cam_para, gt_xyz.transpose(1,2))
+			# one encoder pass for the estimation and the loss
+			joints, loss = model.forward_with_loss(points.transpose(1,2), points.transpose(1,2), img, test_data, center, M, cube, cam_para, gt_xyz.transpose(1,2),
+												   precomputed=precomputed)
+			estimation = joints[-1]
 
-		torch.cuda.synchronize()
 		test_mse = test_mse + loss.item()*len(points)
 
 		# 3.2.3 compute error in world cs        